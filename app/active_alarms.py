@@ -0,0 +1,39 @@
+"""Active alarms for members and kiosks
+
+Shared by the home page, /api/active-alarms and the NFC kiosk check-in index,
+so "active" means the same everywhere: the alarm has occurred and its
+department has not been closed.
+"""
+
+from . import db
+
+# Row layout of for_user(): alarm id, kind, description, occurred_at, department id,
+# department code, department name, where_location, what, is_attended
+def for_user(user_id):
+    """Active alarms in the user's departments, each flagged with whether the user attended"""
+    return db.sql_all("""
+        SELECT a.id, a.kind, a.description, a.occurred_at, ad.department_id, d.code, d.name,
+               a.where_location, a.what, att.user_id IS NOT NULL AS is_attended
+        FROM alarm_departments ad
+        JOIN alarms a ON a.id = ad.alarm_id
+        JOIN departments d ON d.id = ad.department_id
+        LEFT JOIN attendance att ON att.alarm_id = ad.alarm_id
+            AND att.department_id = ad.department_id
+            AND att.user_id = %s
+        WHERE ad.department_id IN (SELECT department_id FROM user_departments WHERE user_id = %s)
+        AND a.occurred_at <= now()
+        AND ad.ended_at IS NULL
+        ORDER BY a.kind, a.occurred_at DESC
+    """, user_id, user_id)
+
+def latest_per_department():
+    """{department id: (alarm id, description)} for the newest active alarm of each department"""
+    rows = db.sql_all("""
+        SELECT DISTINCT ON (ad.department_id) ad.department_id, a.id, a.description
+        FROM alarm_departments ad
+        JOIN alarms a ON a.id = ad.alarm_id
+        WHERE a.occurred_at <= now()
+        AND ad.ended_at IS NULL
+        ORDER BY ad.department_id, a.occurred_at DESC
+    """)
+    return {row[0]: (str(row[1]), row[2]) for row in rows}
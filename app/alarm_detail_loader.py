@@ -0,0 +1,155 @@
+"""Everything the alarm detail page needs, in a fixed number of queries
+
+alarm_detail used to run one attendee query per department, three lookups to
+resolve who was 07 and a query variant per role for comments, and the page
+then fetched the report comment and car assignments separately. load() gathers
+it all in at most six batched queries, whatever the number of departments, and
+returns a JSON bootstrap so the page's first render needs no follow-up fetches.
+"""
+
+from . import db, report_data
+
+def comment_json(row):
+    """Report comment fields as returned by /api/alarm/<id>/comment (row may be None)"""
+    row = row or (None,) * 6
+    return {
+        'success': True,
+        'comment_text': row[0] or '',
+        'larmtyp': row[1] or '',
+        'raddningsledare': row[2] or '',
+        'rapportforfattare_user_id': row[3] or '',
+        'rapportforfattare_name': row[4] or '',
+        'email': row[5] or ''
+    }
+
+def car_assignments_json(rows):
+    """Group (user_id, car_code, first, last, number, insats, bevakning, aterstallning, rokdykning, sjalvskydd) rows by car"""
+    assignments = {}
+    for row in rows:
+        assignments.setdefault(row[1], []).append({
+            'user_id': row[0],
+            'name': f"{row[2]} {row[3]}",
+            'number': row[4] or '',
+            'mantimmar_insats': float(row[5]) if row[5] else None,
+            'mantimmar_bevakning': float(row[6]) if row[6] else None,
+            'mantimmar_aterstallning': float(row[7]) if row[7] else None,
+            'anvant_aa_rokdykning': row[8] or '',
+            'anvant_aa_sjalvskydd': row[9] or ''
+        })
+    return assignments
+
+def load_user_departments(user_id, all_departments=False):
+    """(id, code, name) of the user's departments, or of every department"""
+    return db.sql_all("""
+        SELECT d.id, d.code, d.name
+        FROM departments d
+        WHERE %s OR d.id IN (SELECT department_id FROM user_departments WHERE user_id = %s)
+        ORDER BY d.code
+    """, all_departments, user_id)
+
+def load(alarm_id, selected_dept_id=None, visible_dept_ids=None):
+    """Load the alarm detail page for one alarm.
+
+    visible_dept_ids limits the alarm's departments to those (None = all).
+    Returns None when the alarm doesn't exist, else a dict with the template
+    values alarm, departments, attendance, who_was_07_data and department_cars,
+    plus 'bootstrap' for the page script.
+    """
+    selected_dept_id = int(selected_dept_id) if selected_dept_id else None
+
+    # The alarm and all its departments
+    rows = db.sql_all("""
+        SELECT a.id, a.kind, a.description, a.occurred_at, a.source,
+               a.alarm_type, a.what, a.where_location, a.who_called,
+               d.id, d.code, d.name, ad.ended_at
+        FROM alarms a
+        LEFT JOIN alarm_departments ad ON ad.alarm_id = a.id
+        LEFT JOIN departments d ON d.id = ad.department_id
+        WHERE a.id = %s
+        ORDER BY d.code
+    """, alarm_id)
+    if not rows:
+        return None
+
+    departments = [row[9:13] for row in rows if row[9] is not None]
+    if visible_dept_ids is not None:
+        departments = [dept for dept in departments if dept[0] in visible_dept_ids]
+
+    # Top-level status follows the selected department
+    selected_ended_at = next((dept[3] for dept in departments if dept[0] == selected_dept_id), None)
+    if selected_dept_id:
+        departments = [dept for dept in departments if dept[0] == selected_dept_id]
+    dept_ids = [dept[0] for dept in departments]
+
+    # Template expects: [0]=id, [1]=kind, [2]=description, [3]=occurred_at, [4]=ended_at,
+    # [5]=source, [6]=alarm_type, [7]=what, [8]=where_location, [9]=who_called
+    first = rows[0]
+    alarm = (first[0], first[1], first[2], first[3], selected_ended_at) + tuple(first[4:9])
+
+    attendance = {dept_id: [] for dept_id in dept_ids}
+    department_cars = {}
+    car_assignments = {}
+    comment = None
+    who_was_07_data = None
+
+    if dept_ids:
+        for row in db.sql_all("""
+            SELECT u.id, a.attended_at, ud.number, u.first_name, u.last_name, a.department_id
+            FROM attendance a
+            JOIN users u ON a.user_id = u.id
+            LEFT JOIN user_departments ud ON a.user_id = ud.user_id AND a.department_id = ud.department_id
+            WHERE a.alarm_id = %s AND a.department_id = ANY(%s)
+            ORDER BY a.attended_at
+        """, alarm_id, dept_ids):
+            attendance[row[5]].append(row[:5])
+
+        # Cars and the car assignment version of each department
+        for dept_id, cars, version in db.sql_all("""
+            SELECT d.id,
+                   ARRAY(SELECT dc.car_code FROM department_cars dc WHERE dc.department_id = d.id ORDER BY dc.car_code),
+                   COALESCE(v.version, 0)
+            FROM unnest(%s::int[]) AS d(id)
+            LEFT JOIN alarm_car_assignment_versions v ON v.alarm_id = %s AND v.department_id = d.id
+        """, dept_ids, alarm_id):
+            if cars:
+                department_cars[dept_id] = [(dept_id, car_code) for car_code in cars]
+            car_assignments[dept_id] = {'success': True, 'assignments': {}, 'version': version}
+
+        assignment_rows = db.sql_all("""
+            SELECT ua.user_id, ua.car_code, u.first_name, u.last_name, ud.number,
+                   ua.mantimmar_insats, ua.mantimmar_bevakning, ua.mantimmar_aterstallning,
+                   ua.anvant_aa_rokdykning, ua.anvant_aa_sjalvskydd, ua.department_id
+            FROM alarm_user_car_assignments ua
+            JOIN users u ON ua.user_id = u.id
+            LEFT JOIN user_departments ud ON ua.user_id = ud.user_id AND ua.department_id = ud.department_id
+            WHERE ua.alarm_id = %s AND ua.department_id = ANY(%s)
+            ORDER BY ua.car_code, ud.number
+        """, alarm_id, dept_ids)
+        for dept_id in dept_ids:
+            car_assignments[dept_id]['assignments'] = car_assignments_json(
+                [row for row in assignment_rows if row[10] == dept_id])
+
+    # Report comment and who was 07 of the selected department, as on the report
+    report = report_data.load(alarm_id, selected_dept_id, include_cars=False) if selected_dept_id else None
+    if report:
+        comment = comment_json((report.beskrivning, report.larmtyp, report.raddningsledare,
+                                report.rapportforfattare_user_id, report.rapportforfattare_name,
+                                report.email))
+        if report.enhetschef:
+            who_was_07_data = {
+                'number': report.enhetschef.number or '',
+                'first_name': report.enhetschef.first_name,
+                'last_name': report.enhetschef.last_name
+            }
+
+    return {
+        'alarm': alarm,
+        'departments': departments,
+        'attendance': attendance,
+        'who_was_07_data': who_was_07_data,
+        'department_cars': department_cars,
+        'bootstrap': {
+            'comment': comment,
+            'car_assignments': {str(dept_id): data for dept_id, data in car_assignments.items()}
+        }
+    }
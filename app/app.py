@@ -6,7 +6,7 @@ from urllib.parse import quote
 import uuid
 import csv
 import io
-from . import db, auth
+from . import db, auth, polling, snapshots, checkins, idempotency, active_alarms, alarm_detail_loader, report_data
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
@@ -126,56 +126,9 @@ def auth_nfc_login():
         if not tag_uid:
             return jsonify({'success': False, 'error': 'Ingen NFC-kod angiven'})
         
-        # Find the NFC tag
-        nfc_tag = db.sql_one("""
-            SELECT nt.user_id, nt.department_id, d.code, d.name, u.first_name, u.last_name
-            FROM nfc_tags nt
-            JOIN departments d ON nt.department_id = d.id
-            JOIN users u ON nt.user_id = u.id
-            WHERE nt.tag_uid = %s
-        """, tag_uid)
-        
-        if not nfc_tag:
-            return jsonify({'success': False, 'error': 'Ogiltig NFC-kod'})
-        
-        # Check for active alarms for this department
-        active_alarms = db.sql_all("""
-            SELECT a.id, a.description, a.occurred_at
-            FROM alarms a
-            JOIN alarm_departments ad ON a.id = ad.alarm_id
-            WHERE ad.department_id = %s 
-            AND a.occurred_at <= now()
-            AND ad.ended_at IS NULL
-            ORDER BY a.occurred_at DESC
-        """, nfc_tag[1])
-        
-        if active_alarms:
-            # Mark attendance for the first active alarm
-            alarm = active_alarms[0]
-            db.sql_exec("""
-                INSERT INTO attendance (alarm_id, user_id, department_id, attended_at, is_attending)
-                VALUES (%s, %s, %s, NOW(), TRUE)
-                ON CONFLICT (alarm_id, department_id, user_id) 
-                DO UPDATE SET 
-                    attended_at = NOW(),
-                    eta = NULL,
-                    is_attending = TRUE
-            """, alarm[0], nfc_tag[0], nfc_tag[1])
-            
-            return jsonify({
-                'success': True,
-                'action': 'attended_alarm',
-                'alarm_description': alarm[1],
-                'department': nfc_tag[2]
-            })
-        else:
-            return jsonify({
-                'success': True,
-                'action': 'no_alarm',
-                'message': 'Inga aktiva larm för denna avdelning',
-                'department': nfc_tag[2]
-            })
-            
+        # Validated against the in-memory tag index and journaled locally;
+        # attendance is written in the background (see checkins.py)
+        return jsonify(checkins.scan(tag_uid))
     except Exception as e:
         return jsonify({'success': False, 'error': f'Ett fel uppstod: {str(e)}'})
 
@@ -238,53 +191,11 @@ def home():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
-    user_id = session['user_id']
-    
-    # Get user's departments
-    departments = db.sql_all("""
-        SELECT d.id, d.code, d.name
-        FROM user_departments ud
-        JOIN departments d ON ud.department_id = d.id
-        WHERE ud.user_id = %s
-    """, user_id)
+    # Active alarms with the user's attendance flag, in one query
+    alarms = active_alarms.for_user(session['user_id'])
+    attended = {(alarm[0], alarm[4]) for alarm in alarms if alarm[9]}
     
-    # Get active alarms for user's departments
-    alarms = db.sql_all("""
-        SELECT a.id, a.kind, a.description, a.occurred_at, ad.department_id, d.code, d.name, a.where_location, a.what
-        FROM alarms a
-        JOIN alarm_departments ad ON a.id = ad.alarm_id
-        JOIN departments d ON ad.department_id = d.id
-        WHERE ad.department_id = ANY(%s)
-        AND a.occurred_at <= now()
-        AND ad.ended_at IS NULL
-        ORDER BY a.kind, a.occurred_at DESC
-    """, [dept[0] for dept in departments])
-    
-    # Check which alarms user has already attended
-    attended = set()
-    if alarms:
-        # Create a list of alarm-department pairs for the query
-        alarm_dept_pairs = [(alarm[0], alarm[4]) for alarm in alarms]
-        
-        # Use a different approach - check each pair individually or use IN with concatenated values
-        if alarm_dept_pairs:
-            # Convert to a format that works with PostgreSQL
-            pair_conditions = []
-            params = [user_id]
-            for i, (alarm_id, dept_id) in enumerate(alarm_dept_pairs):
-                pair_conditions.append(f"(alarm_id = %s AND department_id = %s)")
-                params.extend([alarm_id, dept_id])
-            
-            query = f"""
-                SELECT alarm_id, department_id
-                FROM attendance
-                WHERE user_id = %s AND ({' OR '.join(pair_conditions)})
-            """
-            
-            attended_rows = db.sql_all(query, *params)
-            attended = {(row[0], row[1]) for row in attended_rows}
-    
-    return render_template('home.html', alarms=alarms, attended=attended, departments=departments)
+    return render_template('home.html', alarms=alarms, attended=attended)
 
 @app.route('/api/active-alarms')
 def api_active_alarms():
@@ -292,58 +203,15 @@ def api_active_alarms():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    user_id = session['user_id']
-    
-    # Get user's departments
-    departments = db.sql_all("""
-        SELECT d.id, d.code, d.name
-        FROM user_departments ud
-        JOIN departments d ON ud.department_id = d.id
-        WHERE ud.user_id = %s
-    """, user_id)
-    
-    if not departments:
-        return jsonify({'alarms': [], 'attended': []})
-    
-    # Get active alarms for user's departments
-    alarms = db.sql_all("""
-        SELECT a.id, a.kind, a.description, a.occurred_at, ad.department_id, d.code, d.name, a.where_location, a.what
-        FROM alarms a
-        JOIN alarm_departments ad ON a.id = ad.alarm_id
-        JOIN departments d ON ad.department_id = d.id
-        WHERE ad.department_id = ANY(%s)
-        AND a.occurred_at <= now()
-        AND ad.ended_at IS NULL
-        ORDER BY a.kind, a.occurred_at DESC
-    """, [dept[0] for dept in departments])
-    
-    # Check which alarms user has already attended
-    attended = set()
-    if alarms:
-        alarm_dept_pairs = [(alarm[0], alarm[4]) for alarm in alarms]
-        
-        if alarm_dept_pairs:
-            pair_conditions = []
-            params = [user_id]
-            for alarm_id, dept_id in alarm_dept_pairs:
-                pair_conditions.append(f"(alarm_id = %s AND department_id = %s)")
-                params.extend([alarm_id, dept_id])
-            
-            query = f"""
-                SELECT alarm_id, department_id
-                FROM attendance
-                WHERE user_id = %s AND ({' OR '.join(pair_conditions)})
-            """
-            
-            attended_rows = db.sql_all(query, *params)
-            attended = {(str(row[0]), row[1]) for row in attended_rows}
+    # Active alarms with the user's attendance flag, in one query
+    alarms = active_alarms.for_user(session['user_id'])
     
     # Format alarms for JSON response
     alarms_data = []
     for alarm in alarms:
         alarm_id = str(alarm[0])
         dept_id = alarm[4]
-        is_attended = (alarm_id, dept_id) in attended
+        is_attended = alarm[9]
         
         # Determine location
         location = None
@@ -365,10 +233,15 @@ def api_active_alarms():
             'is_attended': is_attended
         })
     
-    return jsonify({
+    # New alarms must show up promptly, so this poll stays at the baseline interval
+    poll_interval = polling.DISCOVERY_INTERVAL
+    
+    response = jsonify({
         'alarms': alarms_data,
-        'attended': [{'alarm_id': str(a[0]), 'department_id': a[1]} for a in attended]
+        'attended': [{'alarm_id': str(alarm[0]), 'department_id': alarm[4]} for alarm in alarms if alarm[9]],
+        'poll_interval': poll_interval
     })
+    return polling.with_poll_interval(response, poll_interval)
 
 @app.route('/profile', methods=['GET', 'POST'])
 def profile():
@@ -416,6 +289,7 @@ def profile():
     return render_template('profile.html', phone=phone)
 
 @app.route('/attendance/<alarm_id>/<int:department_id>', methods=['POST'])
+@idempotency.idempotent
 def mark_attendance(alarm_id, department_id):
     try:
         if 'user_id' not in session:
@@ -425,75 +299,15 @@ def mark_attendance(alarm_id, department_id):
         arrival_time = request.form.get('arrival_time', type=int)
         comment = request.form.get('comment', '').strip()
         
-        # Verify user is member of department
-        membership = db.sql_one("""
-            SELECT 1 FROM user_departments
-            WHERE user_id = %s AND department_id = %s
-        """, user_id, department_id)
+        # Membership check, response and attendance upserts in one round trip
+        # (ETA is computed by the database as now() + arrival_time minutes)
+        is_member = db.sql_one("""
+            SELECT record_attendance(%s, %s, %s, %s, %s, TRUE, TRUE, %s)
+        """, alarm_id, department_id, user_id, comment, arrival_time, arrival_time == 0)[0]
         
-        if not membership:
+        if not is_member:
             return jsonify({'error': 'Not authorized for this department'}), 403
-        
-        # Calculate ETA if arrival_time is provided
-        from datetime import datetime, timedelta
-        from zoneinfo import ZoneInfo
-        helsinki_tz = ZoneInfo('Europe/Helsinki')
-        
-        eta = None
-        attended_at = None
-        is_attending = True  # They're responding to the alarm
-        
-        if arrival_time is not None and arrival_time > 0:
-            # They're coming in the future - set ETA, clear attended_at
-            eta = datetime.now(helsinki_tz) + timedelta(minutes=arrival_time)
-            attended_at = None
-        elif arrival_time == 0:
-            # They're on site now - set attended_at, clear ETA
-            attended_at = datetime.now(helsinki_tz)
-            eta = None
-        
-        # Also create/update alarm_responses to indicate they're responding
-        db.sql_exec("""
-            INSERT INTO alarm_responses (alarm_id, department_id, user_id, comment, is_attending, eta)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            ON CONFLICT (alarm_id, department_id, user_id) 
-            DO UPDATE SET 
-                comment = EXCLUDED.comment,
-                is_attending = EXCLUDED.is_attending,
-                eta = EXCLUDED.eta,
-                responded_at = now()
-        """, alarm_id, department_id, user_id, comment, is_attending, eta)
-        
-        # Mark attendance with comment and ETA
-        # Always create/update attendance record so home page can detect it
-        # If attended_at is None, don't include it in INSERT (let DB default handle it)
-        # If attended_at is set (they're on site), include it
-        if attended_at is not None:
-            db.sql_exec("""
-                INSERT INTO attendance (alarm_id, department_id, user_id, comment, eta, attended_at)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON CONFLICT (alarm_id, department_id, user_id) 
-                DO UPDATE SET 
-                    comment = EXCLUDED.comment,
-                    eta = EXCLUDED.eta,
-                    attended_at = EXCLUDED.attended_at
-            """, alarm_id, department_id, user_id, comment, eta, attended_at)
-        else:
-            # They have an ETA - don't set attended_at
-            # On conflict, only update attended_at if ETA is in the past
-            db.sql_exec("""
-                INSERT INTO attendance (alarm_id, department_id, user_id, comment, eta)
-                VALUES (%s, %s, %s, %s, %s)
-                ON CONFLICT (alarm_id, department_id, user_id) 
-                DO UPDATE SET 
-                    comment = EXCLUDED.comment,
-                    eta = EXCLUDED.eta,
-                    attended_at = CASE 
-                        WHEN EXCLUDED.eta IS NULL THEN COALESCE(attendance.attended_at, now())
-                        WHEN EXCLUDED.eta <= now() THEN COALESCE(attendance.attended_at, now())
-                        ELSE attendance.attended_at
-                    END
-            """, alarm_id, department_id, user_id, comment, eta)
+        snapshots.invalidate(alarm_id)
         
         # Ensure arrival_time is a valid integer or None
         arrival_time_value = arrival_time if arrival_time is not None else 0
@@ -536,10 +350,12 @@ def remove_attendance(alarm_id, department_id):
         DELETE FROM alarm_responses 
         WHERE alarm_id = %s AND department_id = %s AND user_id = %s
     """, alarm_id, department_id, user_id)
+    snapshots.invalidate(alarm_id)
     
     return jsonify({'success': True})
 
 @app.route('/response/<alarm_id>/<int:department_id>', methods=['POST'])
+@idempotency.idempotent
 def add_response(alarm_id, department_id):
     """Add a response/comment that doesn't necessarily mean attendance"""
     if 'user_id' not in session:
@@ -550,50 +366,14 @@ def add_response(alarm_id, department_id):
     is_attending = request.form.get('is_attending', 'false').lower() == 'true'
     arrival_time = request.form.get('arrival_time', type=int)
     
-    # Verify user is member of department
-    membership = db.sql_one("""
-        SELECT 1 FROM user_departments
-        WHERE user_id = %s AND department_id = %s
-    """, user_id, department_id)
+    # Membership check, response upsert and (when attending) attendance upsert in one round trip
+    is_member = db.sql_one("""
+        SELECT record_attendance(%s, %s, %s, %s, %s, %s, TRUE, FALSE)
+    """, alarm_id, department_id, user_id, comment, arrival_time, is_attending)[0]
     
-    if not membership:
+    if not is_member:
         return jsonify({'error': 'Not authorized for this department'}), 403
-    
-    # Calculate ETA if arrival_time is provided and user is attending
-    eta = None
-    if is_attending and arrival_time and arrival_time > 0:
-        from datetime import datetime, timedelta
-        from zoneinfo import ZoneInfo
-        helsinki_tz = ZoneInfo('Europe/Helsinki')
-        eta = datetime.now(helsinki_tz) + timedelta(minutes=arrival_time)
-    
-    # Add response to alarm_responses table
-    db.sql_exec("""
-        INSERT INTO alarm_responses (alarm_id, department_id, user_id, comment, is_attending, eta)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        ON CONFLICT (alarm_id, department_id, user_id) 
-        DO UPDATE SET 
-            comment = EXCLUDED.comment,
-            is_attending = EXCLUDED.is_attending,
-            eta = EXCLUDED.eta,
-            responded_at = now()
-    """, alarm_id, department_id, user_id, comment, is_attending, eta)
-    
-    # If user is attending, also mark attendance
-    if is_attending:
-        db.sql_exec("""
-            INSERT INTO attendance (alarm_id, department_id, user_id, comment, eta)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (alarm_id, department_id, user_id) 
-            DO UPDATE SET 
-                comment = EXCLUDED.comment,
-                eta = EXCLUDED.eta,
-                attended_at = CASE 
-                    WHEN EXCLUDED.eta IS NULL THEN COALESCE(attendance.attended_at, now())
-                    WHEN EXCLUDED.eta <= now() THEN COALESCE(attendance.attended_at, now())
-                    ELSE attendance.attended_at
-                END
-        """, alarm_id, department_id, user_id, comment, eta)
+    snapshots.invalidate(alarm_id)
     
     return jsonify({'success': True, 'is_attending': is_attending, 'arrival_time': arrival_time})
 
@@ -676,44 +456,113 @@ def manual_attendance(alarm_id, department_id):
     if not user_id:
         return jsonify({'error': 'User ID required'}), 400
     
-    # Check if user exists and is in this department
-    user_dept = db.sql_one("""
-        SELECT ud.user_id, ud.department_id 
-        FROM user_departments ud
-        WHERE ud.user_id = %s AND ud.department_id = %s
-    """, user_id, department_id)
-    
-    if not user_dept:
-        return jsonify({'error': 'User not in this department'}), 400
-    
-    # Calculate ETA if arrival_time is provided
-    eta = None
-    if arrival_time and arrival_time > 0:
-        from datetime import datetime, timedelta
-        from zoneinfo import ZoneInfo
-        helsinki_tz = ZoneInfo('Europe/Helsinki')
-        eta = datetime.now(helsinki_tz) + timedelta(minutes=arrival_time)
-    
-    # Mark attendance
+    # Membership check and attendance upsert in one round trip
     try:
-        db.sql_exec("""
-            INSERT INTO attendance (alarm_id, department_id, user_id, comment, eta)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (alarm_id, department_id, user_id) 
-            DO UPDATE SET 
-                comment = EXCLUDED.comment,
-                eta = EXCLUDED.eta,
-                attended_at = CASE 
-                    WHEN EXCLUDED.eta IS NULL THEN COALESCE(attendance.attended_at, now())
-                    WHEN EXCLUDED.eta <= now() THEN COALESCE(attendance.attended_at, now())
-                    ELSE attendance.attended_at
-                END
-        """, alarm_id, department_id, user_id, comment, eta)
+        is_member = db.sql_one("""
+            SELECT record_attendance(%s, %s, %s, %s, %s, TRUE, FALSE, FALSE)
+        """, alarm_id, department_id, user_id, comment, arrival_time)[0]
+        
+        if not is_member:
+            return jsonify({'error': 'User not in this department'}), 400
+        snapshots.invalidate(alarm_id)
         
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Largest crew accepted by one bulk manual attendance request
+MAX_BULK_ATTENDANCE = 200
+
+@app.route('/admin/manual-attendance/<alarm_id>/<int:department_id>/bulk', methods=['POST'])
+def manual_attendance_bulk(alarm_id, department_id):
+    """Manually add attendance for a whole crew in one request (admin or role_07 only)
+
+    Body: {"attendees": [{"user_id": "0052", "arrived_at": "2024-05-01T14:05"}, {"number": 52}], "comment": ""}
+    Each attendee is a user_id or a department number. arrived_at is optional;
+    times without an offset are local time.
+    """
+    if 'user_id' not in session or not (session.get('is_admin') or session.get('role_07')):
+        return jsonify({'error': 'Not authorized'}), 403
+
+    payload = request.get_json(silent=True) or {}
+    attendees = payload.get('attendees')
+    comment = payload.get('comment', '')
+
+    if not isinstance(attendees, list) or not attendees:
+        return jsonify({'error': 'attendees must be a non-empty list'}), 400
+    if len(attendees) > MAX_BULK_ATTENDANCE:
+        return jsonify({'error': f'At most {MAX_BULK_ATTENDANCE} attendees per request'}), 413
+
+    user_ids = []
+    numbers = []
+    arrival_times = []
+    keep_existing = []
+    for entry in attendees:
+        if not isinstance(entry, dict) or not (entry.get('user_id') or entry.get('number') is not None):
+            return jsonify({'error': 'Each attendee needs a user_id or a number'}), 400
+        try:
+            number = int(entry['number']) if not entry.get('user_id') else None
+            arrived_at = None
+            if entry.get('arrived_at'):
+                arrived_at = datetime.fromisoformat(entry['arrived_at'])
+                if arrived_at.tzinfo is None:
+                    arrived_at = arrived_at.replace(tzinfo=LOCAL_TZ)
+        except (TypeError, ValueError):
+            return jsonify({'error': f'Invalid attendee: {entry}'}), 400
+        user_ids.append(str(entry['user_id']) if entry.get('user_id') else None)
+        numbers.append(number)
+        arrival_times.append(arrived_at)
+        # Without an arrival time an existing arrival is kept, like single adds
+        keep_existing.append(arrived_at is None)
+
+    # Resolve user ids and department numbers against the membership in one query
+    # and upsert every resolved member in one statement. Entries without an
+    # arrival time are recorded as arriving now unless already recorded.
+    try:
+        rows = db.sql_all("""
+            WITH input AS (
+                SELECT * FROM unnest(%s::text[], %s::int[], %s::timestamptz[], %s::boolean[])
+                    WITH ORDINALITY AS i(user_id, number, attended_at, keep_existing, position)
+            ), matched AS (
+                SELECT i.position, ud.user_id, COALESCE(i.attended_at, now()) AS attended_at, i.keep_existing
+                FROM input i
+                LEFT JOIN user_departments ud ON ud.department_id = %s
+                    AND (ud.user_id = i.user_id OR (i.user_id IS NULL AND ud.number = i.number))
+            ), resolved AS (
+                SELECT DISTINCT ON (user_id) user_id, attended_at, keep_existing
+                FROM matched
+                WHERE user_id IS NOT NULL
+                ORDER BY user_id, position DESC
+            ), upserted AS (
+                INSERT INTO attendance (alarm_id, department_id, user_id, comment, eta, attended_at)
+                SELECT %s::uuid, %s, r.user_id, %s, NULL, r.attended_at FROM resolved r
+                ON CONFLICT (alarm_id, department_id, user_id)
+                DO UPDATE SET
+                    comment = EXCLUDED.comment,
+                    eta = NULL,
+                    attended_at = CASE WHEN (SELECT r.keep_existing FROM resolved r WHERE r.user_id = EXCLUDED.user_id)
+                                       THEN attendance.attended_at
+                                       ELSE EXCLUDED.attended_at END
+                RETURNING user_id
+            )
+            SELECT position, user_id FROM matched
+        """, user_ids, numbers, arrival_times, keep_existing, department_id, alarm_id, department_id, comment)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    snapshots.invalidate(alarm_id)
+
+    # Entries that matched nobody in the department
+    recorded_ids = {row[1] for row in rows if row[1]}
+    unmatched = {row[0] for row in rows if not row[1]}
+    rejected = [entry for position, entry in enumerate(attendees, start=1) if position in unmatched]
+
+    return jsonify({
+        'success': True,
+        'recorded': sorted(recorded_ids),
+        'rejected': rejected
+    })
+
 @app.route('/api/alarm/<alarm_id>/attendance')
 def get_alarm_attendance(alarm_id):
     """Get attendance data for an alarm with optional department filtering"""
@@ -771,252 +620,25 @@ def get_attendance_data(alarm_id):
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    # Get user info and departments
-    user = db.sql_one("SELECT role_07, is_admin, is_md FROM users WHERE id = %s", session['user_id'])
-    can_see_phones = user and (user[0] or user[1] or user[2])  # Include MD role for phone visibility
-    has_role_07 = user and user[0]  # role_07
-    
-    # Get user's departments
-    user_departments = db.sql_all("""
-        SELECT department_id FROM user_departments WHERE user_id = %s
-    """, session['user_id'])
-    user_department_ids = [row[0] for row in user_departments]
-    
-    # Get attendance data (people who actually arrived)
-    attendance_data = db.sql_all("""
-        SELECT a.user_id, a.attended_at, a.comment, a.eta, a.department_id, u.phone, u.first_name, u.last_name, u.is_rd, u.is_chafoer, d.code, d.name, ud.number
-        FROM attendance a
-        JOIN users u ON a.user_id = u.id
-        JOIN departments d ON a.department_id = d.id
-        LEFT JOIN user_departments ud ON a.user_id = ud.user_id AND a.department_id = ud.department_id
-        WHERE a.alarm_id = %s
-    """, alarm_id)
-    
-    # Get responses data (people who said they're coming)
-    responses_data = db.sql_all("""
-        SELECT ar.user_id, ar.eta, ar.responded_at, ar.comment, ar.department_id, u.phone, u.first_name, u.last_name, u.is_rd, u.is_chafoer, d.code, d.name, ud.number
-        FROM alarm_responses ar
-        JOIN users u ON ar.user_id = u.id
-        JOIN departments d ON ar.department_id = d.id
-        LEFT JOIN user_departments ud ON ar.user_id = ud.user_id AND ar.department_id = ud.department_id
-        WHERE ar.alarm_id = %s AND ar.is_attending = true
-    """, alarm_id)
+    # The merged, sorted roster is shared by every viewer of this alarm and
+    # rebuilt at most once per tick - only the projection is per viewer
+    viewer = snapshots.get_viewer(session['user_id'])
+    snapshot = snapshots.get_snapshot(alarm_id)
+    all_attendees, other_dept_counts = snapshots.project(snapshot, viewer)
     
-    # Combine both datasets
-    all_attendees = []
-    from datetime import datetime, timezone
-    from zoneinfo import ZoneInfo
-    helsinki_tz = ZoneInfo('Europe/Helsinki')
-    
-    # Add attendance records (people who actually arrived)
-    for row in attendance_data:
-        # Only include full data for user's departments
-        if row[4] not in user_department_ids:  # row[4] is department_id
-            continue
-        
-        user_id, attended_at, comment, eta, department_id, phone, first_name, last_name, is_rd, is_chafoer, dept_code, dept_name, dept_number = row
-        
-        # Check if ETA is future
-        if eta:
-            if eta.tzinfo is None:
-                eta_future = eta > datetime.now()
-            else:
-                eta_future = eta > datetime.now(timezone.utc)
-        else:
-            eta_future = False
-        
-        # Format name
-        last_initial = last_name[0] + '.' if last_name else ''
-        display_name = f"{first_name} {last_initial}".strip()
-        rd_status = ' RD' if is_rd else ''
-        chafoer_status = ' C' if is_chafoer else ''
-        
-        all_attendees.append({
-            'user_id': user_id,
-            'attended_at': attended_at.isoformat() if attended_at else None,
-            'comment': comment,
-            'eta': eta.isoformat() if eta else None,
-            'eta_future': eta_future,
-            'department_id': department_id,
-            'department_code': dept_code,
-            'department_name': dept_name,
-            'department_number': dept_number,
-            'display_name': f"{user_id} {display_name}{rd_status}{chafoer_status}",
-            'first_name': first_name,
-            'last_name': last_name,
-            'is_rd': is_rd,
-            'is_chafoer': is_chafoer,
-            'phone': phone if can_see_phones else None
-        })
-    
-    # Add response records (people who said they're coming, avoid duplicates)
-    for row in responses_data:
-        # Only include full data for user's departments
-        if row[4] not in user_department_ids:  # row[4] is department_id
-            continue
-        
-        user_id, eta, responded_at, comment, department_id, phone, first_name, last_name, is_rd, is_chafoer, dept_code, dept_name, dept_number = row
-        
-        # Check if user already exists in attendance
-        user_exists = False
-        for existing in all_attendees:
-            if existing['user_id'] == user_id and existing['department_id'] == department_id:
-                user_exists = True
-                break
-        
-        if not user_exists:
-            # Check if ETA is future
-            if eta:
-                if eta.tzinfo is None:
-                    eta_future = eta > datetime.now()
-                else:
-                    eta_future = eta > datetime.now(timezone.utc)
-            else:
-                eta_future = False
-            
-            # Format name
-            last_initial = last_name[0] + '.' if last_name else ''
-            display_name = f"{first_name} {last_initial}".strip()
-            rd_status = ' RD' if is_rd else ''
-            chafoer_status = ' C' if is_chafoer else ''
-            
-            all_attendees.append({
-                'user_id': user_id,
-                'attended_at': None,  # They haven't arrived yet
-                'comment': comment,
-                'eta': eta.isoformat() if eta else None,
-                'eta_future': eta_future,
-                'department_id': department_id,
-                'department_code': dept_code,
-                'department_name': dept_name,
-                'department_number': dept_number,
-                'display_name': f"{user_id} {display_name}{rd_status}{chafoer_status}",
-                'first_name': first_name,
-                'last_name': last_name,
-                'is_rd': is_rd,
-                'is_chafoer': is_chafoer,
-                'phone': phone if can_see_phones else None
-            })
-    
-    # Sort by shortest time remaining (lowest countdown first)
-    # People who have arrived (attended_at) or have past ETAs go to the top (sorted by arrival time, most recent first)
-    # People with future ETAs are sorted by time remaining (shortest first)
-    # People without ETAs go to the bottom
-    def sort_key(person):
-        attended_at = person['attended_at']
-        eta = person['eta']
-        eta_future = person.get('eta_future', False)
-        
-        if attended_at:
-            # Arrived people go to top - use negative timestamp to sort most recent first
-            # Parse ISO format string
-            if attended_at.endswith('Z'):
-                attended_dt = datetime.fromisoformat(attended_at.replace('Z', '+00:00'))
-            else:
-                attended_dt = datetime.fromisoformat(attended_at)
-            if attended_dt.tzinfo is None:
-                attended_dt = attended_dt.replace(tzinfo=timezone.utc)
-            return (-1, -attended_dt.timestamp())
-        elif eta and not eta_future:
-            # Has past ETA (should be considered "på plats") - put at top with arrived people
-            if eta.endswith('Z'):
-                eta_dt = datetime.fromisoformat(eta.replace('Z', '+00:00'))
-            else:
-                eta_dt = datetime.fromisoformat(eta)
-            if eta_dt.tzinfo is None:
-                eta_dt = eta_dt.replace(tzinfo=timezone.utc)
-            return (-1, -eta_dt.timestamp())
-        elif eta and eta_future:
-            # Has future ETA - sort by time remaining (shortest first)
-            if eta.endswith('Z'):
-                eta_dt = datetime.fromisoformat(eta.replace('Z', '+00:00'))
-            else:
-                eta_dt = datetime.fromisoformat(eta)
-            if eta_dt.tzinfo is None:
-                eta_dt = eta_dt.replace(tzinfo=timezone.utc)
-            now = datetime.now(timezone.utc)
-            time_remaining = (eta_dt - now).total_seconds()
-            # Use 0 to sort after arrived people, ascending by time remaining
-            return (0, time_remaining)
-        else:
-            # No ETA - go to bottom
-            return (9999999998, 0)
-    
-    all_attendees.sort(key=sort_key)
-    
-    # Calculate counter data for other departments (if user has role_07)
-    other_dept_counts = {}
-    if has_role_07:
-        # Get all departments involved in this alarm
-        all_dept_ids = set()
-        for row in attendance_data:
-            all_dept_ids.add(row[4])  # department_id
-        for row in responses_data:
-            all_dept_ids.add(row[4])  # department_id
-        
-        # Calculate counts for departments user is not part of
-        for dept_id in all_dept_ids:
-            if dept_id not in user_department_ids:
-                # Get attendance data for this department
-                dept_attendance = [row for row in attendance_data if row[4] == dept_id]
-                dept_responses = [row for row in responses_data if row[4] == dept_id]
-                
-                # Track users we've seen (to avoid double counting)
-                processed_user_ids = set()
-                on_site_count = 0
-                incoming_count = 0
-                rd_count = 0
-                
-                # Process attendance records - these are all "on site"
-                for record in dept_attendance:
-                    user_id = record[0]
-                    if user_id not in processed_user_ids:
-                        processed_user_ids.add(user_id)
-                        on_site_count += 1
-                        if record[8]:  # is_rd
-                            rd_count += 1
-                
-                # Process response records - only count if not already in attendance
-                for record in dept_responses:
-                    user_id = record[0]
-                    if user_id not in processed_user_ids:
-                        # Check if they have a future ETA
-                        eta = record[1]
-                        if eta:
-                            if eta.tzinfo is None:
-                                eta_future = eta > datetime.now()
-                            else:
-                                eta_future = eta > datetime.now(timezone.utc)
-                        else:
-                            eta_future = True  # No ETA means they're still coming
-                        
-                        if eta_future:
-                            incoming_count += 1
-                        else:
-                            # Past ETA but no attendance record - count as on-site
-                            on_site_count += 1
-                        if record[8]:  # is_rd
-                            rd_count += 1
-                        processed_user_ids.add(user_id)
-                
-                # Get department code and name
-                # For attendance: row[10]=code, row[11]=name
-                # For responses: row[10]=code, row[11]=name
-                dept_code = dept_attendance[0][10] if dept_attendance else (dept_responses[0][10] if dept_responses else '')
-                dept_name = dept_attendance[0][11] if dept_attendance else (dept_responses[0][11] if dept_responses else '')
-                
-                other_dept_counts[dept_id] = {
-                    'code': dept_code,
-                    'name': dept_name,
-                    'incoming': incoming_count,
-                    'on_site': on_site_count,
-                    'rd_count': rd_count
-                }
+    # Recommend the next poll based on alarm age and the latest change
+    if snapshot['exists'] and snapshot['ended_at'] is None:
+        poll_interval = polling.recommend_poll_interval(snapshot['occurred_at'], snapshot['last_change_at'])
+    else:
+        # Ended or unknown alarm - nothing is going to change
+        poll_interval = polling.STALE_INTERVAL
     
-    return jsonify({
+    response = jsonify({
         'attendees': all_attendees,
-        'other_dept_counts': other_dept_counts
+        'other_dept_counts': other_dept_counts,
+        'poll_interval': poll_interval
     })
+    return polling.with_poll_interval(response, poll_interval)
 
 @app.route('/api/responses/<alarm_id>')
 def get_responses_data(alarm_id):
@@ -1127,6 +749,7 @@ def update_comment(alarm_id, department_id):
         SET comment = %s, responded_at = now()
         WHERE alarm_id = %s AND department_id = %s AND user_id = %s
     """, comment, alarm_id, department_id, user_id)
+    snapshots.invalidate(alarm_id)
     
     return jsonify({'success': True})
 
@@ -1402,26 +1025,7 @@ def get_alarm_comment(alarm_id):
             WHERE alarm_id = %s AND department_id = %s
         """, alarm_id, dept_id)
         
-        if comment_data:
-            return jsonify({
-                'success': True,
-                'comment_text': comment_data[0] or '',
-                'larmtyp': comment_data[1] or '',
-                'raddningsledare': comment_data[2] or '',
-                'rapportforfattare_user_id': comment_data[3] or '',
-                'rapportforfattare_name': comment_data[4] or '',
-                'email': comment_data[5] or ''
-            })
-        else:
-            return jsonify({
-                'success': True,
-                'comment_text': '',
-                'larmtyp': '',
-                'raddningsledare': '',
-                'rapportforfattare_user_id': '',
-                'rapportforfattare_name': '',
-                'email': ''
-            })
+        return jsonify(alarm_detail_loader.comment_json(comment_data))
     except Exception as e:
         print(f"Error getting comment: {e}")
         return jsonify({'error': f'Error getting comment: {str(e)}'}), 500
@@ -1438,116 +1042,40 @@ def export_alarm_comprehensive(alarm_id):
     is_md = session.get('is_md', False)
     selected_dept_id = session.get('selected_dept_id')
     
-    # Get alarm details
-    alarm = db.sql_one("""
-        SELECT a.id, a.kind, a.description, a.occurred_at, a.source,
-               a.alarm_type, a.what, a.where_location, a.who_called
-        FROM alarms a
-        WHERE a.id = %s
-    """, alarm_id)
-    
-    if not alarm:
-        return "Alarm not found", 404
-    
     if not selected_dept_id:
         return "No department selected", 400
     
-    # Get selected department info
-    dept_info = db.sql_one("""
-        SELECT d.id, d.code, d.name, ad.ended_at
-        FROM departments d
-        JOIN alarm_departments ad ON d.id = ad.department_id
-        WHERE ad.alarm_id = %s AND d.id = %s
-    """, alarm_id, selected_dept_id)
+    # Alarm, department, report comment, people and crew per car
+    report = report_data.load(alarm_id, selected_dept_id)
     
-    if not dept_info:
+    if not report:
+        return "Alarm not found", 404
+    
+    if not report.in_alarm:
         return "Department not found for this alarm", 404
     
-    dept_id, dept_code, dept_name, dept_ended_at = dept_info
+    dept_id, dept_code, dept_name = report.department_id, report.department_code, report.department_name
     
     # Check permissions
     if not (is_superadmin or is_md):
-        user_departments = db.sql_all("""
-            SELECT department_id FROM user_departments 
-            WHERE user_id = %s
-        """, user_id)
-        user_dept_ids = [dept[0] for dept in user_departments]
-        if dept_id not in user_dept_ids:
+        membership = db.sql_one("""
+            SELECT 1 FROM user_departments 
+            WHERE user_id = %s AND department_id = %s
+        """, user_id, dept_id)
+        if not membership:
             return "Access denied", 403
     
-    # Get report data (comment with larmtyp, raddningsledare, rapportforfattare, email)
-    try:
-        comment_data = db.sql_one("""
-            SELECT comment, larmtyp, raddningsledare, rapportforfattare_user_id, rapportforfattare_name, email 
-            FROM alarm_comments 
-            WHERE alarm_id = %s AND department_id = %s
-        """, alarm_id, selected_dept_id)
-    except Exception as e:
-        print(f"Warning: Could not fetch rapportforfattare/email columns: {e}")
-        comment_data = db.sql_one("""
-            SELECT comment, larmtyp, raddningsledare 
-            FROM alarm_comments 
-            WHERE alarm_id = %s AND department_id = %s
-        """, alarm_id, selected_dept_id)
-        if comment_data:
-            comment_data = (comment_data[0], comment_data[1], comment_data[2], None, None, None)
-    
-    larmtyp = comment_data[1] if comment_data and len(comment_data) > 1 and comment_data[1] else ''
-    raddningsledare = comment_data[2] if comment_data and len(comment_data) > 2 and comment_data[2] else ''
-    beskrivning = comment_data[0] if comment_data and comment_data[0] else ''
-    
-    # Get rapportförfattare name
-    rapportforfattare = ''
-    if comment_data and len(comment_data) > 3 and comment_data[3]:
-        user_data = db.sql_one("SELECT first_name, last_name FROM users WHERE id = %s", comment_data[3])
-        if user_data:
-            dept_number = db.sql_one("""
-                SELECT ud.number FROM user_departments ud 
-                WHERE ud.user_id = %s AND ud.department_id = %s
-            """, comment_data[3], selected_dept_id)
-            number_str = dept_number[0] if dept_number else ''
-            rapportforfattare = f"{user_data[0]} {user_data[1]}" + (f" ({number_str})" if number_str else "")
-    elif comment_data and len(comment_data) > 4 and comment_data[4]:
-        rapportforfattare = comment_data[4]
-    
-    email = comment_data[5] if comment_data and len(comment_data) > 5 and comment_data[5] else ''
-    
-    # Get who_was_07 (Enhetschef)
-    who_was_07_record = db.sql_one("""
-        SELECT user_id, name FROM alarm_who_was_07 
-        WHERE alarm_id = %s AND department_id = %s
-    """, alarm_id, selected_dept_id)
-    
-    enhetschef = ''
-    if who_was_07_record:
-        user_id_07, name_07 = who_was_07_record
-        if user_id_07:
-            user_data = db.sql_one("SELECT first_name, last_name FROM users WHERE id = %s", user_id_07)
-            if user_data:
-                dept_number = db.sql_one("""
-                    SELECT ud.number FROM user_departments ud 
-                    WHERE ud.user_id = %s AND ud.department_id = %s
-                """, user_id_07, selected_dept_id)
-                number_str = dept_number[0] if dept_number else ''
-                enhetschef = f"{user_data[0]} {user_data[1]}" + (f" ({number_str})" if number_str else "")
-        else:
-            enhetschef = name_07 or ''
-    
-    # Get car assignments with Mantimmar and AA fields
-    car_assignments_data = db.sql_all("""
-        SELECT ua.car_code, ua.user_id, u.first_name, u.last_name, ud.number,
-               ua.mantimmar_insats, ua.mantimmar_bevakning, ua.mantimmar_aterstallning,
-               ua.anvant_aa_rokdykning, ua.anvant_aa_sjalvskydd
-        FROM alarm_user_car_assignments ua
-        JOIN users u ON ua.user_id = u.id
-        LEFT JOIN user_departments ud ON ua.user_id = ud.user_id AND ua.department_id = ud.department_id
-        WHERE ua.alarm_id = %s AND ua.department_id = %s
-        ORDER BY ua.car_code, ud.number
-    """, alarm_id, selected_dept_id)
+    larmtyp = report.larmtyp
+    raddningsledare = report.raddningsledare
+    beskrivning = report.beskrivning
+    rapportforfattare = report.rapportforfattare.display if report.rapportforfattare else ''
+    email = report.email
+    enhetschef = report.enhetschef.display if report.enhetschef else ''
     
     # Format date with time (ISO format like 2025-06-23T15:25:00)
-    if alarm[3]:
-        occurred_at_local = alarm[3].astimezone(LOCAL_TZ) if alarm[3].tzinfo else alarm[3].replace(tzinfo=timezone.utc).astimezone(LOCAL_TZ)
+    occurred_at = report.occurred_at
+    if occurred_at:
+        occurred_at_local = occurred_at.astimezone(LOCAL_TZ) if occurred_at.tzinfo else occurred_at.replace(tzinfo=timezone.utc).astimezone(LOCAL_TZ)
         datum_display = occurred_at_local.strftime('%Y-%m-%dT%H:%M:%S')
     else:
         datum_display = 'N/A'
@@ -1593,8 +1121,8 @@ def export_alarm_comprehensive(alarm_id):
     
     # Header information
     header_data = [
-        ['Händelse/objekt:', alarm[6] or ''],
-        ['Adress:', alarm[7] or ''],  # where_location
+        ['Händelse/objekt:', report.what or ''],
+        ['Adress:', report.where_location or ''],
         ['Datum/klockslag:', datum_display],
         ['Larmtyp:', larmtyp],
         ['Enhetschef:', enhetschef]
@@ -1643,35 +1171,13 @@ def export_alarm_comprehensive(alarm_id):
             elements.append(info_table)
             elements.append(Spacer(1, 0.5*cm))
     
-    # Group car assignments by car_code
-    assignments_by_car = {}
-    for row_data in car_assignments_data:
-        car_code = row_data[0]
-        if car_code not in assignments_by_car:
-            assignments_by_car[car_code] = []
-        assignments_by_car[car_code].append({
-            'number': row_data[4] or '',
-            'first_name': row_data[2],
-            'last_name': row_data[3],
-            'mantimmar_insats': row_data[5] if row_data[5] else None,
-            'mantimmar_bevakning': row_data[6] if row_data[6] else None,
-            'mantimmar_aterstallning': row_data[7] if row_data[7] else None,
-            'anvant_aa_rokdykning': row_data[8] if row_data[8] else None,
-            'anvant_aa_sjalvskydd': row_data[9] if row_data[9] else None
-        })
-    
     # Manskap/Fordon section
     manskap_title = Paragraph("Manskap/fordon:", heading_style)
     elements.append(manskap_title)
     
     # Create tables for each unit (car)
-    total_insats = 0.0
-    total_bevakning = 0.0
-    total_aterstallning = 0.0
-    total_aa_rokdykning = 0
-    total_aa_sjalvskydd = 0
-    
-    for car_code in sorted(assignments_by_car.keys()):
+    for car in report.cars:
+        car_code = car.car_code
         # Unit header
         unit_title = Paragraph(f"Enhet: {car_code}", ParagraphStyle(
             'UnitTitle',
@@ -1690,34 +1196,22 @@ def export_alarm_comprehensive(alarm_id):
         ]]
         
         # Add rows for each person
-        for user in assignments_by_car[car_code]:
-            name = f"{user['first_name']} {user['last_name']}"
-            number = str(user['number']) if user['number'] else ''
+        for member in car.crew:
+            name = f"{member.first_name} {member.last_name}"
+            number = str(member.number) if member.number else ''
             
             # Mantimmar column - empty for now (not in database schema)
             mantimmar = ''
             
-            insats = f"{user['mantimmar_insats']:.2f}" if user['mantimmar_insats'] is not None else ''
-            bevakning = f"{user['mantimmar_bevakning']:.2f}" if user['mantimmar_bevakning'] is not None else ''
-            aterstallning = f"{user['mantimmar_aterstallning']:.2f}" if user['mantimmar_aterstallning'] is not None else ''
+            insats = f"{member.mantimmar_insats:.2f}" if member.mantimmar_insats is not None else ''
+            bevakning = f"{member.mantimmar_bevakning:.2f}" if member.mantimmar_bevakning is not None else ''
+            aterstallning = f"{member.mantimmar_aterstallning:.2f}" if member.mantimmar_aterstallning is not None else ''
             
             # AA fields - show "Ja" if 'Ja', empty otherwise
-            aa_rok = 'Ja' if user['anvant_aa_rokdykning'] == 'Ja' else ''
-            aa_sjalv = 'Ja' if user['anvant_aa_sjalvskydd'] == 'Ja' else ''
+            aa_rok = 'Ja' if member.anvant_aa_rokdykning == 'Ja' else ''
+            aa_sjalv = 'Ja' if member.anvant_aa_sjalvskydd == 'Ja' else ''
             
             table_data.append([number, name, mantimmar, insats, bevakning, aterstallning, aa_rok, aa_sjalv])
-            
-            # Sum totals
-            if user['mantimmar_insats']:
-                total_insats += float(user['mantimmar_insats'])
-            if user['mantimmar_bevakning']:
-                total_bevakning += float(user['mantimmar_bevakning'])
-            if user['mantimmar_aterstallning']:
-                total_aterstallning += float(user['mantimmar_aterstallning'])
-            if user['anvant_aa_rokdykning'] == 'Ja':
-                total_aa_rokdykning += 1
-            if user['anvant_aa_sjalvskydd'] == 'Ja':
-                total_aa_sjalvskydd += 1
         
         # Create table with 8 columns - wider columns for readability
         # A4 width: 21cm, margins: 3cm total, available: 18cm
@@ -1763,16 +1257,17 @@ def export_alarm_comprehensive(alarm_id):
     elements.append(summary_title)
     
     # Summary table with 6 columns matching the example format
+    totals = report.totals
     summary_data = [[
         'Mantimmar', 'INSATS totalt', 'BEVAKNING totalt', 
         'ÅTERSTÄLLNING totalt', 'RÖKDYKNING totalt', 'SJÄLVSKYDD totalt'
     ], [
         '',  # Mantimmar total - empty for now (not in database)
-        f"{total_insats:.2f}" if total_insats > 0 else '',
-        f"{total_bevakning:.2f}" if total_bevakning > 0 else '',
-        f"{total_aterstallning:.2f}" if total_aterstallning > 0 else '',
-        str(total_aa_rokdykning) if total_aa_rokdykning > 0 else '',
-        str(total_aa_sjalvskydd) if total_aa_sjalvskydd > 0 else ''
+        f"{totals.insats:.2f}" if totals.insats > 0 else '',
+        f"{totals.bevakning:.2f}" if totals.bevakning > 0 else '',
+        f"{totals.aterstallning:.2f}" if totals.aterstallning > 0 else '',
+        str(totals.aa_rokdykning) if totals.aa_rokdykning > 0 else '',
+        str(totals.aa_sjalvskydd) if totals.aa_sjalvskydd > 0 else ''
     ]]
     
     summary_table = Table(summary_data, colWidths=[2.8*cm, 2.8*cm, 2.8*cm, 2.8*cm, 2.8*cm, 2.8*cm])
@@ -1832,6 +1327,7 @@ def remove_user_attendance(alarm_id):
             DELETE FROM attendance 
             WHERE alarm_id = %s AND user_id = %s AND department_id = %s
         """, alarm_id, user_id, department_id)
+        snapshots.invalidate(alarm_id)
         
         return jsonify({
             'success': True,
@@ -2131,25 +1627,9 @@ def alarm_detail(alarm_id):
     is_superadmin = session.get('is_superadmin', False)
     is_md = session.get('is_md', False)
     
-    # Get user's departments with details
-    if is_superadmin:
-        # Superadmin can see all departments
-        user_departments = db.sql_all("""
-            SELECT id, code, name
-            FROM departments
-            ORDER BY code
-        """)
-        user_dept_ids = [dept[0] for dept in user_departments]
-    else:
-        # Regular users see only their departments
-        user_departments = db.sql_all("""
-            SELECT ud.department_id, d.code, d.name
-            FROM user_departments ud
-            JOIN departments d ON ud.department_id = d.id
-            WHERE ud.user_id = %s
-            ORDER BY d.code
-        """, user_id)
-        user_dept_ids = [dept[0] for dept in user_departments]
+    # Superadmin can see all departments, regular users only their own
+    user_departments = alarm_detail_loader.load_user_departments(user_id, is_superadmin)
+    user_dept_ids = [dept[0] for dept in user_departments]
     
     # Get selected department from query parameter or session
     selected_dept_id = request.args.get('dept_id')
@@ -2166,155 +1646,12 @@ def alarm_detail(alarm_id):
             selected_dept_id = user_dept_ids[0] if user_dept_ids else None
             session['selected_dept_id'] = selected_dept_id
     
-    # Get departments for this alarm with access control and their ended_at status
-    if is_superadmin or is_md:
-        # Superadmin and MD can see all departments
-        alarm_departments = db.sql_all("""
-            SELECT d.id, d.code, d.name, ad.ended_at
-            FROM alarm_departments ad
-            JOIN departments d ON ad.department_id = d.id
-            WHERE ad.alarm_id = %s
-            ORDER BY d.code
-        """, alarm_id)
-    else:
-        # Regular users can only see departments they belong to
-        if user_dept_ids:
-            placeholders = ','.join(['%s'] * len(user_dept_ids))
-            alarm_departments = db.sql_all(f"""
-                SELECT d.id, d.code, d.name, ad.ended_at
-                FROM alarm_departments ad
-                JOIN departments d ON ad.department_id = d.id
-                WHERE ad.alarm_id = %s AND ad.department_id IN ({placeholders})
-                ORDER BY d.code
-            """, alarm_id, *user_dept_ids)
-        else:
-            alarm_departments = []
-    
-    # Get alarm details (for top-level display, use selected department's ended_at if available)
-    selected_ended_at = None
-    if selected_dept_id and alarm_departments:
-        selected_dept_info = next((dept for dept in alarm_departments if dept[0] == int(selected_dept_id)), None)
-        if selected_dept_info:
-            selected_ended_at = selected_dept_info[3]
-    
-    # Get basic alarm info with selected department's ended_at
-    # Template expects: [0]=id, [1]=kind, [2]=description, [3]=occurred_at, [4]=ended_at, [5]=source, [6]=alarm_type, [7]=what, [8]=where_location, [9]=who_called
-    alarm = db.sql_one("""
-        SELECT a.id, a.kind, a.description, a.occurred_at, %s as ended_at, a.source,
-               a.alarm_type, a.what, a.where_location, a.who_called
-        FROM alarms a
-        WHERE a.id = %s
-    """, selected_ended_at, alarm_id)
-    
-    if not alarm:
+    # Superadmin and MD can see all of the alarm's departments, regular users only their own
+    page = alarm_detail_loader.load(alarm_id, selected_dept_id,
+                                    None if is_superadmin or is_md else set(user_dept_ids))
+    if not page:
         return "Alarm not found", 404
-    
-    # Filter to selected department if a specific department is selected
-    if selected_dept_id:
-        # Filter alarm departments to only show selected department
-        alarm_departments = [dept for dept in alarm_departments if dept[0] == int(selected_dept_id)]
-    
-    # Get attendance for each department
-    attendance_data = {}
-    for dept in alarm_departments:
-        attendees = db.sql_all("""
-            SELECT u.id, a.attended_at, ud.number, u.first_name, u.last_name
-            FROM attendance a
-            JOIN users u ON a.user_id = u.id
-            LEFT JOIN user_departments ud ON a.user_id = ud.user_id AND a.department_id = ud.department_id
-            WHERE a.alarm_id = %s AND a.department_id = %s
-            ORDER BY a.attended_at
-        """, alarm_id, dept[0])
-        attendance_data[dept[0]] = attendees
-    
-    # Get comments with access control
-    if is_superadmin or is_md:
-        # Superadmin and MD can see all comments
-        comments_query = """
-            SELECT ac.id, ac.department_id, ac.comment, ac.created_at, 
-                   u.first_name, u.last_name, d.code, d.name
-            FROM alarm_comments ac
-            JOIN users u ON ac.user_id = u.id
-            JOIN departments d ON ac.department_id = d.id
-            WHERE ac.alarm_id = %s
-            ORDER BY ac.created_at DESC
-        """
-        comments = db.sql_all(comments_query, alarm_id)
-    else:
-        # Regular users can only see comments from their departments
-        if user_dept_ids:
-            if selected_dept_id:
-                # Filter to selected department only
-                comments_query = """
-                    SELECT ac.id, ac.department_id, ac.comment, ac.created_at, 
-                           u.first_name, u.last_name, d.code, d.name
-                    FROM alarm_comments ac
-                    JOIN users u ON ac.user_id = u.id
-                    JOIN departments d ON ac.department_id = d.id
-                    WHERE ac.alarm_id = %s AND ac.department_id = %s
-                    ORDER BY ac.created_at DESC
-                """
-                comments = db.sql_all(comments_query, alarm_id, selected_dept_id)
-            else:
-                # Show all user's departments
-                placeholders = ','.join(['%s'] * len(user_dept_ids))
-                comments_query = f"""
-                    SELECT ac.id, ac.department_id, ac.comment, ac.created_at, 
-                           u.first_name, u.last_name, d.code, d.name
-                    FROM alarm_comments ac
-                    JOIN users u ON ac.user_id = u.id
-                    JOIN departments d ON ac.department_id = d.id
-                    WHERE ac.alarm_id = %s AND ac.department_id IN ({placeholders})
-                    ORDER BY ac.created_at DESC
-                """
-                comments = db.sql_all(comments_query, alarm_id, *user_dept_ids)
-        else:
-            comments = []
-    
-    # Get who was 07 data for the selected department
-    who_was_07_data = None
-    if selected_dept_id:
-        who_was_07_record = db.sql_one("""
-            SELECT user_id, name FROM alarm_who_was_07 
-            WHERE alarm_id = %s AND department_id = %s
-        """, alarm_id, selected_dept_id)
-        
-        if who_was_07_record:
-            user_id_07, name_07 = who_was_07_record
-            if user_id_07:  # If we have user_id, get user details
-                user_data = db.sql_one("SELECT first_name, last_name FROM users WHERE id = %s", user_id_07)
-                if user_data:
-                    # Get department number for this user
-                    dept_number = db.sql_one("""
-                        SELECT ud.number FROM user_departments ud 
-                        WHERE ud.user_id = %s AND ud.department_id = %s
-                    """, user_id_07, selected_dept_id)
-                    
-                    who_was_07_data = {
-                        'number': dept_number[0] if dept_number else '',
-                        'first_name': user_data[0],
-                        'last_name': user_data[1]
-                    }
-            elif name_07:  # If we only have name, parse it
-                # Parse name from name_07 (format: "First Last (number)")
-                name_parts = name_07.split(' (')
-                if len(name_parts) == 2:
-                    full_name = name_parts[0]
-                    number = name_parts[1].rstrip(')')
-                    name_parts = full_name.split(' ', 1)
-                    who_was_07_data = {
-                        'number': number,
-                        'first_name': name_parts[0] if len(name_parts) > 0 else '',
-                        'last_name': name_parts[1] if len(name_parts) > 1 else ''
-                    }
-                else:
-                    # Fallback: just use the name as is
-                    name_parts = name_07.split(' ', 1)
-                    who_was_07_data = {
-                        'number': '',
-                        'first_name': name_parts[0] if len(name_parts) > 0 else '',
-                        'last_name': name_parts[1] if len(name_parts) > 1 else ''
-                    }
+    alarm_departments = page['departments']
 
     # Check if user can add comments (only for closed alarms in their department)
     # For the selected department, check if it's closed
@@ -2334,46 +1671,21 @@ def alarm_detail(alarm_id):
     # Get selected department details
     selected_dept = None
     if selected_dept_id:
-        if is_superadmin:
-            # For superadmin, look in all departments
-            all_departments = db.sql_all("SELECT id, code, name FROM departments ORDER BY code")
-            selected_dept = next((dept for dept in all_departments if dept[0] == int(selected_dept_id)), None)
-        else:
-            # For regular users, look in their departments
-            selected_dept = next((dept for dept in user_departments if dept[0] == int(selected_dept_id)), None)
-    
-    # Get department cars for all departments in this alarm
-    department_cars = {}
-    if alarm_departments:
-        dept_ids = [dept[0] for dept in alarm_departments]
-        if dept_ids:
-            placeholders = ','.join(['%s'] * len(dept_ids))
-            all_cars = db.sql_all(f"""
-                SELECT department_id, car_code 
-                FROM department_cars 
-                WHERE department_id IN ({placeholders})
-                ORDER BY department_id, car_code
-            """, *dept_ids)
-            
-            # Group cars by department_id
-            for car in all_cars:
-                dept_id = car[0]
-                if dept_id not in department_cars:
-                    department_cars[dept_id] = []
-                department_cars[dept_id].append(car)
+        selected_dept = next((dept for dept in user_departments if dept[0] == int(selected_dept_id)), None)
     
     return render_template('alarm_detail.html', 
-                         alarm=alarm, 
+                         alarm=page['alarm'], 
                          departments=alarm_departments, 
-                         attendance=attendance_data,
+                         attendance=page['attendance'],
                          can_comment=can_comment,
                          is_superadmin=is_superadmin,
                          is_md=is_md,
                          user_departments=user_departments,
                          selected_dept_id=selected_dept_id,
                          selected_dept=selected_dept,
-                         who_was_07_data=who_was_07_data,
-                         department_cars=department_cars)
+                         who_was_07_data=page['who_was_07_data'],
+                         department_cars=page['department_cars'],
+                         bootstrap=page['bootstrap'])
 
 @app.route('/api/alarm/<alarm_id>/save-car-assignments', methods=['POST'])
 def save_car_assignments(alarm_id):
@@ -2389,39 +1701,37 @@ def save_car_assignments(alarm_id):
     data = request.get_json()
     department_id = data.get('department_id')
     assignments = data.get('assignments', {})
+    # Version the client loaded; older clients don't send one and skip the check
+    expected_version = data.get('version')
     
     if not department_id:
         return jsonify({'error': 'Department ID required'}), 400
     
+    # One entry per person - if someone is listed twice the last car wins
+    rows = {}
+    for car_code, users in assignments.items():
+        for user in users:
+            rows[user['user_id']] = (car_code, user)
+    
     try:
-        # Delete existing assignments for this alarm/department
-        db.sql_exec("""
-            DELETE FROM alarm_user_car_assignments 
-            WHERE alarm_id = %s AND department_id = %s
-        """, alarm_id, department_id)
-        
-        # Insert new assignments with Mantimmar and AA fields
-        for car_code, users in assignments.items():
-            for user in users:
-                db.sql_exec("""
-                    INSERT INTO alarm_user_car_assignments 
-                    (alarm_id, department_id, user_id, car_code,
-                     mantimmar_insats, mantimmar_bevakning, mantimmar_aterstallning,
-                     anvant_aa_rokdykning, anvant_aa_sjalvskydd)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (alarm_id, department_id, user_id) 
-                    DO UPDATE SET car_code = EXCLUDED.car_code,
-                                  mantimmar_insats = EXCLUDED.mantimmar_insats,
-                                  mantimmar_bevakning = EXCLUDED.mantimmar_bevakning,
-                                  mantimmar_aterstallning = EXCLUDED.mantimmar_aterstallning,
-                                  anvant_aa_rokdykning = EXCLUDED.anvant_aa_rokdykning,
-                                  anvant_aa_sjalvskydd = EXCLUDED.anvant_aa_sjalvskydd
-                """, alarm_id, department_id, user['user_id'], car_code,
-                    user.get('mantimmar_insats'), user.get('mantimmar_bevakning'), 
-                    user.get('mantimmar_aterstallning'), user.get('anvant_aa_rokdykning'),
-                    user.get('anvant_aa_sjalvskydd'))
-        
-        return jsonify({'success': True})
+        # Diff against the stored rows and apply it in one call (see migrations/008)
+        saved, version, inserted, updated, deleted = db.sql_one("""
+            SELECT * FROM save_car_assignments(%s, %s, %s, %s,
+                %s::text[], %s::text[], %s::numeric[], %s::numeric[], %s::numeric[], %s::text[], %s::text[])
+        """, alarm_id, department_id, expected_version, session['user_id'],
+            list(rows),
+            [car_code for car_code, _ in rows.values()],
+            [user.get('mantimmar_insats') for _, user in rows.values()],
+            [user.get('mantimmar_bevakning') for _, user in rows.values()],
+            [user.get('mantimmar_aterstallning') for _, user in rows.values()],
+            [user.get('anvant_aa_rokdykning') for _, user in rows.values()],
+            [user.get('anvant_aa_sjalvskydd') for _, user in rows.values()])
+        
+        if not saved:
+            return jsonify({'error': 'Tilldelningarna har ändrats av någon annan', 'conflict': True, 'version': version}), 409
+        
+        return jsonify({'success': True, 'version': version,
+                        'inserted': inserted, 'updated': updated, 'deleted': deleted})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -2436,6 +1746,14 @@ def get_car_assignments(alarm_id):
         return jsonify({'error': 'Department ID required'}), 400
     
     try:
+        # Saves must send this version back (optimistic locking). Read before the
+        # rows: a save in between then makes the client's save conflict instead
+        # of pairing old rows with the new version.
+        version_row = db.sql_one("""
+            SELECT version FROM alarm_car_assignment_versions
+            WHERE alarm_id = %s AND department_id = %s
+        """, alarm_id, department_id)
+        
         assignments_data = db.sql_all("""
             SELECT ua.user_id, ua.car_code, u.first_name, u.last_name, ud.number,
                    ua.mantimmar_insats, ua.mantimmar_bevakning, ua.mantimmar_aterstallning,
@@ -2447,23 +1765,9 @@ def get_car_assignments(alarm_id):
             ORDER BY ua.car_code, ud.number
         """, alarm_id, department_id)
         
-        assignments = {}
-        for row in assignments_data:
-            car_code = row[1]
-            if car_code not in assignments:
-                assignments[car_code] = []
-            assignments[car_code].append({
-                'user_id': row[0],
-                'name': f"{row[2]} {row[3]}",
-                'number': row[4] or '',
-                'mantimmar_insats': float(row[5]) if row[5] else None,
-                'mantimmar_bevakning': float(row[6]) if row[6] else None,
-                'mantimmar_aterstallning': float(row[7]) if row[7] else None,
-                'anvant_aa_rokdykning': row[8] or '',
-                'anvant_aa_sjalvskydd': row[9] or ''
-            })
+        assignments = alarm_detail_loader.car_assignments_json(assignments_data)
         
-        return jsonify({'success': True, 'assignments': assignments})
+        return jsonify({'success': True, 'assignments': assignments, 'version': version_row[0] if version_row else 0})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -3204,6 +2508,60 @@ def admin_tags():
     
     return render_template('admin/tags.html', tags=tags, users=users, departments=departments)
 
+@app.route('/admin/sms-patterns', methods=['GET', 'POST'])
+def admin_sms_patterns():
+    """Department and alarm kind patterns used to parse SMS alarms"""
+    if not session.get('is_superadmin'):
+        return "Access denied", 403
+    
+    from .sms import patterns as sms_patterns
+    error = None
+    
+    if request.method == 'POST':
+        action = request.form.get('action')
+        pattern = request.form.get('pattern', '').strip()
+        
+        try:
+            if action == 'add_department_pattern' and pattern:
+                db.sql_exec("""
+                    INSERT INTO sms_department_patterns (department_id, pattern, position)
+                    SELECT %s, %s, COALESCE(MAX(position) + 1, 0)
+                    FROM sms_department_patterns WHERE department_id = %s
+                    ON CONFLICT (department_id, pattern) DO NOTHING
+                """, int(request.form['department_id']), pattern, int(request.form['department_id']))
+            elif action == 'delete_department_pattern':
+                db.sql_exec("DELETE FROM sms_department_patterns WHERE id = %s", int(request.form['pattern_id']))
+            elif action == 'add_kind_pattern' and pattern:
+                db.sql_exec("""
+                    INSERT INTO sms_alarm_kind_patterns (kind, pattern, position)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (kind, pattern) DO NOTHING
+                """, request.form['kind'], pattern, int(request.form.get('position') or 0))
+            elif action == 'delete_kind_pattern':
+                db.sql_exec("DELETE FROM sms_alarm_kind_patterns WHERE id = %s", int(request.form['pattern_id']))
+            
+            # Rebuild this worker's matcher now, the others follow within RELOAD_INTERVAL
+            sms_patterns.reload_if_changed()
+            return redirect(url_for('admin_sms_patterns'))
+        except Exception as e:
+            error = f'Error saving pattern: {str(e)}'
+    
+    departments = db.sql_all("""
+        SELECT d.id, d.code, d.name,
+               COALESCE(json_agg(json_build_object('id', p.id, 'pattern', p.pattern)
+                                 ORDER BY p.position, p.id) FILTER (WHERE p.id IS NOT NULL), '[]')
+        FROM departments d
+        LEFT JOIN sms_department_patterns p ON p.department_id = d.id
+        GROUP BY d.id, d.code, d.name
+        ORDER BY d.sms_priority NULLS LAST, d.id
+    """)
+    kind_patterns = db.sql_all("""
+        SELECT id, kind::text, pattern, position FROM sms_alarm_kind_patterns ORDER BY position, kind, id
+    """)
+    
+    return render_template('admin/sms_patterns.html', departments=departments,
+                           kind_patterns=kind_patterns, error=error)
+
 @app.route('/admin/alarms', methods=['GET', 'POST'])
 def admin_alarms():
     # Check if user has admin, superadmin, role_07, or MD permissions
@@ -4113,6 +3471,12 @@ def init_app():
     db.init_db()
     db.run_migrations()
     
+    # Turn passed ETAs into arrivals in the background
+    snapshots.start_sweeper()
+    
+    # Flush NFC kiosk check-ins from the local journal
+    checkins.start()
+    
     # Register SMS webhook routes
     from .sms.webhook import register_sms_routes
     register_sms_routes(app)
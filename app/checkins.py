@@ -0,0 +1,338 @@
+"""Write-behind buffer for NFC kiosk check-ins
+
+A crew arriving at the station scans 15-25 tags within a minute. A scan is
+validated against an in-memory index of tags and active alarms and appended to
+a small local SQLite journal, so the kiosk answers without waiting on Postgres.
+A background thread flushes the journal into attendance in batches with
+retries. Repeated scans of the same person for the same alarm are coalesced
+while they wait, and the journal survives a crash.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+from . import db, snapshots, active_alarms
+
+JOURNAL_PATH = os.getenv('CHECKIN_JOURNAL_PATH', os.path.join('data', 'checkins.db'))
+
+# Seconds between refreshes of the tag and active alarm index
+INDEX_REFRESH = 5
+
+# A scan that misses the index (unknown tag, no alarm yet) reloads it at most this often
+MISS_REFRESH = 1
+
+# Check-ins written to Postgres per statement
+BATCH_SIZE = 100
+
+# Retry failed batches with exponential backoff, then give up
+MAX_ATTEMPTS = 10
+MAX_BACKOFF = 120  # seconds
+
+# A claimed check-in not flushed within this many seconds is retried (worker crashed)
+CLAIM_TIMEOUT = 120
+
+# Flushed check-ins are kept this long for inspection
+KEEP_DONE_SECONDS = 24 * 3600
+
+# Another check-in of the same person for the same alarm is waiting
+_NEWER_PENDING = """
+    SELECT 1 FROM checkins newer
+    WHERE newer.status = 'pending'
+    AND newer.alarm_id = checkins.alarm_id
+    AND newer.department_id = checkins.department_id
+    AND newer.user_id = checkins.user_id
+"""
+
+_local = threading.local()
+_wakeup = threading.Event()
+_worker = None
+_worker_lock = threading.Lock()
+
+# tag_uid -> (user_id, department_id, department code); department_id -> (alarm_id, description)
+_tags = {}
+_active_alarms = {}
+_index_loaded_at = None
+_index_lock = threading.Lock()
+_miss_refresh_at = None
+_miss_refresh_lock = threading.Lock()
+
+def _connect():
+    """Per-thread SQLite connection to the journal file"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        journal_dir = os.path.dirname(JOURNAL_PATH)
+        if journal_dir:
+            os.makedirs(journal_dir, exist_ok=True)
+        conn = sqlite3.connect(JOURNAL_PATH, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS checkins (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                alarm_id TEXT NOT NULL,
+                department_id INTEGER NOT NULL,
+                user_id TEXT NOT NULL,
+                scanned_at REAL NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                claimed_at REAL,
+                finished_at REAL,
+                last_error TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_checkins_pending ON checkins(status, next_attempt_at)")
+        # At most one waiting check-in per person and alarm - later scans update it
+        conn.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_checkins_coalesce
+            ON checkins(alarm_id, department_id, user_id) WHERE status = 'pending'
+        """)
+        _local.conn = conn
+    return conn
+
+def refresh_index():
+    """Reload the tag and active alarm index from the database"""
+    global _tags, _active_alarms, _index_loaded_at
+    tag_rows = db.sql_all("""
+        SELECT UPPER(nt.tag_uid), nt.user_id, nt.department_id, d.code
+        FROM nfc_tags nt
+        JOIN departments d ON nt.department_id = d.id
+    """)
+    # Latest active alarm per department, as the kiosk always checked in to that one
+    alarms = active_alarms.latest_per_department()
+    with _index_lock:
+        _tags = {row[0]: (row[1], row[2], row[3]) for row in tag_rows}
+        _active_alarms = alarms
+        _index_loaded_at = time.monotonic()
+
+def _refresh_on_miss():
+    """Reload the index for a scan that missed it - rate limited, one caller at a time,
+    so a burst of misses costs at most one reload per MISS_REFRESH seconds"""
+    global _miss_refresh_at
+    now = time.monotonic()
+    if _miss_refresh_at is not None and now - _miss_refresh_at < MISS_REFRESH:
+        return
+    if _index_loaded_at is not None and now - _index_loaded_at < MISS_REFRESH:
+        return
+    if not _miss_refresh_lock.acquire(blocking=False):
+        return
+    try:
+        _miss_refresh_at = now
+        refresh_index()
+    except Exception as e:
+        print(f"Check-in index refresh failed: {e}")
+    finally:
+        _miss_refresh_lock.release()
+
+def scan(tag_uid):
+    """Check in a scanned tag. Returns the kiosk response without touching Postgres.
+
+    {'success': True, 'action': 'attended_alarm' | 'no_alarm', ...} or
+    {'success': False, 'error': ...} for unknown tags and while no index could be loaded.
+    """
+    if _index_loaded_at is None:
+        _refresh_on_miss()
+        if _index_loaded_at is None:
+            return {'success': False, 'error': 'Incheckning är inte tillgänglig just nu, försök igen'}
+
+    tag_uid = tag_uid.strip().upper()
+    tag = _tags.get(tag_uid)
+    alarm = _active_alarms.get(tag[1]) if tag else None
+    # The tag may have been registered, or the alarm created, since the last refresh
+    if not alarm:
+        _refresh_on_miss()
+        tag = _tags.get(tag_uid)
+        alarm = _active_alarms.get(tag[1]) if tag else None
+
+    if not tag:
+        return {'success': False, 'error': 'Ogiltig NFC-kod'}
+
+    user_id, department_id, department_code = tag
+    if not alarm:
+        return {
+            'success': True,
+            'action': 'no_alarm',
+            'message': 'Inga aktiva larm för denna avdelning',
+            'department': department_code
+        }
+
+    record(alarm[0], department_id, user_id)
+    return {
+        'success': True,
+        'action': 'attended_alarm',
+        'alarm_description': alarm[1],
+        'department': department_code
+    }
+
+def record(alarm_id, department_id, user_id, scanned_at=None):
+    """Durably journal a check-in; the flusher writes it to attendance"""
+    now = time.time()
+    scanned_at = scanned_at or now
+    _connect().execute("""
+        INSERT INTO checkins (alarm_id, department_id, user_id, scanned_at, next_attempt_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (alarm_id, department_id, user_id) WHERE status = 'pending'
+        DO UPDATE SET scanned_at = MAX(scanned_at, excluded.scanned_at)
+    """, (str(alarm_id), department_id, user_id, scanned_at, now))
+    _wakeup.set()
+
+def pending_count():
+    """Number of check-ins not yet written to attendance"""
+    return _connect().execute(
+        "SELECT COUNT(*) FROM checkins WHERE status IN ('pending', 'processing')"
+    ).fetchone()[0]
+
+def _claim_batch():
+    """Atomically claim up to BATCH_SIZE due check-ins"""
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Give back check-ins claimed by a worker that died, unless a newer scan is waiting
+        conn.execute("""
+            UPDATE checkins SET status = 'superseded', finished_at = ?
+            WHERE status = 'processing' AND claimed_at < ?
+            AND EXISTS (""" + _NEWER_PENDING + """)
+        """, (now, now - CLAIM_TIMEOUT))
+        conn.execute("""
+            UPDATE checkins SET status = 'pending'
+            WHERE status = 'processing' AND claimed_at < ?
+        """, (now - CLAIM_TIMEOUT,))
+
+        rows = conn.execute("""
+            SELECT id, alarm_id, department_id, user_id, scanned_at, attempts FROM checkins
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY id
+            LIMIT ?
+        """, (now, BATCH_SIZE)).fetchall()
+
+        if rows:
+            conn.executemany("""
+                UPDATE checkins SET status = 'processing', claimed_at = ?, attempts = attempts + 1
+                WHERE id = ?
+            """, [(now, row[0]) for row in rows])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return rows
+
+def _write_attendance(rows):
+    """Upsert a batch of check-ins into attendance in one statement"""
+    alarm_ids = [row[1] for row in rows]
+    department_ids = [row[2] for row in rows]
+    user_ids = [row[3] for row in rows]
+    scanned_at = [datetime.fromtimestamp(row[4], timezone.utc) for row in rows]
+
+    # Check-ins for departments removed from the alarm meanwhile are dropped
+    db.sql_exec("""
+        INSERT INTO attendance (alarm_id, user_id, department_id, attended_at, is_attending)
+        SELECT c.alarm_id, c.user_id, c.department_id, c.scanned_at, TRUE
+        FROM unnest(%s::uuid[], %s::int[], %s::text[], %s::timestamptz[])
+            AS c(alarm_id, department_id, user_id, scanned_at)
+        JOIN alarm_departments ad ON ad.alarm_id = c.alarm_id AND ad.department_id = c.department_id
+        ON CONFLICT (alarm_id, department_id, user_id)
+        DO UPDATE SET
+            attended_at = EXCLUDED.attended_at,
+            eta = NULL,
+            is_attending = TRUE
+    """, alarm_ids, department_ids, user_ids, scanned_at)
+
+def _finish(rows):
+    now = time.time()
+    _connect().executemany("""
+        UPDATE checkins SET status = 'done', finished_at = ? WHERE id = ?
+    """, [(now, row[0]) for row in rows])
+
+def _retry(rows, error):
+    now = time.time()
+    conn = _connect()
+    for row in rows:
+        attempts = row[5] + 1
+        if attempts >= MAX_ATTEMPTS:
+            conn.execute("""
+                UPDATE checkins SET status = 'failed', finished_at = ?, last_error = ? WHERE id = ?
+            """, (now, error, row[0]))
+            print(f"Check-in journal: giving up on check-in {row[0]} after {attempts} attempts: {error}")
+            continue
+        # A newer scan may be waiting already; it supersedes this one
+        conn.execute("""
+            UPDATE checkins SET status = 'superseded', finished_at = ?, last_error = ?
+            WHERE id = ? AND EXISTS (""" + _NEWER_PENDING + """)
+        """, (now, error, row[0]))
+        conn.execute("""
+            UPDATE checkins SET status = 'pending', next_attempt_at = ?, last_error = ?
+            WHERE id = ? AND status = 'processing'
+        """, (now + min(2 ** attempts, MAX_BACKOFF), error, row[0]))
+
+def flush_once():
+    """Write one batch of check-ins. Returns False when nothing was due."""
+    rows = _claim_batch()
+    if not rows:
+        return False
+    try:
+        _write_attendance(rows)
+        written = rows
+    except Exception as e:
+        traceback.print_exc()
+        if len(rows) == 1:
+            _retry(rows, str(e))
+            return False
+        # Write the check-ins one at a time so one bad row (say, a deleted user)
+        # doesn't hold back the rest of the crew
+        written = []
+        for row in rows:
+            try:
+                _write_attendance([row])
+                written.append(row)
+            except Exception as row_error:
+                print(f"Check-in journal: check-in {row[0]} failed: {row_error}")
+                _retry([row], str(row_error))
+        if not written:
+            return False
+    _finish(written)
+    for alarm_id in {row[1] for row in written}:
+        snapshots.invalidate(alarm_id)
+    return True
+
+def _purge_done():
+    _connect().execute("""
+        DELETE FROM checkins WHERE status IN ('done', 'superseded') AND finished_at < ?
+    """, (time.time() - KEEP_DONE_SECONDS,))
+
+def _run_worker():
+    last_purge = 0
+    while True:
+        try:
+            if _index_loaded_at is None or time.monotonic() - _index_loaded_at > INDEX_REFRESH:
+                refresh_index()
+        except Exception as e:
+            print(f"Check-in index refresh failed: {e}")
+        try:
+            while flush_once():
+                pass
+            if time.time() - last_purge > 3600:
+                _purge_done()
+                last_purge = time.time()
+        except Exception as e:
+            # Journal busy or broken - back off and try again
+            print(f"Check-in journal worker error: {e}")
+            time.sleep(5)
+        # Sleep until a scan arrives, a retry becomes due or the index is old
+        _wakeup.wait(timeout=1)
+        _wakeup.clear()
+
+def start():
+    """Load the index and start the background flusher (once per process)"""
+    global _worker
+    try:
+        refresh_index()
+    except Exception as e:
+        print(f"Check-in index not loaded: {e}")
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run_worker, name='checkin-flusher', daemon=True)
+            _worker.start()
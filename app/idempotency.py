@@ -0,0 +1,127 @@
+"""Idempotency-Key handling for attendance and response posts
+
+Members often answer from a fire truck on poor coverage and the client retries
+failed posts. Every user action gets its own key, sent as an Idempotency-Key
+header with each retry. The first request with a key claims it in
+idempotency_keys (migrations/009) and stores its response; a replay gets the
+stored response without running the endpoint again, so a late retry can't
+overwrite a newer ETA. Recent responses are also kept in a bounded in-process
+cache, so most replays don't need the database at all.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, session, jsonify, make_response
+from psycopg.types.json import Jsonb
+from . import db
+
+HEADER = 'Idempotency-Key'
+
+# Recent responses kept in memory per process
+MAX_CACHED = 5000
+
+# A claim without a stored response is taken over after this many seconds (request crashed)
+CLAIM_TIMEOUT = 30
+
+# Keys are forgotten after this long
+KEEP_SECONDS = 24 * 3600
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_last_purge = 0.0
+
+def _remember(cache_key, endpoint, status_code, body):
+    with _lock:
+        _cache[cache_key] = (endpoint, status_code, body)
+        _cache.move_to_end(cache_key)
+        while len(_cache) > MAX_CACHED:
+            _cache.popitem(last=False)
+
+def _replay(endpoint, stored_endpoint, status_code, body):
+    """Response for a repeated key"""
+    if stored_endpoint != endpoint:
+        return jsonify({'error': f'{HEADER} already used for another request'}), 422
+    response = make_response(jsonify(body), status_code)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def _claim(user_id, key, endpoint):
+    """Claim a key; returns None when claimed, else the stored (endpoint, status, body)"""
+    row = db.sql_one("""
+        WITH claim AS (
+            INSERT INTO idempotency_keys (user_id, key, endpoint)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (user_id, key) DO UPDATE
+                SET endpoint = EXCLUDED.endpoint, created_at = now()
+                WHERE idempotency_keys.response IS NULL
+                AND idempotency_keys.created_at < now() - make_interval(secs => %s)
+            RETURNING 1
+        )
+        SELECT EXISTS (SELECT 1 FROM claim), k.endpoint, k.status_code, k.response
+        FROM (SELECT 1) one
+        LEFT JOIN idempotency_keys k ON k.user_id = %s AND k.key = %s
+    """, user_id, key, endpoint, CLAIM_TIMEOUT, user_id, key)
+    if row[0]:
+        return None
+    return row[1], row[2], row[3]
+
+def _purge():
+    global _last_purge
+    if time.monotonic() - _last_purge < 3600:
+        return
+    _last_purge = time.monotonic()
+    db.sql_exec("""
+        DELETE FROM idempotency_keys WHERE created_at < now() - make_interval(secs => %s)
+    """, KEEP_SECONDS)
+
+def idempotent(view):
+    """Replay the stored response when a request repeats its Idempotency-Key"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(HEADER, '').strip()
+        user_id = session.get('user_id')
+        if not key or not user_id:
+            return view(*args, **kwargs)
+        if len(key) > 200:
+            return jsonify({'error': f'{HEADER} is too long'}), 400
+
+        endpoint = request.path
+        cache_key = (user_id, key)
+        with _lock:
+            cached = _cache.get(cache_key)
+        if cached:
+            return _replay(endpoint, *cached)
+
+        stored = _claim(user_id, key, endpoint)
+        if stored is not None:
+            stored_endpoint, status_code, body = stored
+            if status_code is None:
+                # The first request with this key is still running
+                response = make_response(jsonify({'error': 'Request already in progress'}), 409)
+                response.headers['Retry-After'] = '2'
+                return response
+            _remember(cache_key, stored_endpoint, status_code, body)
+            return _replay(endpoint, stored_endpoint, status_code, body)
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            # Let a retry run the request again
+            db.sql_exec("DELETE FROM idempotency_keys WHERE user_id = %s AND key = %s", user_id, key)
+            raise
+
+        body = response.get_json(silent=True)
+        if response.status_code >= 500 or body is None:
+            db.sql_exec("DELETE FROM idempotency_keys WHERE user_id = %s AND key = %s", user_id, key)
+            return response
+
+        db.sql_exec("""
+            UPDATE idempotency_keys SET status_code = %s, response = %s
+            WHERE user_id = %s AND key = %s
+        """, response.status_code, Jsonb(body), user_id, key)
+        _remember(cache_key, endpoint, response.status_code, body)
+        _purge()
+        return response
+    return wrapper
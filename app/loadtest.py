@@ -0,0 +1,464 @@
+"""Alarm-storm load test against a local dev server and Postgres
+
+Usage:
+    python -m app.loadtest --setup                 # create load-test departments and members (once)
+    python -m app.loadtest                         # run the scenario against http://localhost:8000
+    python -m app.loadtest --members 300 --kiosks 10 --duration 180 --speed 2
+    python -m app.loadtest --cleanup               # remove load-test users, departments and alarms
+
+Scenario: one SMS naming DEPARTMENTS departments arrives at /sms-webhook.
+Members open the app over --ramp seconds, log in, load /home and poll
+/api/active-alarms at the interval the server recommends. Most of them answer
+with an ETA on /attendance/<alarm>/<dept> and report on site when the ETA has
+passed. Kiosks open /display/<alarm> and poll /api/attendance and
+/api/responses. --speed compresses all waits, e.g. --speed 4 runs a four
+minute incident in one minute.
+
+Reports p50/p95/p99 and error rate per endpoint, how long the SMS took to
+show up for members, and connection use sampled from pg_stat_activity
+against the app's pool size. Load-test data uses the department codes
+LT01..LTnn and user ids from --first-user-id, and is never mixed with real
+users: --setup refuses ids that belong to someone else.
+"""
+
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import defaultdict
+
+DEPARTMENTS = 8
+PASSWORD = 'loadtest'
+LAST_NAME = 'Loadtest'
+
+# Must match max_size in db.init_db
+POOL_SIZE = 10
+
+# Share of members that answer, and the ETAs (minutes) they pick
+RESPONSE_RATE = 0.7
+ETA_CHOICES = [0, 3, 5, 5, 8, 10, 15]
+
+def department_codes(count):
+    return [f"LT{n:02d}" for n in range(1, count + 1)]
+
+def scenario_sms(run_id, codes):
+    """The scenario SMS, in the "Klass:" format of the real alarms in
+    sms/corpus/messages.json (klass_who_called_automatlarm). The run id goes
+    in the free text so members can tell the alarm apart; nothing in it may
+    match an alarm kind pattern, or the alarm is parsed as practice or test."""
+    return (f"Storgatan 12, Lastby; Klass: Stor Larm - Byggnadsbrand. "
+            f"Övrig information Rök från vindsvåning, referens {run_id}.; {', '.join(codes)}")
+
+def user_ids(first, count):
+    return [f"{first + n:04d}" for n in range(count)]
+
+# --- Database setup ----------------------------------------------------------
+
+def _connect(database_url):
+    import psycopg
+    return psycopg.connect(database_url, autocommit=True)
+
+def setup(database_url, members, departments, first_user_id):
+    """Create load-test departments (with SMS patterns) and members spread over them"""
+    codes = department_codes(departments)
+    ids = user_ids(first_user_id, members)
+    with _connect(database_url) as conn:
+        taken = conn.execute("""
+            SELECT id FROM users WHERE id = ANY(%s) AND last_name IS DISTINCT FROM %s
+        """, (ids, LAST_NAME)).fetchall()
+        if taken:
+            print(f"User ids already in use by real users: {', '.join(row[0] for row in taken[:10])} - "
+                  f"choose another --first-user-id")
+            return 1
+
+        conn.execute("""
+            INSERT INTO departments (code, name)
+            SELECT code, 'Loadtest ' || code FROM unnest(%s::text[]) AS code
+            ON CONFLICT (code) DO NOTHING
+        """, (codes,))
+        department_ids = dict(conn.execute(
+            "SELECT code, id FROM departments WHERE code = ANY(%s)", (codes,)).fetchall())
+
+        # The scenario alarm must be parsed as a real one, whatever patterns admins added
+        content = scenario_sms('00000000', codes)
+        kind = next((kind for kind, pattern in conn.execute("""
+            SELECT kind::text, pattern FROM sms_alarm_kind_patterns ORDER BY position, kind, id
+        """).fetchall() if pattern in content), 'real')
+        if kind != 'real':
+            print(f"The scenario SMS would be parsed as '{kind}' by sms_alarm_kind_patterns: {content}")
+            return 1
+
+        conn.execute("""
+            INSERT INTO sms_department_patterns (department_id, pattern)
+            SELECT id, code FROM departments WHERE code = ANY(%s)
+            ON CONFLICT (department_id, pattern) DO NOTHING
+        """, (codes,))
+
+        conn.execute("""
+            INSERT INTO users (id, password, first_name, last_name)
+            SELECT id, %s, 'M' || id, %s FROM unnest(%s::text[]) AS id
+            ON CONFLICT (id) DO NOTHING
+        """, (PASSWORD, LAST_NAME, ids))
+
+        # Round-robin membership, with a tenth of the members in two departments
+        memberships = []
+        for n, user_id in enumerate(ids):
+            memberships.append((user_id, department_ids[codes[n % len(codes)]], n))
+            if n % 10 == 0:
+                memberships.append((user_id, department_ids[codes[(n + 1) % len(codes)]], n))
+        conn.execute("""
+            INSERT INTO user_departments (user_id, department_id, number)
+            SELECT user_id, department_id, number % 1000
+            FROM unnest(%s::text[], %s::int[], %s::int[]) AS m(user_id, department_id, number)
+            ON CONFLICT (user_id, department_id) DO NOTHING
+        """, ([m[0] for m in memberships], [m[1] for m in memberships], [m[2] for m in memberships]))
+
+    print(f"Load-test data ready: {len(codes)} departments ({codes[0]}..{codes[-1]}), "
+          f"{len(ids)} members ({ids[0]}..{ids[-1]}), password '{PASSWORD}'")
+    print("Running servers pick up the new SMS patterns within their reload interval")
+    return 0
+
+def cleanup(database_url, departments):
+    """Remove load-test alarms, members and departments"""
+    codes = department_codes(departments)
+    with _connect(database_url) as conn:
+        conn.execute("""
+            DELETE FROM alarms WHERE id IN (
+                SELECT ad.alarm_id FROM alarm_departments ad
+                JOIN departments d ON d.id = ad.department_id
+                WHERE d.code = ANY(%s)
+            )
+        """, (codes,))
+        users = conn.execute("DELETE FROM users WHERE last_name = %s", (LAST_NAME,)).rowcount
+        conn.execute("DELETE FROM departments WHERE code = ANY(%s)", (codes,))
+    print(f"Removed {users} load-test users and departments {codes[0]}..{codes[-1]}")
+    return 0
+
+class PoolSampler:
+    """Samples the app's connections from pg_stat_activity once per second"""
+
+    def __init__(self, database_url):
+        self.database_url = database_url
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+
+    def _run(self):
+        try:
+            conn = _connect(self.database_url)
+        except Exception as e:
+            print(f"Pool sampling disabled: {e}")
+            return
+        with conn:
+            while not self._stop.wait(1):
+                row = conn.execute("""
+                    SELECT COUNT(*),
+                           COUNT(*) FILTER (WHERE state = 'active'),
+                           COUNT(*) FILTER (WHERE state = 'idle in transaction'),
+                           COUNT(*) FILTER (WHERE wait_event_type = 'Lock')
+                    FROM pg_stat_activity
+                    WHERE datname = current_database() AND pid <> pg_backend_pid()
+                      AND backend_type = 'client backend'
+                """).fetchone()
+                self.samples.append(row)
+
+# --- HTTP clients ------------------------------------------------------------
+
+class Stats:
+    """Latency and status per endpoint"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        # Setup problems (bad credentials, missing --setup), kept apart from endpoint errors
+        self.logins = 0
+        self.login_failures = 0
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def record_login(self, ok):
+        with self.lock:
+            self.logins += 1
+            if not ok:
+                self.login_failures += 1
+
+class Client:
+    """One browser session (cookie jar) against the server"""
+
+    def __init__(self, base_url, stats, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.stats = stats
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        # URL of the last response, after redirects
+        self.last_url = None
+
+    def request(self, endpoint, path, data=None, json_body=None):
+        """Send a request, record it under endpoint, return (status, headers, body)"""
+        headers = {}
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode('utf-8')
+        request = urllib.request.Request(self.base_url + path, data=body, headers=headers)
+
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                status, response_headers, content = response.status, response.headers, response.read()
+                self.last_url = response.geturl()
+        except urllib.error.HTTPError as e:
+            status, response_headers, content = e.code, e.headers, e.read()
+        except Exception:
+            self.stats.record(endpoint, time.perf_counter() - start, False)
+            return None, {}, b''
+        self.stats.record(endpoint, time.perf_counter() - start, status < 400)
+        return status, response_headers, content
+
+    def json(self, endpoint, path):
+        status, headers, content = self.request(endpoint, path)
+        try:
+            return status, headers, json.loads(content) if status == 200 else None
+        except ValueError:
+            return status, headers, None
+
+    def login(self, user_id):
+        """Log in; only the redirect to /home counts, as bad credentials render login.html with 200"""
+        status, _, _ = self.request('POST /auth/login', '/auth/login', data={'id': user_id, 'password': PASSWORD})
+        ok = status == 200 and urllib.parse.urlparse(self.last_url or '').path == '/home'
+        self.stats.record_login(ok)
+        return ok
+
+# --- Scenario ----------------------------------------------------------------
+
+class Scenario:
+    def __init__(self, args, stats):
+        self.args = args
+        self.stats = stats
+        self.run_id = uuid.uuid4().hex[:8]
+        self.started = None
+        self.deadline = None
+        self.alarm_id = None
+        self.alarm_kind = None
+        self.alarm_seen = threading.Event()
+        self.alarm_visible_after = None
+        self.departments_seen = set()
+        self.lock = threading.Lock()
+
+    def sleep(self, seconds):
+        """Wait scenario seconds (compressed by --speed), return False once the run is over"""
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(seconds / self.args.speed, remaining))
+        return time.time() < self.deadline
+
+    def send_sms(self):
+        content = scenario_sms(self.run_id, department_codes(self.args.departments))
+        client = Client(self.args.url, self.stats, self.args.timeout)
+        status, _, body = client.request('POST /sms-webhook', '/sms-webhook', json_body={
+            'content': content,
+            'sender': 'loadtest',
+            'mid': f"loadtest-{self.run_id}",
+            'timestamp': int(time.time())
+        })
+        print(f"SMS sent ({status}): {body.decode('utf-8', 'replace')[:120]}")
+
+    def find_alarm(self, data):
+        """Pick the scenario alarm out of an /api/active-alarms response"""
+        for alarm in (data or {}).get('alarms', []):
+            if self.run_id in (alarm.get('what') or '') or self.run_id in (alarm.get('description') or ''):
+                with self.lock:
+                    self.departments_seen.add(alarm['department_id'])
+                    if self.alarm_id is None:
+                        self.alarm_id = alarm['id']
+                        self.alarm_kind = alarm.get('kind')
+                        self.alarm_visible_after = time.time() - self.started
+                        self.alarm_seen.set()
+                yield alarm
+
+    def member(self, user_id):
+        client = Client(self.args.url, self.stats, self.args.timeout)
+        # Members pick up their phones over the ramp period
+        if not self.sleep(random.uniform(0, self.args.ramp)) or not client.login(user_id):
+            return
+        client.request('GET /home', '/home')
+
+        responded = set()
+        arrive_at = {}
+        will_respond = random.random() < RESPONSE_RATE
+        while True:
+            status, headers, data = client.json('GET /api/active-alarms', '/api/active-alarms')
+            for alarm in self.find_alarm(data):
+                key = (alarm['id'], alarm['department_id'])
+                if will_respond and key not in responded and not alarm.get('is_attended'):
+                    responded.add(key)
+                    # Reading the SMS and deciding takes a moment
+                    if not self.sleep(random.uniform(5, 30)):
+                        return
+                    eta = random.choice(ETA_CHOICES)
+                    client.request('POST /attendance', f"/attendance/{alarm['id']}/{alarm['department_id']}",
+                                   data={'arrival_time': eta})
+                    if eta:
+                        arrive_at[key] = time.time() + eta * 60 / self.args.speed
+            # On site once the ETA has passed
+            for key, at in list(arrive_at.items()):
+                if time.time() >= at:
+                    client.request('POST /attendance', f"/attendance/{key[0]}/{key[1]}", data={'arrival_time': 0})
+                    del arrive_at[key]
+
+            interval = (data or {}).get('poll_interval') or int((headers or {}).get('X-Poll-Interval', 10))
+            if not self.sleep(interval):
+                return
+
+    def kiosk(self, user_id):
+        client = Client(self.args.url, self.stats, self.args.timeout)
+        if not client.login(user_id):
+            return
+        while not self.alarm_seen.wait(0.5):
+            if time.time() >= self.deadline:
+                return
+        # Kiosks are switched to the alarm shortly after it comes in
+        if not self.sleep(random.uniform(0, 20)):
+            return
+        client.request('GET /display', f"/display/{self.alarm_id}")
+        while True:
+            status, headers, data = client.json('GET /api/attendance', f"/api/attendance/{self.alarm_id}")
+            client.request('GET /api/responses', f"/api/responses/{self.alarm_id}")
+            interval = (data or {}).get('poll_interval') or int((headers or {}).get('X-Poll-Interval', 5))
+            if not self.sleep(interval):
+                return
+
+    def run(self):
+        ids = user_ids(self.args.first_user_id, self.args.members)
+        self.started = time.time()
+        self.deadline = self.started + self.args.duration
+
+        self.send_sms()
+        threads = [threading.Thread(target=self.member, args=(user_id,), daemon=True) for user_id in ids]
+        # Kiosks are logged in as members of different departments
+        threads += [threading.Thread(target=self.kiosk, args=(ids[n % len(ids)],), daemon=True)
+                    for n in range(self.args.kiosks)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=max(0, self.deadline - time.time()) + self.args.timeout)
+
+# --- Report ------------------------------------------------------------------
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def report(scenario, stats, sampler, elapsed):
+    print(f"\nRun {scenario.run_id}: {elapsed:.0f}s, {scenario.args.members} members, "
+          f"{scenario.args.kiosks} kiosks, speed x{scenario.args.speed}")
+    if scenario.alarm_id:
+        print(f"Alarm {scenario.alarm_id} visible to members after {scenario.alarm_visible_after:.1f}s "
+              f"in {len(scenario.departments_seen)}/{scenario.args.departments} departments")
+        if scenario.alarm_kind != 'real':
+            print(f"✗ The alarm was parsed as '{scenario.alarm_kind}', not 'real' - "
+                  f"check sms_alarm_kind_patterns against the scenario SMS")
+    else:
+        print("✗ The SMS alarm never showed up in /api/active-alarms")
+
+    print(f"\n{'endpoint':<26} {'requests':>9} {'req/s':>7} {'errors':>7} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    total = errors = 0
+    for endpoint in sorted(stats.latencies):
+        latencies = sorted(stats.latencies[endpoint])
+        total += len(latencies)
+        errors += stats.errors[endpoint]
+        print(f"{endpoint:<26} {len(latencies):>9} {len(latencies) / elapsed:>7.1f} "
+              f"{stats.errors[endpoint] / len(latencies):>7.1%} "
+              + ' '.join(f"{percentile(latencies, f) * 1000:>8.1f}" for f in (0.5, 0.95, 0.99, 1.0)))
+    print(f"{'total':<26} {total:>9} {total / elapsed:>7.1f} {errors / max(total, 1):>7.1%}")
+    if stats.login_failures:
+        print(f"\n✗ {stats.login_failures} of {stats.logins} logins failed (not counted above) - "
+              f"run --setup, or check --first-user-id and --members")
+
+    if sampler and sampler.samples:
+        connections = [s[0] for s in sampler.samples]
+        active = [s[1] for s in sampler.samples]
+        print(f"\nDB connections (pg_stat_activity, pool size {scenario.args.pool_size} per process): "
+              f"peak {max(connections)}, peak active {max(active)}, "
+              f"mean active {sum(active) / len(active):.1f}, "
+              f"saturated {sum(1 for a in active if a >= scenario.args.pool_size) / len(active):.0%} of samples, "
+              f"peak idle in transaction {max(s[2] for s in sampler.samples)}, "
+              f"peak lock waits {max(s[3] for s in sampler.samples)}")
+    real = scenario.alarm_id and scenario.alarm_kind == 'real'
+    return 0 if real and not errors and not stats.login_failures else 1
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Alarm-storm load test')
+    arg_parser.add_argument('--url', default='http://localhost:8000', help='server to test')
+    arg_parser.add_argument('--database-url', default=os.getenv('DATABASE_URL'),
+                            help='database for --setup/--cleanup and pool sampling (default $DATABASE_URL)')
+    arg_parser.add_argument('--setup', action='store_true', help='create load-test departments and members')
+    arg_parser.add_argument('--cleanup', action='store_true', help='remove load-test data')
+    arg_parser.add_argument('--members', type=int, default=300)
+    arg_parser.add_argument('--kiosks', type=int, default=10)
+    arg_parser.add_argument('--departments', type=int, default=DEPARTMENTS)
+    arg_parser.add_argument('--first-user-id', type=int, default=7000)
+    arg_parser.add_argument('--duration', type=float, default=300, help='scenario length in seconds')
+    arg_parser.add_argument('--ramp', type=float, default=90, help='seconds over which members open the app')
+    arg_parser.add_argument('--speed', type=float, default=1.0, help='compress all waits by this factor')
+    arg_parser.add_argument('--timeout', type=float, default=30, help='HTTP timeout in seconds')
+    arg_parser.add_argument('--pool-size', type=int, default=POOL_SIZE)
+    arg_parser.add_argument('--seed', type=int, help='random seed for a repeatable scenario')
+    args = arg_parser.parse_args(argv)
+
+    if args.setup or args.cleanup:
+        if not args.database_url:
+            print("--setup/--cleanup need --database-url or DATABASE_URL")
+            return 1
+        if args.setup:
+            return setup(args.database_url, args.members, args.departments, args.first_user_id)
+        return cleanup(args.database_url, args.departments)
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    stats = Stats()
+    scenario = Scenario(args, stats)
+    sampler = PoolSampler(args.database_url) if args.database_url else None
+    if sampler:
+        sampler.start()
+    start = time.time()
+    try:
+        scenario.run()
+    except KeyboardInterrupt:
+        print("Interrupted")
+    finally:
+        if sampler:
+            sampler.stop()
+    return report(scenario, stats, sampler, time.time() - start)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""Recommended client poll intervals for the live alarm views"""
+
+from datetime import datetime, timezone
+from . import db
+
+# Response header carrying the recommended interval (seconds)
+POLL_INTERVAL_HEADER = 'X-Poll-Interval'
+
+# Alarm age (seconds) -> poll interval (seconds)
+# Fast during the first 15 minutes, then backing off to minutes for stale alarms
+AGE_STEPS = [
+    (15 * 60, 5),
+    (60 * 60, 15),
+    (6 * 60 * 60, 60),
+]
+STALE_INTERVAL = 120
+
+# The active alarm list is how members discover a new callout, which can come at any
+# time - it never backs off, whatever the age of the alarms shown or the pool pressure
+DISCOVERY_INTERVAL = 10
+
+# Anything changed within this many seconds keeps clients on the fast interval
+RECENT_CHANGE_WINDOW = 120
+
+def _as_utc(value):
+    """Treat naive datetimes as UTC"""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+def _pool_is_busy():
+    """True when requests are waiting for a database connection"""
+    if not db.pool:
+        return False
+    try:
+        stats = db.pool.get_stats()
+    except Exception:
+        return False
+    return stats.get('requests_waiting', 0) > 0 or (
+        stats.get('pool_available', 0) == 0 and stats.get('pool_size', 0) >= db.pool.max_size
+    )
+
+def recommend_poll_interval(occurred_at, last_change_at=None, minimum=5, maximum=STALE_INTERVAL):
+    """Return the recommended seconds until the next poll.
+
+    Based on alarm age, time since the last attendance/response change and
+    current database pool pressure. The result is clamped to [minimum, maximum].
+    """
+    now = datetime.now(timezone.utc)
+
+    if occurred_at is None:
+        interval = maximum
+    else:
+        age = (now - _as_utc(occurred_at)).total_seconds()
+        interval = STALE_INTERVAL
+        for max_age, step_interval in AGE_STEPS:
+            if age < max_age:
+                interval = step_interval
+                break
+
+    # Someone just responded - people are still on their way, keep it snappy
+    if last_change_at is not None:
+        if (now - _as_utc(last_change_at)).total_seconds() < RECENT_CHANGE_WINDOW:
+            interval = min(interval, AGE_STEPS[0][1])
+
+    # Back off when the connection pool is saturated
+    if _pool_is_busy():
+        interval *= 2
+
+    return int(max(minimum, min(interval, maximum)))
+
+def with_poll_interval(response, interval):
+    """Attach the recommended poll interval header to a response"""
+    response.headers[POLL_INTERVAL_HEADER] = str(interval)
+    return response
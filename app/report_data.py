@@ -0,0 +1,193 @@
+"""Alarm report model for one alarm and department
+
+Everything a report shows - the alarm, the department's status, the report
+comment, rapportförfattare, enhetschef (who was 07) and the crew per car with
+mantimmar - is gathered in two queries: one row for the header and one row per
+car with its crew aggregated in SQL. The PDF export and the alarm detail page
+both read it, and other export formats can too.
+"""
+
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional, Union
+from . import db
+
+@dataclass
+class Person:
+    """Someone named on a report, by user or free text"""
+    first_name: str
+    last_name: str
+    # Department number; text when parsed from a free-text name
+    number: Optional[Union[int, str]] = None
+    user_id: Optional[str] = None
+
+    @property
+    def display(self):
+        """'First Last (number)', as written on the report"""
+        name = f"{self.first_name} {self.last_name}".strip()
+        return f"{name} ({self.number})" if self.number not in (None, '') else name
+
+    @classmethod
+    def parse(cls, text):
+        """Parse a free-text name stored as "First Last (number)" or just "First Last" """
+        number = None
+        name_parts = text.split(' (')
+        if len(name_parts) == 2:
+            number = name_parts[1].rstrip(')')
+            text = name_parts[0]
+        name_parts = text.split(' ', 1)
+        return cls(first_name=name_parts[0] if len(name_parts) > 0 else '',
+                   last_name=name_parts[1] if len(name_parts) > 1 else '',
+                   number=number)
+
+@dataclass
+class CrewMember:
+    user_id: str
+    first_name: str
+    last_name: str
+    number: Optional[int]
+    mantimmar_insats: Optional[float]
+    mantimmar_bevakning: Optional[float]
+    mantimmar_aterstallning: Optional[float]
+    anvant_aa_rokdykning: Optional[str]
+    anvant_aa_sjalvskydd: Optional[str]
+
+@dataclass
+class Car:
+    car_code: str
+    crew: list
+
+@dataclass
+class Totals:
+    insats: float = 0.0
+    bevakning: float = 0.0
+    aterstallning: float = 0.0
+    aa_rokdykning: int = 0
+    aa_sjalvskydd: int = 0
+
+@dataclass
+class Report:
+    alarm_id: str
+    kind: str
+    description: str
+    occurred_at: Optional[datetime]
+    source: str
+    alarm_type: str
+    what: str
+    where_location: str
+    who_called: str
+    department_id: int
+    department_code: Optional[str]
+    department_name: Optional[str]
+    # False when the department isn't dispatched to the alarm
+    in_alarm: bool
+    ended_at: Optional[datetime]
+    beskrivning: str
+    larmtyp: str
+    raddningsledare: str
+    rapportforfattare_user_id: str
+    rapportforfattare_name: str
+    email: str
+    rapportforfattare: Optional[Person]
+    enhetschef: Optional[Person]
+    cars: list = field(default_factory=list)
+
+    @property
+    def totals(self):
+        """Mantimmar and breathing apparatus use summed over all cars"""
+        totals = Totals()
+        for car in self.cars:
+            for member in car.crew:
+                totals.insats += member.mantimmar_insats or 0.0
+                totals.bevakning += member.mantimmar_bevakning or 0.0
+                totals.aterstallning += member.mantimmar_aterstallning or 0.0
+                totals.aa_rokdykning += member.anvant_aa_rokdykning == 'Ja'
+                totals.aa_sjalvskydd += member.anvant_aa_sjalvskydd == 'Ja'
+        return totals
+
+def _float(value):
+    return float(value) if value else None
+
+def load(alarm_id, department_id, include_cars=True):
+    """Report for an alarm and department, or None when the alarm doesn't exist"""
+    department_id = int(department_id)
+    row = db.sql_one("""
+        SELECT a.id, a.kind, a.description, a.occurred_at, a.source,
+               a.alarm_type, a.what, a.where_location, a.who_called,
+               d.code, d.name, ad.department_id IS NOT NULL, ad.ended_at,
+               ac.comment, ac.larmtyp, ac.raddningsledare,
+               ac.rapportforfattare_user_id, ac.rapportforfattare_name, ac.email,
+               ru.first_name, ru.last_name, rud.number,
+               w.user_id, w.name, wu.first_name, wu.last_name, wud.number
+        FROM alarms a
+        LEFT JOIN departments d ON d.id = %s
+        LEFT JOIN alarm_departments ad ON ad.alarm_id = a.id AND ad.department_id = d.id
+        LEFT JOIN alarm_comments ac ON ac.alarm_id = a.id AND ac.department_id = d.id
+        LEFT JOIN users ru ON ru.id = ac.rapportforfattare_user_id
+        LEFT JOIN user_departments rud ON rud.user_id = ru.id AND rud.department_id = d.id
+        LEFT JOIN alarm_who_was_07 w ON w.alarm_id = a.id AND w.department_id = d.id
+        LEFT JOIN users wu ON wu.id = w.user_id
+        LEFT JOIN user_departments wud ON wud.user_id = wu.id AND wud.department_id = d.id
+        WHERE a.id = %s
+    """, department_id, alarm_id)
+    if not row:
+        return None
+
+    # Rapportförfattare is a user when picked from the list, else the typed name
+    rapportforfattare = None
+    if row[19] is not None:
+        rapportforfattare = Person(row[19], row[20], row[21], row[16])
+    elif row[17]:
+        rapportforfattare = Person.parse(row[17])
+
+    # A 07 whose user has been deleted is left out, as before
+    enhetschef = None
+    if row[22]:
+        if row[24] is not None:
+            enhetschef = Person(row[24], row[25], row[26], row[22])
+    elif row[23]:
+        enhetschef = Person.parse(row[23])
+
+    report = Report(
+        alarm_id=str(row[0]), kind=row[1], description=row[2], occurred_at=row[3],
+        source=row[4], alarm_type=row[5], what=row[6], where_location=row[7],
+        who_called=row[8], department_id=department_id, department_code=row[9],
+        department_name=row[10], in_alarm=row[11], ended_at=row[12],
+        beskrivning=row[13] or '', larmtyp=row[14] or '', raddningsledare=row[15] or '',
+        rapportforfattare_user_id=row[16] or '', rapportforfattare_name=row[17] or '',
+        email=row[18] or '', rapportforfattare=rapportforfattare, enhetschef=enhetschef)
+
+    if include_cars:
+        # One row per car, crew ordered by department number
+        for car_code, crew in db.sql_all("""
+            SELECT ua.car_code,
+                   json_agg(json_build_object(
+                       'user_id', ua.user_id, 'first_name', u.first_name, 'last_name', u.last_name,
+                       'number', ud.number,
+                       'mantimmar_insats', ua.mantimmar_insats,
+                       'mantimmar_bevakning', ua.mantimmar_bevakning,
+                       'mantimmar_aterstallning', ua.mantimmar_aterstallning,
+                       'anvant_aa_rokdykning', ua.anvant_aa_rokdykning,
+                       'anvant_aa_sjalvskydd', ua.anvant_aa_sjalvskydd
+                   ) ORDER BY ud.number)
+            FROM alarm_user_car_assignments ua
+            JOIN users u ON ua.user_id = u.id
+            LEFT JOIN user_departments ud ON ua.user_id = ud.user_id AND ua.department_id = ud.department_id
+            WHERE ua.alarm_id = %s AND ua.department_id = %s
+            GROUP BY ua.car_code
+            ORDER BY ua.car_code
+        """, alarm_id, department_id):
+            report.cars.append(Car(car_code, [
+                CrewMember(
+                    user_id=member['user_id'],
+                    first_name=member['first_name'],
+                    last_name=member['last_name'],
+                    number=member['number'],
+                    mantimmar_insats=_float(member['mantimmar_insats']),
+                    mantimmar_bevakning=_float(member['mantimmar_bevakning']),
+                    mantimmar_aterstallning=_float(member['mantimmar_aterstallning']),
+                    anvant_aa_rokdykning=member['anvant_aa_rokdykning'] or None,
+                    anvant_aa_sjalvskydd=member['anvant_aa_sjalvskydd'] or None)
+                for member in crew]))
+
+    return report
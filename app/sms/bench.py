@@ -0,0 +1,104 @@
+"""SMS parser golden-corpus check and benchmark
+
+Usage:
+    python -m app.sms.bench                  # check golden outputs, then a quick benchmark
+    python -m app.sms.bench --update-golden  # regenerate golden outputs after an intended change
+
+The corpus (corpus/messages.json) holds anonymised messages in every
+supported format. Golden outputs (corpus/golden.json) are the expected
+parse_sms_alarm results for the example DEPARTMENT_PATTERNS in config.py.
+tests/test_sms_parser.py runs the same check and the benchmarks under pytest;
+throughput depends on the machine, so no numbers are kept in the repository.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from . import parser
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'corpus')
+MESSAGES_FILE = os.path.join(CORPUS_DIR, 'messages.json')
+GOLDEN_FILE = os.path.join(CORPUS_DIR, 'golden.json')
+
+BENCHMARKS = {
+    'parse_sms_alarm': parser.parse_sms_alarm_uncached,
+    'parse_sms_alarm_memoised': parser.parse_sms_alarm,
+    'detect_all_departments': parser.detect_all_departments,
+    'extract_department_codes_from_end': parser.extract_department_codes_from_end,
+}
+
+def load_messages():
+    """Load the named corpus messages"""
+    with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def load_golden():
+    """Load golden parse results keyed by message name"""
+    with open(GOLDEN_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def parse_corpus(messages):
+    """Parse every corpus message, keyed by name"""
+    return {message['name']: parser.parse_sms_alarm(message['content']) for message in messages}
+
+def check_golden(messages):
+    """Compare parse results with the golden file, return list of (name, expected, actual)"""
+    golden = load_golden()
+    mismatches = []
+    for name, actual in parse_corpus(messages).items():
+        expected = golden.get(name)
+        if expected != actual:
+            mismatches.append((name, expected, actual))
+    return mismatches
+
+def write_golden(messages):
+    """Regenerate the golden file from the current parser"""
+    with open(GOLDEN_FILE, 'w', encoding='utf-8') as f:
+        json.dump(parse_corpus(messages), f, ensure_ascii=False, indent=2)
+        f.write('\n')
+
+def measure(func, contents, min_seconds=1.0):
+    """Return messages/second for func over the corpus, running for at least min_seconds"""
+    processed = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_seconds:
+        for content in contents:
+            func(content)
+        processed += len(contents)
+        elapsed = time.perf_counter() - start
+    return processed / elapsed
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='SMS parser golden-corpus check and benchmark')
+    arg_parser.add_argument('--update-golden', action='store_true', help='regenerate golden outputs and exit')
+    arg_parser.add_argument('--seconds', type=float, default=1.0, help='minimum run time per benchmark')
+    args = arg_parser.parse_args(argv)
+
+    messages = load_messages()
+
+    if args.update_golden:
+        write_golden(messages)
+        print(f"Golden outputs written for {len(messages)} messages: {GOLDEN_FILE}")
+        return 0
+
+    mismatches = check_golden(messages)
+    for name, expected, actual in mismatches:
+        print(f"✗ {name}")
+        print(f"  expected: {json.dumps(expected, ensure_ascii=False)}")
+        print(f"  actual:   {json.dumps(actual, ensure_ascii=False)}")
+    if mismatches:
+        print(f"\n{len(mismatches)} of {len(messages)} corpus messages differ from golden outputs")
+        return 1
+    print(f"✓ {len(messages)} corpus messages match golden outputs")
+
+    contents = [message['content'] for message in messages]
+    for name, func in BENCHMARKS.items():
+        rate = measure(func, contents, args.seconds)
+        print(f"{name:<36} {rate:>12,.0f} msg/s")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
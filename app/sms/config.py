@@ -3,6 +3,8 @@
 # Department detection patterns
 # Configure these patterns to match your SMS alarm message format
 # Each department can have multiple patterns (vehicle codes, department codes, names)
+# Copied once into sms_department_patterns; after that they are edited under
+# Admin > SMS-mönster and these are only used when the database is unreachable
 DEPARTMENT_PATTERNS = {
     'DEPT01': ['A01', 'A02', 'A03', 'DEPT01', 'Station A'],
     'DEPT02': ['B01', 'B02', 'B03', 'DEPT02', 'Station B'],
@@ -12,7 +14,7 @@ DEPARTMENT_PATTERNS = {
     'RESCUE': ['RESCUE01', 'Rescue Team', 'Emergency Response']
 }
 
-# Alarm type detection patterns
+# Alarm type detection patterns (stored in sms_alarm_kind_patterns, see migrations/005)
 ALARM_TYPE_PATTERNS = {
     'practice': ['PROVALARM', 'Övning', 'test'],
     'test': ['test', 'TEST'],
@@ -0,0 +1,64 @@
+"""Idempotent SMS ingestion keyed on the gateway message id
+
+The gateway retries deliveries it thinks failed. Each message gets a dedup
+key (its mid, or a hash of content and timestamp), recent keys are kept in
+memory and every processed message is recorded in sms_messages together with
+the resulting alarm, so a retry returns the original result without
+touching alarms.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from psycopg.types.json import Jsonb
+from .. import db
+
+# Recent keys remembered in memory
+MAX_RECENT = 10000
+
+_recent = OrderedDict()
+_lock = threading.Lock()
+
+def message_key(mid, content, timestamp):
+    """Dedup key for a gateway message"""
+    if mid:
+        return f"mid:{mid}"
+    digest = hashlib.sha256(f"{content}\n{timestamp}".encode('utf-8')).hexdigest()
+    return f"sha256:{digest}"
+
+def remember(key, result):
+    """Remember the result for a key (bounded, least recently used dropped first)"""
+    with _lock:
+        _recent[key] = result
+        _recent.move_to_end(key)
+        while len(_recent) > MAX_RECENT:
+            _recent.popitem(last=False)
+
+def recall(key):
+    """Result remembered for a key in this process, or None"""
+    with _lock:
+        result = _recent.get(key)
+        if result is not None:
+            _recent.move_to_end(key)
+        return result
+
+def lookup_stored(key):
+    """Result recorded in sms_messages for a key, or None"""
+    row = db.sql_one("SELECT result FROM sms_messages WHERE dedup_key = %s", key)
+    return row[0] if row else None
+
+def store_message(key, payload, result):
+    """Record a processed message and its result (first writer wins)"""
+    timestamp = payload.get('timestamp')
+    sent_at = datetime.fromtimestamp(timestamp, tz=timezone.utc) if timestamp else None
+    alarm_id = result.get('alarm_id') if result.get('status') == 'success' else None
+
+    db.sql_exec("""
+        INSERT INTO sms_messages (dedup_key, mid, sender, recipient, content, sent_at, status, alarm_id, result)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (dedup_key) DO NOTHING
+    """, key, payload.get('mid') or None, payload.get('sender'), payload.get('recipient'),
+         payload['content'], sent_at, result['status'], alarm_id,
+         Jsonb(json.loads(json.dumps(result, default=str))))
@@ -1,91 +1,50 @@
 """SMS alarm handler for creating database records"""
 
+import uuid
 from datetime import datetime, timezone, timedelta
 from .. import db
+from . import patterns
+
+# Duplicate alarms are SMS for the same incident within this window
+DUPLICATE_WINDOW = timedelta(minutes=2)
+
+def _departments_for(alarm_data):
+    departments = alarm_data.get('all_departments', [])
+    if not departments and alarm_data.get('department_code'):
+        departments = [alarm_data['department_code']]
+    return departments
 
 def create_alarm_from_sms(alarm_data, timestamp):
-    """Create alarm record from SMS data or link to existing duplicate"""
+    """Create alarm record from SMS data or link to existing duplicate.
+
+    upsert_sms_alarm (migrations/005) finds an open alarm with the same
+    fingerprint (normalised what/where/type) within two minutes or creates one, and links every
+    department code, in one round trip under an advisory lock on the incident.
+    """
     
-    # Determine alarm kind using parser
-    from .parser import detect_alarm_kind
-    kind = detect_alarm_kind(alarm_data['raw_content'])
+    # Alarm kind is detected by the parser (and memoised with the rest of the parse)
+    kind = alarm_data['alarm_kind']
     
     occurred_at = datetime.fromtimestamp(timestamp, tz=timezone.utc)
     
-    # Check for existing duplicate alarm within a time window (2 minutes)
-    # Match on: what, where_location, alarm_type, and occurred_at within 2 minutes
-    time_window_start = occurred_at - timedelta(minutes=2)
-    time_window_end = occurred_at + timedelta(minutes=2)
-    
-    existing_alarm = db.sql_one("""
-        SELECT a.id
-        FROM alarms a
-        WHERE a.source = 'SMS'
-        AND (a.what IS NOT DISTINCT FROM %s)
-        AND (a.where_location IS NOT DISTINCT FROM %s)
-        AND (a.alarm_type IS NOT DISTINCT FROM %s)
-        AND a.occurred_at BETWEEN %s AND %s
-        AND a.ended_at IS NULL
-        ORDER BY a.occurred_at DESC
-        LIMIT 1
-    """, alarm_data.get('what'), alarm_data.get('where'), 
-         alarm_data.get('alarm_type'), time_window_start, time_window_end)
-    
-    if existing_alarm:
-        # Duplicate alarm found - add departments to existing alarm
-        alarm_id = existing_alarm[0]
-        departments = alarm_data.get('all_departments', [])
-        if not departments and alarm_data.get('department_code'):
-            departments = [alarm_data['department_code']]
-        
-        if not departments:
-            print(f"Warning: No departments found for duplicate alarm {alarm_id}")
-        
-        for dept_code in departments:
-            # Use case-insensitive lookup since database might have mixed case (LuFBK vs LUFBK)
-            dept = db.sql_one("SELECT id FROM departments WHERE UPPER(code) = UPPER(%s)", dept_code)
-            if dept:
-                # Use INSERT ... ON CONFLICT to avoid duplicate department assignments
-                db.sql_exec("""
-                    INSERT INTO alarm_departments (alarm_id, department_id)
-                    VALUES (%s, %s)
-                    ON CONFLICT (alarm_id, department_id) DO NOTHING
-                """, alarm_id, dept[0])
-            else:
-                print(f"Warning: Department {dept_code} not found")
-        
-        return alarm_id
-    else:
-        # No duplicate found - create new alarm
-        alarm_id = db.sql_one("""
-            INSERT INTO alarms (kind, description, occurred_at, source, alarm_type, what, where_location, who_called)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """, kind, alarm_data['description'], 
-             occurred_at, 'SMS',
-             alarm_data.get('alarm_type'), alarm_data.get('what'), 
-             alarm_data.get('where'), alarm_data.get('who_called'))
-        
-        # Assign to all departments mentioned in the SMS
-        departments = alarm_data.get('all_departments', [])
-        if not departments and alarm_data.get('department_code'):
-            departments = [alarm_data['department_code']]
-        
-        if not departments:
-            print(f"Warning: No departments found for alarm {alarm_id[0]}")
-        
-        for dept_code in departments:
-            # Use case-insensitive lookup since database might have mixed case (LuFBK vs LUFBK)
-            dept = db.sql_one("SELECT id FROM departments WHERE UPPER(code) = UPPER(%s)", dept_code)
-            if dept:
-                db.sql_exec("""
-                    INSERT INTO alarm_departments (alarm_id, department_id)
-                    VALUES (%s, %s)
-                """, alarm_id[0], dept[0])
-            else:
-                print(f"Warning: Department {dept_code} not found")
-        
-        return alarm_id[0]
+    # Assign to all departments mentioned in the SMS, by id from the loaded patterns
+    departments = _departments_for(alarm_data)
+    department_ids, unknown_codes = patterns.department_ids(departments)
+    
+    alarm_id, created = db.sql_one("""
+        SELECT id, created
+        FROM upsert_sms_alarm(%s::alarm_kind, %s, %s, %s, %s, %s, %s, %s::int[], %s)
+    """, kind, alarm_data['description'], occurred_at,
+         alarm_data.get('alarm_type'), alarm_data.get('what'),
+         alarm_data.get('where'), alarm_data.get('who_called'),
+         department_ids, DUPLICATE_WINDOW)
+    
+    if not departments:
+        print(f"Warning: No departments found for {'alarm' if created else 'duplicate alarm'} {alarm_id}")
+    for dept_code in unknown_codes:
+        print(f"Warning: Department {dept_code} not found")
+    
+    return alarm_id
 
 def process_sms_alarm(content, sender=None, timestamp=None):
     """Process incoming SMS alarm and create database record"""
@@ -121,3 +80,168 @@ def process_sms_alarm(content, sender=None, timestamp=None):
             'message': str(e),
             'parsed_data': alarm_data
         }
+
+def process_sms_batch(messages):
+    """Process a batch of gateway messages (backlog replay) in one transaction.
+
+    Messages are parsed in one pass, department codes are resolved from the
+    loaded patterns, duplicates within DUPLICATE_WINDOW are grouped in memory and
+    all alarms, alarm_departments and sms_messages rows are committed together.
+    Returns one result per message, in input order.
+    """
+    from .parser import parse_sms_alarm
+    from . import dedup
+    from psycopg.types.json import Jsonb
+    
+    results = [None] * len(messages)
+    entries = []
+    
+    for index, message in enumerate(messages):
+        content = (message.get('content') or '') if isinstance(message, dict) else ''
+        if not content:
+            results[index] = {'status': 'error', 'message': 'No content provided'}
+            continue
+        try:
+            timestamp = int(message.get('timestamp') or datetime.now().timestamp())
+        except (TypeError, ValueError):
+            results[index] = {'status': 'error', 'message': 'Invalid timestamp'}
+            continue
+        
+        key = dedup.message_key(message.get('mid'), content, timestamp)
+        previous = dedup.recall(key)
+        if previous is not None:
+            results[index] = dict(previous, duplicate=True)
+            continue
+        
+        entries.append({
+            'index': index,
+            'key': key,
+            'message': message,
+            'timestamp': timestamp,
+            'occurred_at': datetime.fromtimestamp(timestamp, tz=timezone.utc),
+            'alarm_data': parse_sms_alarm(content)
+        })
+    
+    if not entries:
+        return results
+    
+    with db.get_connection() as conn:
+        with conn.cursor() as cur:
+            # Messages already ingested earlier (single-message webhook or a previous replay)
+            cur.execute("SELECT dedup_key, result FROM sms_messages WHERE dedup_key = ANY(%s)",
+                        ([entry['key'] for entry in entries],))
+            stored = dict(cur.fetchall())
+            
+            # Fingerprint every incident in the batch and take the same advisory locks as
+            # upsert_sms_alarm (in a fixed order), so the single-message path cannot
+            # create a duplicate alarm concurrently
+            incidents = {(entry['alarm_data'].get('what'), entry['alarm_data'].get('where'),
+                          entry['alarm_data'].get('alarm_type')) for entry in entries}
+            cur.execute("""
+                SELECT what, where_location, alarm_type, fingerprint,
+                       pg_advisory_xact_lock(sms_alarm_lock_key(fingerprint))
+                FROM (
+                    SELECT DISTINCT what, where_location, alarm_type,
+                           alarm_fingerprint(what, where_location, alarm_type) AS fingerprint
+                    FROM unnest(%s::text[], %s::text[], %s::text[]) AS i(what, where_location, alarm_type)
+                    ORDER BY fingerprint
+                ) batch_incidents
+            """, tuple(list(column) for column in zip(*incidents)))
+            fingerprints = {tuple(row[:3]): row[3] for row in cur.fetchall()}
+            
+            # Open SMS alarms that batch messages could be duplicates of (index probe per fingerprint)
+            first = min(entry['occurred_at'] for entry in entries) - DUPLICATE_WINDOW
+            last = max(entry['occurred_at'] for entry in entries) + DUPLICATE_WINDOW
+            cur.execute("""
+                SELECT id, fingerprint, occurred_at
+                FROM alarms
+                WHERE source = 'SMS' AND fingerprint = ANY(%s) AND ended_at IS NULL
+                AND occurred_at BETWEEN %s AND %s
+            """, (list(set(fingerprints.values())), first, last))
+            open_alarms = {}
+            for alarm_id, fingerprint, occurred_at in cur.fetchall():
+                open_alarms.setdefault(fingerprint, []).append((occurred_at, alarm_id))
+            
+            new_alarms = []
+            alarm_departments = set()
+            sms_rows = []
+            processed = {}
+            
+            for entry in sorted(entries, key=lambda entry: entry['timestamp']):
+                alarm_data = entry['alarm_data']
+                key = entry['key']
+                
+                # Same gateway message already ingested, or twice in this batch
+                if key in stored or key in processed:
+                    previous = {k: v for k, v in (stored.get(key) or processed[key]).items() if k != 'parsed_data'}
+                    results[entry['index']] = dict(previous, duplicate=True)
+                    continue
+                
+                if not alarm_data['department_code']:
+                    result = {'status': 'ignored', 'reason': 'Unknown department'}
+                else:
+                    # Newest alarm with the same what/where/type within the window, else a new alarm
+                    fingerprint = fingerprints[(alarm_data.get('what'), alarm_data.get('where'),
+                                                alarm_data.get('alarm_type'))]
+                    candidates = [
+                        (occurred_at, alarm_id) for occurred_at, alarm_id in open_alarms.get(fingerprint, [])
+                        if abs(occurred_at - entry['occurred_at']) <= DUPLICATE_WINDOW
+                    ]
+                    if candidates:
+                        alarm_id = max(candidates)[1]
+                    else:
+                        alarm_id = uuid.uuid4()
+                        new_alarms.append((alarm_id, alarm_data['alarm_kind'], alarm_data['description'],
+                                           entry['occurred_at'], 'SMS', alarm_data.get('alarm_type'), alarm_data.get('what'),
+                                           alarm_data.get('where'), alarm_data.get('who_called')))
+                        open_alarms.setdefault(fingerprint, []).append((entry['occurred_at'], alarm_id))
+                    
+                    departments = _departments_for(alarm_data)
+                    if not departments:
+                        print(f"Warning: No departments found for alarm {alarm_id}")
+                    department_ids, unknown_codes = patterns.department_ids(departments)
+                    alarm_departments.update((alarm_id, department_id) for department_id in department_ids)
+                    for dept_code in unknown_codes:
+                        print(f"Warning: Department {dept_code} not found")
+                    
+                    result = {
+                        'status': 'success',
+                        'alarm_id': str(alarm_id),
+                        'department': alarm_data['department_code'],
+                        'all_departments': alarm_data.get('all_departments', [alarm_data['department_code']]),
+                        'kind': alarm_data.get('alarm_type', 'Unknown')
+                    }
+                
+                results[entry['index']] = processed[key] = result
+                message = entry['message']
+                sms_rows.append((key, message.get('mid') or None, message.get('sender'), message.get('recipient'),
+                                 message['content'], entry['occurred_at'], result['status'],
+                                 result.get('alarm_id'), Jsonb(dict(result, parsed_data=alarm_data))))
+            
+            if new_alarms:
+                cur.executemany("""
+                    INSERT INTO alarms (id, kind, description, occurred_at, source, alarm_type, what, where_location, who_called)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                """, new_alarms)
+            
+            if alarm_departments:
+                pairs = list(alarm_departments)
+                cur.execute("""
+                    INSERT INTO alarm_departments (alarm_id, department_id)
+                    SELECT * FROM unnest(%s::uuid[], %s::int[])
+                    ON CONFLICT (alarm_id, department_id) DO NOTHING
+                """, ([pair[0] for pair in pairs], [pair[1] for pair in pairs]))
+            
+            if sms_rows:
+                cur.executemany("""
+                    INSERT INTO sms_messages (dedup_key, mid, sender, recipient, content, sent_at, status, alarm_id, result)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (dedup_key) DO NOTHING
+                """, sms_rows)
+            
+            conn.commit()
+    
+    for key, result in processed.items():
+        dedup.remember(key, result)
+    
+    return results
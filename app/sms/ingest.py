@@ -0,0 +1,245 @@
+"""Durable local queue between the SMS webhook and alarm creation
+
+The webhook only validates the payload and appends it to a small SQLite
+queue, so the gateway gets its 200 in a few milliseconds even when Postgres
+is slow. A background worker drains the queue into process_sms_alarm with
+retries. When too many messages are waiting the webhook answers 503 and the
+gateway's own retry scheme provides back-pressure.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from . import dedup
+from .handler import process_sms_alarm
+
+QUEUE_PATH = os.getenv('SMS_QUEUE_PATH', os.path.join('data', 'sms_queue.db'))
+
+# Refuse new messages (HTTP 503) when this many are waiting
+MAX_PENDING = 1000
+
+# Retry failed messages with exponential backoff, then give up
+MAX_ATTEMPTS = 8
+MAX_BACKOFF = 300  # seconds
+
+# A claimed message not finished within this many seconds is retried (worker crashed)
+CLAIM_TIMEOUT = 300
+
+# Processed messages are kept this long for inspection
+KEEP_DONE_SECONDS = 7 * 24 * 3600
+
+_local = threading.local()
+_wakeup = threading.Event()
+_worker = None
+_worker_lock = threading.Lock()
+
+def _connect():
+    """Per-thread SQLite connection to the queue file"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        queue_dir = os.path.dirname(QUEUE_PATH)
+        if queue_dir:
+            os.makedirs(queue_dir, exist_ok=True)
+        conn = sqlite3.connect(QUEUE_PATH, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sms_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                dedup_key TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                received_at REAL NOT NULL,
+                next_attempt_at REAL NOT NULL,
+                claimed_at REAL,
+                finished_at REAL,
+                last_error TEXT,
+                result TEXT
+            )
+        """)
+        # Queue files created before dedup keys were introduced
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(sms_queue)")}
+        if 'dedup_key' not in columns:
+            conn.execute("ALTER TABLE sms_queue ADD COLUMN dedup_key TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sms_queue_pending ON sms_queue(status, next_attempt_at)")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_sms_queue_dedup_key ON sms_queue(dedup_key)")
+        _local.conn = conn
+    return conn
+
+def enqueue(payload):
+    """Durably append a gateway payload to the queue.
+
+    Returns {'queue_id', 'duplicate', 'status', 'result'}. A payload whose
+    dedup_key is already queued is not added again; the existing entry is
+    returned with duplicate=True. A redelivered message that had failed is
+    queued again with fresh attempts, as the gateway still wants it delivered.
+    """
+    now = time.time()
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cur = conn.execute("""
+            INSERT INTO sms_queue (payload, dedup_key, received_at, next_attempt_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (dedup_key) DO NOTHING
+        """, (json.dumps(payload, ensure_ascii=False), payload.get('dedup_key'), now, now))
+
+        if cur.rowcount:
+            conn.execute("COMMIT")
+            _wakeup.set()
+            return {'queue_id': cur.lastrowid, 'duplicate': False, 'status': 'pending', 'result': None}
+
+        row = conn.execute("""
+            SELECT id, status, result FROM sms_queue WHERE dedup_key = ?
+        """, (payload.get('dedup_key'),)).fetchone()
+
+        if row[1] == 'failed':
+            conn.execute("""
+                UPDATE sms_queue
+                SET status = 'pending', attempts = 0, next_attempt_at = ?,
+                    claimed_at = NULL, finished_at = NULL
+                WHERE id = ?
+            """, (now, row[0]))
+            conn.execute("COMMIT")
+            print(f"SMS queue: message {row[0]} redelivered after failing, queued again")
+            _wakeup.set()
+            return {'queue_id': row[0], 'duplicate': False, 'status': 'pending', 'result': None}
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    return {
+        'queue_id': row[0],
+        'duplicate': True,
+        'status': row[1],
+        'result': json.loads(row[2]) if row[2] else None
+    }
+
+def pending_count():
+    """Number of messages waiting to be processed"""
+    return _connect().execute(
+        "SELECT COUNT(*) FROM sms_queue WHERE status IN ('pending', 'processing')"
+    ).fetchone()[0]
+
+def _claim_next():
+    """Atomically claim the oldest due message, or return None"""
+    conn = _connect()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Give back messages claimed by a worker that died
+        conn.execute("""
+            UPDATE sms_queue SET status = 'pending'
+            WHERE status = 'processing' AND claimed_at < ?
+        """, (now - CLAIM_TIMEOUT,))
+
+        row = conn.execute("""
+            SELECT id, payload, attempts FROM sms_queue
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY id
+            LIMIT 1
+        """, (now,)).fetchone()
+
+        if row:
+            conn.execute("""
+                UPDATE sms_queue SET status = 'processing', claimed_at = ?, attempts = attempts + 1
+                WHERE id = ?
+            """, (now, row[0]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return row
+
+def _finish(queue_id, result):
+    _connect().execute("""
+        UPDATE sms_queue SET status = 'done', finished_at = ?, result = ?
+        WHERE id = ?
+    """, (time.time(), json.dumps(result, ensure_ascii=False, default=str), queue_id))
+
+def _retry(queue_id, attempts, error):
+    now = time.time()
+    if attempts >= MAX_ATTEMPTS:
+        _connect().execute("""
+            UPDATE sms_queue SET status = 'failed', finished_at = ?, last_error = ?
+            WHERE id = ?
+        """, (now, error, queue_id))
+        print(f"SMS queue: giving up on message {queue_id} after {attempts} attempts: {error}")
+        return
+    delay = min(2 ** attempts, MAX_BACKOFF)
+    _connect().execute("""
+        UPDATE sms_queue SET status = 'pending', next_attempt_at = ?, last_error = ?
+        WHERE id = ?
+    """, (now + delay, error, queue_id))
+
+def process_payload(payload):
+    """Run a queued gateway payload through alarm creation, once per dedup key"""
+    key = payload.get('dedup_key')
+    if key:
+        # Already processed (possibly by another worker or host) - reuse the result
+        stored = dedup.lookup_stored(key)
+        if stored is not None:
+            return stored
+
+    result = process_sms_alarm(payload['content'], payload.get('sender'), payload.get('timestamp'))
+
+    if key and result['status'] != 'error':
+        dedup.store_message(key, payload, result)
+    return result
+
+def drain_once():
+    """Process one due message. Returns False when nothing was due."""
+    row = _claim_next()
+    if not row:
+        return False
+
+    queue_id, payload, attempts = row[0], json.loads(row[1]), row[2] + 1
+    try:
+        result = process_payload(payload)
+    except Exception as e:
+        traceback.print_exc()
+        result = {'status': 'error', 'message': str(e)}
+
+    if result['status'] == 'error':
+        _retry(queue_id, attempts, result.get('message'))
+    else:
+        result = {key: value for key, value in result.items() if key != 'parsed_data'}
+        _finish(queue_id, result)
+        if payload.get('dedup_key'):
+            dedup.remember(payload['dedup_key'], result)
+    return True
+
+def _purge_done():
+    _connect().execute("""
+        DELETE FROM sms_queue WHERE status = 'done' AND finished_at < ?
+    """, (time.time() - KEEP_DONE_SECONDS,))
+
+def _run_worker():
+    last_purge = 0
+    while True:
+        try:
+            while drain_once():
+                pass
+            if time.time() - last_purge > 3600:
+                _purge_done()
+                last_purge = time.time()
+        except Exception as e:
+            # Queue file busy or broken - back off and try again
+            print(f"SMS queue worker error: {e}")
+            time.sleep(5)
+        # Sleep until a new message arrives or a retry becomes due
+        _wakeup.wait(timeout=1)
+        _wakeup.clear()
+
+def start_worker():
+    """Start the background worker that drains the queue (once per process)"""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run_worker, name='sms-queue-worker', daemon=True)
+            _worker.start()
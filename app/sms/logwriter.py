@@ -0,0 +1,179 @@
+"""Buffered JSONL log of everything the SMS webhook receives
+
+Request threads only put a record on a bounded in-memory queue; a background
+thread writes one compact JSON object per line to
+logs/sms_webhook_YYYY-MM-DD_<pid>.jsonl. Each worker process writes its own
+file, so rotation never pulls a file from under another process. Files are
+rotated at midnight or when they grow past MAX_FILE_BYTES, and rotated files
+are gzipped. Remaining records are
+flushed when the process exits. The files can be fed back through the parser
+with `python -m app.sms.replay`.
+"""
+
+import atexit
+import gzip
+import json
+import os
+import queue
+import re
+import shutil
+import threading
+from datetime import datetime
+
+LOG_DIR = os.getenv('SMS_LOG_DIR', 'logs')
+FILE_PREFIX = 'sms_webhook_'
+
+# sms_webhook_<day>[_<pid>][.<part>].jsonl - files without a pid predate per-process files
+_FILE_RE = re.compile(r'^sms_webhook_\d{4}-\d{2}-\d{2}(?:_(\d+))?(?:\.\d+)?\.jsonl$')
+
+# Records waiting to be written; when full new records are dropped, never the request
+MAX_QUEUED = 10000
+
+# Rotate the current file when it grows past this size
+MAX_FILE_BYTES = 50 * 1024 * 1024
+
+_queue = queue.Queue(maxsize=MAX_QUEUED)
+_writer = None
+_writer_lock = threading.Lock()
+_dropped = 0
+_stop = object()
+
+def log(data, method, timestamp=None):
+    """Queue a received payload for the log file (never blocks)"""
+    global _dropped
+    record = {
+        'logged_at': datetime.now().isoformat(),
+        'method': method,
+        'data': data,
+        'raw_timestamp': timestamp
+    }
+    _start()
+    try:
+        _queue.put_nowait(record)
+    except queue.Full:
+        _dropped += 1
+
+def dropped_count():
+    """Records dropped because the queue was full"""
+    return _dropped
+
+def _path_for(day, part=0):
+    suffix = f".{part}" if part else ''
+    return os.path.join(LOG_DIR, f"{FILE_PREFIX}{day}_{os.getpid()}{suffix}.jsonl")
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+def _compress(path):
+    """Gzip a rotated log file next to the original and remove it"""
+    # Renaming claims the file, so only one process compresses a leftover
+    claimed = f"{path}.{os.getpid()}.compressing"
+    try:
+        os.rename(path, claimed)
+    except FileNotFoundError:
+        return
+    try:
+        with open(claimed, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(claimed)
+    except OSError as e:
+        print(f"Error compressing SMS log {path}: {e}")
+
+def _compress_leftovers(current):
+    """Gzip plain log files left by this process or by processes that have exited"""
+    for filename in os.listdir(LOG_DIR):
+        match = _FILE_RE.match(filename)
+        path = os.path.join(LOG_DIR, filename)
+        if not match or path == current:
+            continue
+        pid = int(match.group(1)) if match.group(1) else None
+        if pid is None or pid == os.getpid() or not _process_alive(pid):
+            _compress(path)
+
+class _LogFile:
+    """The open log file, rotated by date and size"""
+
+    def __init__(self):
+        self.day = None
+        self.path = None
+        self.file = None
+
+    def write(self, line):
+        day = datetime.now().strftime('%Y-%m-%d')
+        if day != self.day:
+            self.rotate(day)
+        elif self.file.tell() + len(line) > MAX_FILE_BYTES:
+            self.rotate(day, by_size=True)
+        self.file.write(line)
+
+    def rotate(self, day, by_size=False):
+        previous = self.path
+        self.close()
+        if by_size:
+            # Move the full file aside as the next numbered part
+            part = 1
+            while os.path.exists(_path_for(day, part)) or os.path.exists(_path_for(day, part) + '.gz'):
+                part += 1
+            rotated = _path_for(day, part)
+            os.replace(previous, rotated)
+            _compress(rotated)
+        os.makedirs(LOG_DIR, exist_ok=True)
+        self.day = day
+        self.path = _path_for(day)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        if previous is None:
+            _compress_leftovers(self.path)
+        elif not by_size:
+            _compress(previous)
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def _run_writer():
+    log_file = _LogFile()
+    while True:
+        record = _queue.get()
+        try:
+            if record is _stop:
+                log_file.close()
+                return
+            log_file.write(json.dumps(record, ensure_ascii=False, default=str, separators=(',', ':')) + '\n')
+            # Flush once the burst is written so a crash loses at most the queue
+            if _queue.empty():
+                log_file.flush()
+        except Exception as e:
+            print(f"Error logging SMS data: {e}")
+        finally:
+            _queue.task_done()
+
+def _start():
+    global _writer
+    if _writer is not None:
+        return
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_run_writer, name='sms-log-writer', daemon=True)
+            _writer.start()
+            atexit.register(shutdown)
+
+def shutdown(timeout=5):
+    """Write out queued records and close the file (registered with atexit)"""
+    global _writer
+    writer = _writer
+    if writer is None or not writer.is_alive():
+        return
+    _queue.put(_stop)
+    writer.join(timeout)
+    _writer = None
@@ -1,45 +1,221 @@
 """SMS alarm message parser for SMS gateway integration"""
 
+import hashlib
 import re
+import threading
+from collections import Counter, OrderedDict
 from .config import DEPARTMENT_PATTERNS, ALARM_TYPE_PATTERNS
 
+# Parse results of recently seen messages, keyed on a content hash. The same
+# alarm text arrives several times (gateway retries, several recipients, one
+# page per vehicle); repeats skip all regex work. Cleared when patterns change.
+MAX_CACHED_PARSES = 2048
+
+_parse_cache = OrderedDict()
+_parse_cache_lock = threading.Lock()
+_parse_cache_stats = Counter()
+# Bumped on every clear, so a parse that ran against the old patterns is not cached
+_parse_generation = 0
+
 def parse_sms_alarm(content):
-    """Parse SMS content to determine department and alarm details"""
+    """Parse SMS content to determine department, alarm details and kind (memoised)"""
+    key = hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+    with _parse_cache_lock:
+        cached = _parse_cache.get(key)
+        if cached is not None:
+            _parse_cache.move_to_end(key)
+            _parse_cache_stats['hits'] += 1
+            result, format_name = cached
+            _format_hits[format_name] += 1
+            return dict(result, all_departments=list(result['all_departments']))
+        _parse_cache_stats['misses'] += 1
+        generation = _parse_generation
+
+    result, format_name = _parse_sms_alarm(content)
+    _format_hits[format_name] += 1
+
+    with _parse_cache_lock:
+        if generation == _parse_generation:
+            _parse_cache[key] = (result, format_name)
+            while len(_parse_cache) > MAX_CACHED_PARSES:
+                _parse_cache.popitem(last=False)
+    return dict(result, all_departments=list(result['all_departments']))
+
+def parse_sms_alarm_uncached(content):
+    """parse_sms_alarm without the memo (for benchmarks)"""
+    result, format_name = _parse_sms_alarm(content)
+    _format_hits[format_name] += 1
+    return result
+
+def _parse_sms_alarm(content):
+    """Parse SMS content, return (result, name of the matching format)"""
     
-    # Department detection using configuration
-    department_code = detect_department(content)
+    # Department detection using configuration - the first match is the primary department
     all_departments = detect_all_departments(content)
+    department_code = all_departments[0] if all_departments else None
     
     # Parse the message to extract structured information
-    parsed_info = parse_alarm_details(content)
+    parsed_info, format_name = _match_alarm_details(content)
     
     return {
         'department_code': department_code,
         'all_departments': all_departments,
         'alarm_type': parsed_info['type'],
+        'alarm_kind': detect_alarm_kind(content),
         'description': parsed_info['description'],
         'what': parsed_info['what'],
         'where': parsed_info['where'],
         'who_called': parsed_info['who_called'],
         'raw_content': content
+    }, format_name
+
+def clear_parse_cache():
+    """Forget memoised parse results (patterns changed)"""
+    global _parse_generation
+    with _parse_cache_lock:
+        _parse_cache.clear()
+        _parse_generation += 1
+
+def reset_parse_cache_stats():
+    """Clear the parse memo hit/miss counters"""
+    with _parse_cache_lock:
+        _parse_cache_stats.clear()
+
+def get_parse_cache_stats():
+    """Hits, misses, hit rate and size of the parse memo since startup"""
+    with _parse_cache_lock:
+        hits = _parse_cache_stats['hits']
+        misses = _parse_cache_stats['misses']
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'size': len(_parse_cache)
+        }
+
+# --- Department matcher -----------------------------------------------------
+#
+# DEPARTMENT_PATTERNS is compiled once into a single scanning regex. Short
+# codes (<= 4 chars) must not touch another letter or digit, so "E11" does not
+# match "LE11" but does match "E11," or "E11_". Longer names use word
+# boundaries. Patterns are folded into a prefix tree so the scan prefers the
+# longest pattern at each position; shorter patterns that also fit there are
+# resolved from a table built together with the regex.
+
+# Comma-separated codes like "M111, M3, M31, POLIS" at the end of a message
+END_CODE_PATTERNS = [
+    re.compile(r'([A-Z][a-z]?\d+|[A-Z]+)(?:\s*,\s*([A-Z][a-z]?\d+|[A-Z]+))+\s*\.?\.?$'),  # Multiple codes
+    re.compile(r'([A-Z][a-z]?\d+|[A-Z]+)\s*\.?\.?$'),  # Single code at end
+    re.compile(r'([A-Z][a-z]?\d+|[A-Z]+)(?:\s*,\s*([A-Z][a-z]?\d+|[A-Z]+))*(?:\s*,\s*)?\s*\.?\.?$'),  # Flexible
+]
+
+# Codes at the start, before the first underscore, e.g. "A01, DEPT01_C_440..."
+START_CODE_PATTERN = re.compile(r'^([A-Z][a-z]?\d+|[A-Z]+)(?:\s*,\s*([A-Z][a-z]?\d+|[A-Z]+))*(?:\s*,\s*|_)')
+
+SHORT_CODE_MAX_LENGTH = 4
+SHORT_CODE_LEFT = r'(?<![A-Z0-9])'
+SHORT_CODE_RIGHT = r'(?![A-Z0-9])'
+WORD_CHAR = re.compile(r'\w')
+
+def _prefix_tree_regex(words):
+    """Regex matching any of the words, preferring the longest"""
+    tree = {}
+    for word in words:
+        node = tree
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def render(node):
+        branches = [re.escape(char) + render(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # A word ends here - the rest is optional, tried first (greedy)
+        return f'(?:{body})?' if '' in node else body
+
+    return render(tree)
+
+def _short_code_ends_at(text, length):
+    """A short code ending after text[:length] is not followed by a letter or digit"""
+    return not re.match(r'[A-Z0-9]', text[length])
+
+def _word_ends_at(text, length):
+    """There is a word boundary between text[length - 1] and text[length]"""
+    return bool(WORD_CHAR.match(text[length - 1])) != bool(WORD_CHAR.match(text[length]))
+
+def _hits_table(departments_by_text, ends_at):
+    """Departments matched when the scan finds a text, including shorter patterns that also fit"""
+    hits = {}
+    for text, departments in departments_by_text.items():
+        matched = set(departments)
+        for other, other_departments in departments_by_text.items():
+            if len(other) < len(text) and text.startswith(other) and ends_at(text, len(other)):
+                matched.update(other_departments)
+        hits[text] = frozenset(matched)
+    return hits
+
+def build_department_matcher(department_patterns):
+    """Compile department patterns into a single-pass matcher"""
+    exact = {}
+    short_codes = {}
+    names = {}
+    for department_code, patterns in department_patterns.items():
+        for pattern in patterns:
+            pattern_upper = pattern.upper()
+            exact.setdefault(pattern_upper, set()).add(department_code)
+            # Length of the configured pattern decides the boundary rule
+            target = short_codes if len(pattern) <= SHORT_CODE_MAX_LENGTH else names
+            target.setdefault(pattern_upper, set()).add(department_code)
+
+    short_regex = SHORT_CODE_LEFT + '(' + _prefix_tree_regex(short_codes) + ')' + SHORT_CODE_RIGHT
+    name_regex = r'\b(' + _prefix_tree_regex(names) + r')\b'
+
+    branches = []
+    if short_codes:
+        branches.append(short_regex)
+    if names:
+        branches.append(name_regex)
+
+    return {
+        'order': list(department_patterns),
+        'exact': exact,
+        'upper_patterns': tuple(exact),
+        # Zero-width so overlapping hits at every position are found
+        'scanner': re.compile('(?=' + '|'.join(branches) + ')') if branches else None,
+        'has_short_codes': bool(short_codes),
+        'name_regex': re.compile(name_regex) if names else None,
+        'short_hits': _hits_table(short_codes, _short_code_ends_at),
+        'name_hits': _hits_table(names, _word_ends_at),
     }
 
+_department_matcher = build_department_matcher(DEPARTMENT_PATTERNS)
+
+def set_department_patterns(department_patterns):
+    """Rebuild the department matcher from new patterns (swapped in atomically)"""
+    global _department_matcher
+    _department_matcher = build_department_matcher(department_patterns)
+    clear_parse_cache()
+
+# (kind, patterns) in priority order, see detect_alarm_kind()
+_alarm_kind_patterns = tuple((kind, tuple(patterns)) for kind, patterns in ALARM_TYPE_PATTERNS.items())
+
+def set_alarm_kind_patterns(alarm_kind_patterns):
+    """Replace the alarm kind patterns ({kind: [patterns]} in priority order)"""
+    global _alarm_kind_patterns
+    _alarm_kind_patterns = tuple((kind, tuple(patterns)) for kind, patterns in alarm_kind_patterns.items())
+    clear_parse_cache()
+
 def extract_department_codes_from_end(text):
     """Extract department codes from the end of text if they match known patterns"""
     if not text:
         return None, text
     
-    # Look for patterns like "M111, M3, M31, POLIS" at the end
-    # Match: comma-separated codes (M111, M3, POLIS, etc.) at the end, with optional punctuation
-    # Try different patterns: with trailing comma, with periods, etc.
-    patterns_to_try = [
-        r'([A-Z][a-z]?\d+|[A-Z]+)(?:\s*,\s*([A-Z][a-z]?\d+|[A-Z]+))+\s*\.?\.?$',  # Multiple codes
-        r'([A-Z][a-z]?\d+|[A-Z]+)\s*\.?\.?$',  # Single code at end
-        r'([A-Z][a-z]?\d+|[A-Z]+)(?:\s*,\s*([A-Z][a-z]?\d+|[A-Z]+))*(?:\s*,\s*)?\s*\.?\.?$',  # Flexible
-    ]
+    upper_patterns = _department_matcher['upper_patterns']
     
-    for dept_pattern in patterns_to_try:
-        match = re.search(dept_pattern, text)
+    # Try different patterns: with trailing comma, with periods, etc.
+    for dept_pattern in END_CODE_PATTERNS:
+        match = dept_pattern.search(text)
         if match:
             # Get all department codes from the match
             dept_codes_str = match.group(0).rstrip('.,').strip()
@@ -47,24 +223,304 @@ def extract_department_codes_from_end(text):
                 continue
                 
             # Check if any codes match known department patterns
+            # Also accept POLIS or PolisTeknik (common but not in config)
             dept_codes_upper = dept_codes_str.upper()
-            for dept_code, patterns in DEPARTMENT_PATTERNS.items():
-                if any(pattern.upper() in dept_codes_upper for pattern in patterns):
-                    # Found matching department codes - extract them
-                    remaining_text = text[:match.start()].strip()
-                    return dept_codes_str, remaining_text
-            
-            # Also check for POLIS or PolisTeknik (common but not in config)
-            if 'POLIS' in dept_codes_upper or 'POLISTEKNIK' in dept_codes_upper:
+            if any(pattern in dept_codes_upper for pattern in upper_patterns) or 'POLIS' in dept_codes_upper:
+                # Found matching department codes - extract them
                 remaining_text = text[:match.start()].strip()
                 return dept_codes_str, remaining_text
     
     return None, text
 
+# --- Compiled parser engine -------------------------------------------------
+#
+# Every known message format is declared once in ALARM_FORMATS with a
+# precompiled regex, the cheap markers a message must contain for the format
+# to possibly match, and a builder that turns the match into result fields.
+# parse_alarm_details classifies the message once and only tries the formats
+# whose markers are all present, in the same priority order as before.
+
+# Messages containing any of these are not real alarms
+IGNORE_MARKERS = ('PROVALARM-BEFOLKNINGSSKYDD', 'Återbud')
+
+# Department_TYPE_number_ prefix, e.g. "A01, DEPT01_C_441_"
+TYPE_CODE_PREFIX = re.compile(r'^[^_]+_[A-Z]_\d+_')
+
+# Substring markers used for pre-classification
+TEXT_MARKERS = {
+    'klass': 'Klass:',
+    'slash_klass': '/Klass:',
+    'handelse_q': 'Händelse?',
+    'handelse_colon': 'Händelse:',
+    'ovrigt_colon': 'Övrigt:',
+    'forstarkning': 'Typ av förstärkning',
+    'provalarm': '_PROVALARM',
+    'semicolon': ';',
+}
+
+KLASS_TYPE = re.compile(r'Klass:\s*([^.-]+)')
+
+# Per-format hit counters, see get_format_hits()
+_format_hits = Counter()
+
+def classify_message(content):
+    """Return the set of cheap markers present in the message"""
+    markers = {name for name, marker in TEXT_MARKERS.items() if marker in content}
+    if content.startswith('PROVALARM'):
+        markers.add('provalarm_start')
+    if TYPE_CODE_PREFIX.match(content):
+        markers.add('type_code')
+    if 'Beredskapsalarm' in content or 'Övrigt' in content:
+        markers.add('standby')
+    return markers
+
+def _provalarm_simple(m):
+    return {'type': 'PROVALARM', 'what': m.group(1).strip(), 'where': None, 'who_called': None}
+
+def _provalarm_coded(m):
+    return {
+        'type': 'PROVALARM',
+        'what': m.group(3).strip(),
+        'where': m.group(4).strip().lstrip('_'),
+        'who_called': None,
+    }
+
+def _type_code(m):
+    description_part = m.group(3).strip()
+
+    # Try to extract type from description, default for C-type alarms
+    alarm_type = 'Larm'
+    for keyword in ('Beredskapsalarm', 'Övrigt', 'Meddelande'):
+        if keyword in description_part:
+            alarm_type = keyword
+            break
+
+    return {
+        'type': alarm_type,
+        'what': description_part,
+        'where': m.group(4).strip().lstrip('_'),
+        'who_called': m.group(1).strip(),
+    }
+
+def _type_code_klass(m):
+    description_part = m.group(3).strip()
+
+    alarm_type = None
+    if 'Klass:' in description_part:
+        type_match = KLASS_TYPE.search(description_part)
+        if type_match:
+            alarm_type = type_match.group(1).strip()
+
+    # What is everything after the type
+    if ' - ' in description_part:
+        what = description_part.split(' - ', 1)[1].strip()
+    else:
+        what = description_part
+
+    return {
+        'type': alarm_type,
+        'what': what,
+        'where': m.group(4).strip().lstrip('_'),
+        'who_called': m.group(1).strip(),
+    }
+
+def _klass_handelse_ovrigt(m):
+    return {
+        'type': m.group(2).strip(),
+        'what': f"{m.group(3).strip()}. Övrigt: {m.group(4).strip()}",
+        'where': m.group(1).strip(),
+        'who_called': m.group(5).strip(),
+    }
+
+def _klass_handelse(m):
+    return {
+        'type': m.group(2).strip(),
+        'what': m.group(3).strip(),
+        'where': m.group(1).strip(),
+        'who_called': m.group(4).strip(),
+    }
+
+def _two_locations_klass(m):
+    return {
+        'type': m.group(3).strip(),
+        'what': f"{m.group(4).strip()}. {m.group(5).strip()}",
+        'where': f"{m.group(1).strip()}; {m.group(2).strip()}",
+        'who_called': m.group(6).strip(),
+    }
+
+def _two_locations_handelse_ovrigt(m):
+    what = f"{m.group(4).strip()}. Övrigt: {m.group(5).strip()}"
+    return {
+        'type': m.group(3).strip(),
+        'what': what.replace('..', '.').replace(' .', '.'),
+        'where': f"{m.group(1).strip()}; {m.group(2).strip()}",
+        'who_called': m.group(6).strip(),
+    }
+
+def _klass_trailing_codes(m):
+    what = m.group(3).strip()
+
+    # Try to extract who_called from the end (department codes)
+    who_called, what_part = extract_department_codes_from_end(m.group(4).strip())
+
+    return {
+        'type': m.group(2).strip(),
+        'what': f"{what}. {what_part}".strip() if what_part else what,
+        'where': m.group(1).strip(),
+        'who_called': who_called,
+    }
+
+def _klass_who_called(m):
+    return {
+        'type': m.group(2).strip(),
+        'what': m.group(3).strip(),
+        'where': m.group(1).strip(),
+        'who_called': m.group(4).strip(),
+    }
+
+def _klass_info_who_called(m):
+    return {
+        'type': m.group(2).strip(),
+        'what': f"{m.group(3).strip()}. {m.group(4).strip()}".strip(),
+        'where': m.group(1).strip(),
+        'who_called': m.group(5).strip(),
+    }
+
+def _standby_ovrigt(m):
+    return {
+        'type': m.group(2).strip(),
+        'what': f"{m.group(3).strip()}. Övrigt {m.group(4).strip()}".strip(),
+        'where': m.group(1).strip(),
+        'who_called': m.group(5).strip(),
+    }
+
+def _standby(m):
+    return {
+        'type': m.group(2).strip(),
+        'what': m.group(3).strip(),
+        'where': m.group(1).strip(),
+        'who_called': m.group(4).strip(),
+    }
+
+def _forstarkning(m):
+    return {
+        'type': 'Förstärkning',
+        'what': f"Typ av förstärkning {m.group(2).strip()}. Övrig information: {m.group(3).strip()}",
+        'where': m.group(1).strip(),
+        'who_called': m.group(4).strip(),
+    }
+
+def _codes_first_klass(m):
+    return {
+        'type': m.group(2).strip(),
+        'what': m.group(3).strip(),
+        'where': m.group(4).strip(),
+        'who_called': m.group(1).strip(),
+    }
+
+# (name, required markers, regex, builder) - tried in this order, first match wins
+ALARM_FORMATS = [
+    # PROVALARM Station A. . Practice drill tonight at 19:00.
+    ('provalarm_simple', {'provalarm_start'},
+     re.compile(r'^PROVALARM\s+(.+)$'), _provalarm_simple),
+
+    # DEPT01_N_900_PROVALARM Station A. . Practice drill tonight at 19:00._Main Street 12, Station A, City
+    ('provalarm_coded', {'type_code', 'provalarm'},
+     re.compile(r'^([A-Za-z]+)_([A-Z]_\d+)_PROVALARM\s+(.+?)\._(.+)$'), _provalarm_coded),
+
+    # A01, DEPT01_C_441_Other Staff station due to resources busy with fire at location ._Main Street 12, Station A, City
+    ('type_code', {'type_code'},
+     re.compile(r'^([^_]+)_([A-Z]_\d+)_(.+?)\.(.+)$'), _type_code),
+
+    # B01, B02, B03, A01, A02, A03, POLICE, PoliceTech_A_422_Class: Major Alarm - Building Fire._Oak Street 11, City
+    # Only reached when the description spans several lines
+    ('type_code_klass', {'type_code'},
+     re.compile(r'^([^_]+)_([A-Z]_\d+)_([^_]+)\.(.+)$'), _type_code_klass),
+
+    # Old School Street 12, City;  Class: Person Search Alarm. Event? LIFT ASSISTANCE. Other: door open, sitting on floor outside bathroom.;  B01, B02
+    ('klass_handelse_ovrigt', {'semicolon', 'klass', 'handelse_q', 'ovrigt_colon'},
+     re.compile(r'^(.+?);\s*Klass:\s*([^;]+)\.\s*Händelse\?\s*([^;]+)\.\s*Övrigt:\s*([^;]+);\s*(.+)$'), _klass_handelse_ovrigt),
+
+    # Main Road, City;  Class: Rescue - Assistance. Event: driven into ditch, 1 person not trapped . Type of traffic accident: ...;  B01, B02, POLICE
+    ('klass_handelse', {'semicolon', 'klass', 'handelse_colon'},
+     re.compile(r'^(.+?);\s*Klass:\s*([^;]+)\.\s*Händelse:\s*([^;]+);\s*(.+)$'), _klass_handelse),
+
+    # Spark Street, Hilltop, City;  At old stone crusher;  Class: Major Alarm - Wildfire. Other information Smoke up on the hill.;  B01, B02, POLICE
+    ('two_locations_klass', {'semicolon', 'klass'},
+     re.compile(r'^(.+?);\s+(.+?);\s+Klass:\s*([^-]+?)\s*-\s*([^.;]+?)\.\s*([^;]+?);\s+(.+)$'), _two_locations_klass),
+
+    # Old School Street 12, City;  light 3 ;  Class: Person Search Alarm. Event? LIFT ASSISTANCE . Other: sitting on floor cannot get up. .;  B01, B02
+    ('two_locations_handelse_ovrigt', {'semicolon', 'klass', 'handelse_q', 'ovrigt_colon'},
+     re.compile(r'^(.+?);\s*(.+?);\s*Klass:\s*([^.;]+)\.\s*Händelse\?\s*([^.;]+?)\s*\.?\s*Övrigt:\s*([^;]+?)\s*\.?\s*;\s*(.+)$'),
+     _two_locations_handelse_ovrigt),
+
+    # Main Street 12, Station A school north, City; /Class: Major Alarm - Automatic Alarm. Other information Automatic alarm A01, A02, A03..
+    ('slash_klass_trailing_codes', {'semicolon', 'slash_klass'},
+     re.compile(r'^(.+?);\s*/Klass:\s*([^-]+?)\s*-\s*([^.;]+?)\s*\.\s*(.+)$'), _klass_trailing_codes),
+
+    # West School Street 4, Station A elementary school, City; Class: Major Alarm-Automatic Alarm. Other information Automatic alarm A01, A02, A03,
+    ('klass_trailing_codes', {'semicolon', 'klass'},
+     re.compile(r'^(.+?);\s*Klass:\s*([^-]+?)-([^.;]+?)\s*\.\s*(.+)$'), _klass_trailing_codes),
+
+    # Main Street 12, Station A school north, City; /Class: Major Alarm - Automatic Alarm.; A01, A02, A03
+    ('slash_klass_who_called', {'semicolon', 'slash_klass'},
+     re.compile(r'^(.+?);\s*/Klass:\s*([^-]+?)\s*-\s*([^;]+?)\s*\.\s*;\s*(.+)$'), _klass_who_called),
+
+    # West School Street 4, Station A elementary school, City; Class: Major Alarm-Automatic Alarm.; A01, A02, A03
+    ('klass_tight_who_called', {'semicolon', 'klass'},
+     re.compile(r'^(.+?);\s*Klass:\s*([^-]+?)-([^;]+?)\s*\.\s*;\s*(.+)$'), _klass_who_called),
+
+    # Bay Street 323, City;  Class: Small Alarm - Chimney Fire. What type of building? chimney fire. 2 floors.;  E01, E02, A01, POLICE
+    ('klass_info_who_called', {'semicolon', 'klass'},
+     re.compile(r'^(.+?);\s*Klass:\s*([^-]+?)\s*-\s*([^.]+?)\.\s*([^;]+)\s*;\s*(.+)$'), _klass_info_who_called),
+
+    # Bay Street 323, City, Class: Small Alarm - Chimney Fire. What type of building? chimney fire. 2 floors; E01, E02, A01, POLICE
+    ('comma_klass_info_who_called', {'semicolon', 'klass'},
+     re.compile(r'^(.+?),\s*Klass:\s*([^-]+?)\s*-\s*([^.]+?)\.\s*([^;]+)\s*;\s*(.+)$'), _klass_info_who_called),
+
+    # Ridge Road 121 Farm, City; Class: Major Alarm - Automatic Alarm.; B01, B02, C01, C02, A01, POLICE
+    ('klass_who_called', {'semicolon', 'klass'},
+     re.compile(r'^(.+?);\s*Klass:\s*([^-]+?)\s*-\s*([^;]+?)\s*\.\s*;\s*(.+)$'), _klass_who_called),
+
+    # Main Street 12, Station A, City; Standby Alarm all ambulances out, contact supervisor tel 123456. Other On standby., A01, DEPT01
+    ('standby_ovrigt', {'semicolon', 'standby'},
+     re.compile(r'^(.+?);\s*(Beredskapsalarm|Övrigt)\s*(.+?)\s*\.\s*Övrigt\s+([^.,]+?)\s*\.\s*,\s*(.+)$'), _standby_ovrigt),
+
+    # Main Street 12, Station A, City; Standby Alarm standby at depot., A01, DEPT01
+    ('standby', {'semicolon', 'standby'},
+     re.compile(r'^(.+?);\s*(Beredskapsalarm|Övrigt)\s*(.+?)\s*\.\s*,\s*(.+)$'), _standby),
+
+    # Harbor Road, City; Type of reinforcement Fire Department. Other information: Fire in barn City.; A01, A02, A03, DEPT01
+    ('forstarkning', {'semicolon', 'forstarkning'},
+     re.compile(r'^(.+?);\s*Typ av förstärkning\s+([^.;]+?)\.\s*Övrig information:\s*([^;]+?)\s*\.\s*;\s*(.+)$'), _forstarkning),
+
+    # E01, E02, A01, POLICE B 417 Class: Small Alarm - Chimney Fire. Bay Street 323, City
+    ('codes_first_klass', {'klass'},
+     re.compile(r'^(.+?)\s+Klass:\s*([^-]+?)\s*-\s*([^.]+?)\.\s*(.+)$'), _codes_first_klass),
+]
+
+def candidate_formats(content):
+    """Formats whose markers are all present in the message, in priority order"""
+    markers = classify_message(content)
+    return [fmt for fmt in ALARM_FORMATS if fmt[1] <= markers]
+
+def get_format_hits():
+    """Return how many messages each format has parsed since startup"""
+    return dict(_format_hits)
+
+def reset_format_hits():
+    """Clear the per-format hit counters"""
+    _format_hits.clear()
+
 def parse_alarm_details(content):
     """Parse alarm details from SMS content"""
-    
-    # Initialize result
+    result, format_name = _match_alarm_details(content)
+    _format_hits[format_name] += 1
+    return result
+
+def _match_alarm_details(content):
+    """Parse alarm details, return (details, name of the matching format)"""
+
     result = {
         'type': None,
         'what': None,
@@ -72,371 +528,23 @@ def parse_alarm_details(content):
         'who_called': None,
         'description': content
     }
-    
+
     # Check for ignore patterns first
-    ignore_patterns = [
-        'PROVALARM-BEFOLKNINGSSKYDD',
-        'Återbud'
-    ]
-    
-    for pattern in ignore_patterns:
-        if pattern in content:
-            result['type'] = 'IGNORE'
-            return result
-    
-    # Pattern 4: Simple PROVALARM without department prefix
-    # Example: PROVALARM Station A. . Practice drill tonight at 19:00.
-    pattern4_match = re.match(r'^PROVALARM\s+(.+)$', content)
-    if pattern4_match:
-        description_part = pattern4_match.group(1).strip()
-        
-        result['type'] = 'PROVALARM'
-        result['what'] = description_part
-        result['where'] = None
-        result['who_called'] = None
-        
-        return result
-    
-    # Pattern 1: Department_N_number_PROVALARM description._location
-    # Example: DEPT01_N_900_PROVALARM Station A. . Practice drill tonight at 19:00._Main Street 12, Station A, City
-    pattern1_match = re.match(r'^([A-Za-z]+)_([A-Z]_\d+)_PROVALARM\s+(.+?)\._(.+)$', content)
-    if pattern1_match:
-        dept = pattern1_match.group(1)
-        type_code = pattern1_match.group(2)
-        description_part = pattern1_match.group(3).strip()
-        location_part = pattern1_match.group(4).strip()
-        
-        result['type'] = 'PROVALARM'
-        result['what'] = description_part
-        result['where'] = location_part.lstrip('_')
-        result['who_called'] = None
-        
-        return result
-    
-    # Pattern 2: Department_C_number_description._location
-    # Example: A01, DEPT01_C_441_Other Staff station due to resources busy with fire at location ._Main Street 12, Station A, City
-    pattern2_match = re.match(r'^([^_]+)_([A-Z]_\d+)_(.+?)\.(.+)$', content)
-    if pattern2_match:
-        who_called = pattern2_match.group(1).strip()
-        type_code = pattern2_match.group(2)
-        description_part = pattern2_match.group(3).strip()
-        location_part = pattern2_match.group(4).strip()
-        
-        # Try to extract type from description
-        type_keywords = ['Beredskapsalarm', 'Övrigt', 'Meddelande']
-        for keyword in type_keywords:
-            if keyword in description_part:
-                result['type'] = keyword
-                break
-        
-        if not result['type']:
-            result['type'] = 'Larm'  # Default for C-type alarms
-        
-        result['what'] = description_part
-        result['where'] = location_part.lstrip('_')
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 3: Department codes at start, then department_type_number: description._location
-    # Example: B01, B02, B03, A01, A02, A03, POLICE, PoliceTech_A_422_Class: Major Alarm - Building Fire._Oak Street 11, City
-    pattern3_match = re.match(r'^([^_]+)_([A-Z]_\d+)_([^_]+)\.(.+)$', content)
-    if pattern3_match:
-        who_called = pattern3_match.group(1).strip()
-        type_code = pattern3_match.group(2)
-        description_part = pattern3_match.group(3).strip()
-        location_part = pattern3_match.group(4).strip()
-        
-        # Extract type from description
-        if 'Klass:' in description_part:
-            type_match = re.search(r'Klass:\s*([^.-]+)', description_part)
-            if type_match:
-                result['type'] = type_match.group(1).strip()
-        
-        # Extract what (everything after type)
-        if ' - ' in description_part:
-            what_part = description_part.split(' - ', 1)[1]
-            result['what'] = what_part.strip()
-        else:
-            result['what'] = description_part
-        
-        # Extract where (remove leading underscore if present)
-        result['where'] = location_part.lstrip('_')
-        
-        # Extract who is called
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 4: Location; Class: type. Event? what. Other: additional_info.; who_called
-    # Example: Old School Street 12, City;  Class: Person Search Alarm. Event? LIFT ASSISTANCE. Other: door open, sitting on floor outside bathroom.;  B01, B02
-    pattern4_match = re.match(r'^(.+?);\s*Klass:\s*([^;]+)\.\s*Händelse\?\s*([^;]+)\.\s*Övrigt:\s*([^;]+);\s*(.+)$', content)
-    if pattern4_match:
-        location = pattern4_match.group(1).strip()
-        alarm_type = pattern4_match.group(2).strip()
-        händelse = pattern4_match.group(3).strip()
-        övrigt = pattern4_match.group(4).strip()
-        who_called = pattern4_match.group(5).strip()
-        
-        result['type'] = alarm_type
-        result['what'] = f"{händelse}. Övrigt: {övrigt}"
-        result['where'] = location
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 5: Location; Class: type. Event: what. additional_info.; who_called
-    # Example: Main Road, City;  Class: Rescue - Assistance. Event: driven into ditch, 1 person not trapped . Type of traffic accident: Single accident/Off-road. Type of vehicle Car. Vehicle on wheels. Patient injuries neck pain .;  B01, B02, B03, A01, A02, A03, POLICE
-    pattern5_match = re.match(r'^(.+?);\s*Klass:\s*([^;]+)\.\s*Händelse:\s*([^;]+);\s*(.+)$', content)
-    if pattern5_match:
-        location = pattern5_match.group(1).strip()
-        alarm_type = pattern5_match.group(2).strip()
-        händelse = pattern5_match.group(3).strip()
-        who_called = pattern5_match.group(4).strip()
-        
-        result['type'] = alarm_type
-        result['what'] = händelse
-        result['where'] = location
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 6: Location; additional_location; Class: type - what. additional_info.; who_called
-    # Example: Spark Street, Hilltop, City;  At old stone crusher;  Class: Major Alarm - Wildfire. Other information Smoke up on the hill at old stone crusher.;  B01, B02, B03, A01, A02, A03, POLICE, PoliceTech
-    pattern6_match = re.match(r'^(.+?);\s+(.+?);\s+Klass:\s*([^-]+?)\s*-\s*([^.;]+?)\.\s*([^;]+?);\s+(.+)$', content)
-    if pattern6_match:
-        location1 = pattern6_match.group(1).strip()
-        location2 = pattern6_match.group(2).strip()
-        alarm_type = pattern6_match.group(3).strip()
-        what = pattern6_match.group(4).strip()
-        additional_info = pattern6_match.group(5).strip()
-        who_called = pattern6_match.group(6).strip()
-        
-        result['type'] = alarm_type
-        result['what'] = f"{what}. {additional_info}"
-        result['where'] = f"{location1}; {location2}"
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 7: Location; additional_info; Class: type. Event? what. Other: additional_info.; who_called
-    # Example: Old School Street 12, City;  light 3 ;  Class: Person Search Alarm. Event? LIFT ASSISTANCE . Other: sitting on floor cannot get up. .;  B01, B02
-    # More tolerant matching (extra spaces or dots around sentences)
-    pattern7_match = re.match(
-        r'^(.+?);\s*(.+?);\s*Klass:\s*([^.;]+)\.\s*Händelse\?\s*([^.;]+?)\s*\.?\s*Övrigt:\s*([^;]+?)\s*\.?\s*;\s*(.+)$',
-        content
-    )
-    if pattern7_match:
-        location = pattern7_match.group(1).strip()
-        additional_info = pattern7_match.group(2).strip()
-        alarm_type = pattern7_match.group(3).strip()
-        händelse = pattern7_match.group(4).strip()
-        övrigt = pattern7_match.group(5).strip()
-        who_called = pattern7_match.group(6).strip()
-        
-        result['type'] = alarm_type
-        result['what'] = f"{händelse}. Övrigt: {övrigt}".replace('..', '.').replace(' .', '.')
-        result['where'] = f"{location}; {additional_info}"
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 8a: Address; /Class: AlarmType - What. Other information additional_info [departments]
-    # Example: Main Street 12, Station A school north, City; /Class: Major Alarm - Automatic Alarm. Other information Automatic alarm A01, A02, A03..
-    pattern8a_match = re.match(r'^(.+?);\s*/Klass:\s*([^-]+?)\s*-\s*([^.;]+?)\s*\.\s*(.+)$', content)
-    if pattern8a_match:
-        location = pattern8a_match.group(1).strip()
-        alarm_type = pattern8a_match.group(2).strip()
-        what = pattern8a_match.group(3).strip()
-        rest = pattern8a_match.group(4).strip()
-        
-        # Try to extract who_called from the end (department codes)
-        who_called, what_part = extract_department_codes_from_end(rest)
-        
-        result['type'] = alarm_type
-        result['what'] = f"{what}. {what_part}".strip() if what_part else what
-        result['where'] = location
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 8b: Address; Class: AlarmType-What. Other information additional_info [departments]
-    # Example: West School Street 4, Station A elementary school, City; Class: Major Alarm-Automatic Alarm. Other information Automatic alarm A01, A02, A03,
-    pattern8b_match = re.match(r'^(.+?);\s*Klass:\s*([^-]+?)-([^.;]+?)\s*\.\s*(.+)$', content)
-    if pattern8b_match:
-        location = pattern8b_match.group(1).strip()
-        alarm_type = pattern8b_match.group(2).strip()
-        what = pattern8b_match.group(3).strip()
-        rest = pattern8b_match.group(4).strip()
-        
-        # Try to extract who_called from the end (department codes)
-        who_called, what_part = extract_department_codes_from_end(rest)
-        
-        result['type'] = alarm_type
-        result['what'] = f"{what}. {what_part}".strip() if what_part else what
-        result['where'] = location
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 8c: Address; /Class: AlarmType - What.; WhoCalled
-    # Example: Main Street 12, Station A school north, City; /Class: Major Alarm - Automatic Alarm.; A01, A02, A03
-    pattern8c_match = re.match(r'^(.+?);\s*/Klass:\s*([^-]+?)\s*-\s*([^;]+?)\s*\.\s*;\s*(.+)$', content)
-    if pattern8c_match:
-        location = pattern8c_match.group(1).strip()
-        alarm_type = pattern8c_match.group(2).strip()
-        what = pattern8c_match.group(3).strip()
-        who_called = pattern8c_match.group(4).strip()
-        
-        result['type'] = alarm_type
-        result['what'] = what
-        result['where'] = location
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 8d: Address; Class: AlarmType-What.; WhoCalled
-    # Example: West School Street 4, Station A elementary school, City; Class: Major Alarm-Automatic Alarm.; A01, A02, A03
-    pattern8d_match = re.match(r'^(.+?);\s*Klass:\s*([^-]+?)-([^;]+?)\s*\.\s*;\s*(.+)$', content)
-    if pattern8d_match:
-        location = pattern8d_match.group(1).strip()
-        alarm_type = pattern8d_match.group(2).strip()
-        what = pattern8d_match.group(3).strip()
-        who_called = pattern8d_match.group(4).strip()
-        
-        result['type'] = alarm_type
-        result['what'] = what
-        result['where'] = location
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 8b: Location; Class: type - what. additional_info.; who_called
-    # Example: Bay Street 323, City;  Class: Small Alarm - Chimney Fire. What type of building? chimney fire. 2 floors.;  E01, E02, A01, POLICE
-    # Format: Location; Klass: Type - What. AdditionalInfo.; WhoCalled
-    pattern8b_match = re.match(r'^(.+?);\s*Klass:\s*([^-]+?)\s*-\s*([^.]+?)\.\s*([^;]+)\s*;\s*(.+)$', content)
-    if pattern8b_match:
-        location = pattern8b_match.group(1).strip()
-        alarm_type = pattern8b_match.group(2).strip()
-        what = pattern8b_match.group(3).strip()
-        additional_info = pattern8b_match.group(4).strip()
-        who_called = pattern8b_match.group(5).strip()
-        
-        result['type'] = alarm_type
-        result['what'] = f"{what}. {additional_info}".strip()
-        result['where'] = location
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 8c: Location, Class: type - what. additional_info; who_called
-    # Example: Bay Street 323, City, Class: Small Alarm - Chimney Fire. What type of building? chimney fire. 2 floors; E01, E02, A01, POLICE
-    # Format: Location, Klass: Type - What. AdditionalInfo; WhoCalled (comma instead of semicolon)
-    pattern8c_match = re.match(r'^(.+?),\s*Klass:\s*([^-]+?)\s*-\s*([^.]+?)\.\s*([^;]+)\s*;\s*(.+)$', content)
-    if pattern8c_match:
-        location = pattern8c_match.group(1).strip()
-        alarm_type = pattern8c_match.group(2).strip()
-        what = pattern8c_match.group(3).strip()
-        additional_info = pattern8c_match.group(4).strip()
-        who_called = pattern8c_match.group(5).strip()
-        
-        result['type'] = alarm_type
-        result['what'] = f"{what}. {additional_info}".strip()
-        result['where'] = location
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 8: Address; Class: AlarmType - What.; WhoCalled
-    # Example: Ridge Road 121 Farm, City; Class: Major Alarm - Automatic Alarm.; B01, B02, C01, C02, A01, POLICE
-    # Format is ALWAYS: Address; Klass: Type - What.; WhoCalled
-    pattern8_match = re.match(r'^(.+?);\s*Klass:\s*([^-]+?)\s*-\s*([^;]+?)\s*\.\s*;\s*(.+)$', content)
-    if pattern8_match:
-        location = pattern8_match.group(1).strip()
-        alarm_type = pattern8_match.group(2).strip()
-        what = pattern8_match.group(3).strip()
-        who_called = pattern8_match.group(4).strip()
-        
-        result['type'] = alarm_type
-        result['what'] = what
-        result['where'] = location
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 9: Location; Standby Alarm/Other description. Other additional_info., WhoCalled
-    # Example: Main Street 12, Station A, City; Standby Alarm all ambulances out, contact supervisor tel 123456. Other On standby., A01, DEPT01
-    pattern9_match = re.match(r'^(.+?);\s*(Beredskapsalarm|Övrigt)\s*(.+?)\s*\.\s*Övrigt\s+([^.,]+?)\s*\.\s*,\s*(.+)$', content)
-    if pattern9_match:
-        location = pattern9_match.group(1).strip()
-        alarm_type = pattern9_match.group(2).strip()
-        description = pattern9_match.group(3).strip()
-        additional_info = pattern9_match.group(4).strip()
-        who_called = pattern9_match.group(5).strip()
-        
-        result['type'] = alarm_type
-        result['what'] = f"{description}. Övrigt {additional_info}".strip()
-        result['where'] = location
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 9b: Location; Standby Alarm/Other description., WhoCalled
-    # Example: Main Street 12, Station A, City; Standby Alarm standby at depot., A01, DEPT01
-    pattern9b_match = re.match(r'^(.+?);\s*(Beredskapsalarm|Övrigt)\s*(.+?)\s*\.\s*,\s*(.+)$', content)
-    if pattern9b_match:
-        location = pattern9b_match.group(1).strip()
-        alarm_type = pattern9b_match.group(2).strip()
-        description = pattern9b_match.group(3).strip()
-        who_called = pattern9b_match.group(4).strip()
-        
-        result['type'] = alarm_type
-        result['what'] = description
-        result['where'] = location
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 9c: Location; Type of reinforcement Fire Department. Other information: description.; WhoCalled
-    # Example: Harbor Road, City; Type of reinforcement Fire Department. Other information: Fire in barn City.; A01, A02, A03, DEPT01
-    pattern9c_match = re.match(r'^(.+?);\s*Typ av förstärkning\s+([^.;]+?)\.\s*Övrig information:\s*([^;]+?)\s*\.\s*;\s*(.+)$', content)
-    if pattern9c_match:
-        location = pattern9c_match.group(1).strip()
-        reinforcement_type = pattern9c_match.group(2).strip()
-        description = pattern9c_match.group(3).strip()
-        who_called = pattern9c_match.group(4).strip()
-        
-        result['type'] = 'Förstärkning'
-        result['what'] = f"Typ av förstärkning {reinforcement_type}. Övrig information: {description}"
-        result['where'] = location
-        result['who_called'] = who_called
-        
-        return result
-    
-    # Pattern 10: WhoCalled Class: AlarmType - What. Address
-    # Example: E01, E02, A01, POLICE B 417 Class: Small Alarm - Chimney Fire. Bay Street 323, City
-    # Format: Department codes at start, then "Klass: Type - What. Address"
-    pattern10_match = re.match(r'^(.+?)\s+Klass:\s*([^-]+?)\s*-\s*([^.]+?)\.\s*(.+)$', content)
-    if pattern10_match:
-        who_called = pattern10_match.group(1).strip()
-        alarm_type = pattern10_match.group(2).strip()
-        what = pattern10_match.group(3).strip()
-        location = pattern10_match.group(4).strip()
-        
-        result['type'] = alarm_type
-        result['what'] = what
-        result['where'] = location
-        result['who_called'] = who_called
-        
-        return result
-    
+    if any(marker in content for marker in IGNORE_MARKERS):
+        result['type'] = 'IGNORE'
+        return result, 'ignore'
+
+    for name, _, regex, build in candidate_formats(content):
+        match = regex.match(content)
+        if match:
+            result.update(build(match))
+            return result, name
+
     # Default fallback - try to extract basic info
     result['type'] = 'Unknown'
     result['what'] = content
-    result['where'] = None
-    result['who_called'] = None
-    
-    return result
+
+    return result, 'unknown'
 
 def detect_department(content):
     """Enhanced department detection using configuration patterns - returns first matching department"""
@@ -453,7 +561,7 @@ def detect_department(content):
 def detect_all_departments(content):
     """Detect all departments mentioned in the SMS content"""
     
-    matched_departments = []
+    matcher = _department_matcher
     content_upper = content.upper()  # Convert to uppercase for case-insensitive matching
     
     # First, try to extract department codes from the end of the message
@@ -463,59 +571,44 @@ def detect_all_departments(content):
     # Extract individual codes from the comma-separated string
     extracted_codes = set()
     if dept_codes_str:
-        # Split by comma and clean up
-        codes = [code.strip().upper() for code in dept_codes_str.split(',')]
-        extracted_codes.update(codes)
+        extracted_codes.update(code.strip().upper() for code in dept_codes_str.split(','))
     
     # Also extract codes that appear at the start (before first underscore or space after comma)
-    # Pattern: codes at start like "A01, DEPT01_C_440..."
-    start_match = re.match(r'^([A-Z][a-z]?\d+|[A-Z]+)(?:\s*,\s*([A-Z][a-z]?\d+|[A-Z]+))*(?:\s*,\s*|_)', content_upper)
+    start_match = START_CODE_PATTERN.match(content_upper)
     if start_match:
-        # Extract all codes from the match
         start_codes_str = start_match.group(0).rstrip('_,').strip()
         if start_codes_str:
-            start_codes = [code.strip() for code in start_codes_str.split(',')]
-            extracted_codes.update(start_codes)
-    
-    for department_code, patterns in DEPARTMENT_PATTERNS.items():
-        matched = False
-        
-        # Check if any extracted code matches a pattern (exact match)
-        for pattern in patterns:
-            pattern_upper = pattern.upper()
-            if pattern_upper in extracted_codes:
-                matched = True
-                break
-        
-        # If not matched yet, check for patterns in the content
-        # Use smart matching to avoid false positives:
-        # - For short codes (<=4 chars), require word boundary or non-alphanumeric boundaries
-        # - For longer patterns (department names), use word boundary matching
-        if not matched:
-            for pattern in patterns:
-                pattern_upper = pattern.upper()
-                if len(pattern) <= 4:
-                    # Short codes: match only at word boundaries or non-alphanumeric boundaries
-                    # This prevents "E11" matching "LE11", but allows "M31" matching "M31," or "M31_"
-                    # Use negative lookbehind/lookahead to ensure not part of a longer alphanumeric sequence
-                    pattern_regex = r'(?<![A-Z0-9])' + re.escape(pattern_upper) + r'(?![A-Z0-9])'
-                else:
-                    # Longer patterns (department names): use word boundary
-                    pattern_regex = r'\b' + re.escape(pattern_upper) + r'\b'
-                
-                if re.search(pattern_regex, content_upper):
-                    matched = True
-                    break
-        
-        if matched:
-            matched_departments.append(department_code)
-    
-    return matched_departments
+            extracted_codes.update(code.strip() for code in start_codes_str.split(','))
+    
+    matched = set()
+    
+    # Extracted codes that are exactly a known pattern
+    for code in extracted_codes:
+        matched.update(matcher['exact'].get(code, ()))
+    
+    # Patterns anywhere in the content, in a single scan
+    if matcher['scanner'] is not None:
+        short_hits = matcher['short_hits']
+        name_hits = matcher['name_hits']
+        name_regex = matcher['name_regex']
+        for match in matcher['scanner'].finditer(content_upper):
+            if matcher['has_short_codes'] and match.group(1) is not None:
+                matched.update(short_hits[match.group(1)])
+                # A department name may start at the same position
+                if name_regex is not None:
+                    name_match = name_regex.match(content_upper, match.start())
+                    if name_match:
+                        matched.update(name_hits[name_match.group(1)])
+            else:
+                matched.update(name_hits[match.group(match.lastindex)])
+    
+    # Keep the configured department order
+    return [department_code for department_code in matcher['order'] if department_code in matched]
 
 def detect_alarm_kind(content):
     """Detect alarm kind based on content patterns"""
     
-    for kind, patterns in ALARM_TYPE_PATTERNS.items():
+    for kind, patterns in _alarm_kind_patterns:
         if any(pattern in content for pattern in patterns):
             return kind
     
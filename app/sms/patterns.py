@@ -0,0 +1,149 @@
+"""Department and alarm kind patterns stored in the database
+
+sms_department_patterns and sms_alarm_kind_patterns (migrations/005) replace
+the hard-coded DEPARTMENT_PATTERNS / ALARM_TYPE_PATTERNS in config.py, which
+are only used to seed the table once and as a fallback when the database is not
+reachable. The patterns are compiled into the parser matcher once per load;
+every edit bumps sms_pattern_config.version and each worker process rebuilds
+its matcher when it sees a new version, so edits apply without a restart.
+"""
+
+import threading
+import time
+from .. import db
+from . import parser
+from .config import DEPARTMENT_PATTERNS
+
+# How often each worker checks for edited patterns
+RELOAD_INTERVAL = 10  # seconds
+
+# Department code (upper case) -> departments.id, swapped together with the matcher
+_department_ids = {}
+_loaded_version = None
+_load_lock = threading.Lock()
+_reloader = None
+
+def current_version():
+    """Version of the stored patterns"""
+    row = db.sql_one("SELECT version FROM sms_pattern_config")
+    return row[0] if row else 0
+
+def _seed_from_config():
+    """Copy config.py patterns into the table once, for departments that exist"""
+    rows = []
+    for department_code, patterns in DEPARTMENT_PATTERNS.items():
+        for position, pattern in enumerate(patterns):
+            rows.append((department_code, pattern, position))
+    # Only the worker that flips 'seeded' inserts, and never again after admins edit
+    db.sql_exec("""
+        WITH claim AS (
+            UPDATE sms_pattern_config SET seeded = TRUE WHERE NOT seeded RETURNING 1
+        )
+        INSERT INTO sms_department_patterns (department_id, pattern, position)
+        SELECT d.id, c.pattern, c.position
+        FROM unnest(%s::text[], %s::text[], %s::int[]) AS c(code, pattern, position)
+        JOIN departments d ON UPPER(d.code) = UPPER(c.code)
+        WHERE EXISTS (SELECT 1 FROM claim)
+        ON CONFLICT (department_id, pattern) DO NOTHING
+    """, [row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows])
+
+def _seed_priority_from_config():
+    """Give departments the matching order of config.py once (migrations/010)"""
+    codes = list(DEPARTMENT_PATTERNS)
+    db.sql_exec("""
+        WITH claim AS (
+            UPDATE sms_pattern_config SET priority_seeded = TRUE WHERE NOT priority_seeded RETURNING 1
+        )
+        UPDATE departments d SET sms_priority = c.priority
+        FROM unnest(%s::text[]) WITH ORDINALITY AS c(code, priority)
+        WHERE UPPER(d.code) = UPPER(c.code) AND d.sms_priority IS NULL
+        AND EXISTS (SELECT 1 FROM claim)
+    """, codes)
+
+def _department_rows():
+    """(department id, code, pattern) for every department, in matching order.
+
+    The first matching department becomes an alarm's primary department, so
+    departments are ordered by sms_priority (config.py order), then id.
+    """
+    return db.sql_all("""
+        SELECT d.id, d.code, p.pattern
+        FROM departments d
+        LEFT JOIN sms_department_patterns p ON p.department_id = d.id
+        ORDER BY d.sms_priority NULLS LAST, d.id, p.position, p.id
+    """)
+
+def load():
+    """Load patterns from the database and swap them into the parser"""
+    global _department_ids, _loaded_version
+    with _load_lock:
+        seeded, priority_seeded = db.sql_one("SELECT seeded, priority_seeded FROM sms_pattern_config")
+        if not seeded:
+            _seed_from_config()
+        if not priority_seeded:
+            _seed_priority_from_config()
+
+        version = current_version()
+        department_rows = _department_rows()
+
+        kind_rows = db.sql_all("""
+            SELECT kind::text, pattern FROM sms_alarm_kind_patterns ORDER BY position, kind, id
+        """)
+
+        department_patterns = {}
+        department_ids = {}
+        for department_id, code, pattern in department_rows:
+            department_ids[code.upper()] = department_id
+            if pattern:
+                department_patterns.setdefault(code, []).append(pattern)
+
+        alarm_kind_patterns = {}
+        for kind, pattern in kind_rows:
+            alarm_kind_patterns.setdefault(kind, []).append(pattern)
+
+        # Compiled once here, never per message
+        parser.set_department_patterns(department_patterns)
+        parser.set_alarm_kind_patterns(alarm_kind_patterns)
+        _department_ids = department_ids
+        _loaded_version = version
+        print(f"SMS patterns loaded (version {version}): {len(department_patterns)} departments, "
+              f"{sum(len(p) for p in department_patterns.values())} patterns")
+
+def reload_if_changed():
+    """Reload when another worker or an admin has changed the patterns"""
+    if current_version() != _loaded_version:
+        load()
+
+def department_ids(codes):
+    """Map detected department codes to departments.id, return (ids, unknown codes)"""
+    if _loaded_version is None:
+        load()
+    ids = []
+    unknown = []
+    for code in codes:
+        department_id = _department_ids.get(code.upper())
+        if department_id is None:
+            unknown.append(code)
+        elif department_id not in ids:
+            ids.append(department_id)
+    return ids, unknown
+
+def _run_reloader():
+    while True:
+        time.sleep(RELOAD_INTERVAL)
+        try:
+            reload_if_changed()
+        except Exception as e:
+            print(f"SMS pattern reload failed: {e}")
+
+def start():
+    """Load the patterns and keep them in sync (once per process)"""
+    global _reloader
+    try:
+        load()
+    except Exception as e:
+        # Keep parsing with config.py patterns until the database answers
+        print(f"SMS patterns not loaded, using config.py: {e}")
+    if _reloader is None or not _reloader.is_alive():
+        _reloader = threading.Thread(target=_run_reloader, name='sms-pattern-reloader', daemon=True)
+        _reloader.start()
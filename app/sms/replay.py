@@ -0,0 +1,222 @@
+"""Replay logged SMS through the parser or the full ingest path
+
+Usage:
+    python -m app.sms.replay logs/                           # parse-only, throughput and pattern hits
+    python -m app.sms.replay logs/ --write-baseline base.json
+    python -m app.sms.replay logs/ --baseline base.json      # diff parse results against a baseline
+    python -m app.sms.replay logs/ --process --database-url postgresql://.../alarm_scratch --concurrency 8
+
+Reads the webhook logs in both formats: the old pretty-printed
+sms_webhook_*.log files (entries separated by a line of '=') and the JSONL
+files written by logwriter.py, plain or gzipped. --process runs every message
+through process_sms_alarm against the given database, which must be a
+scratch database: alarms are created in it.
+"""
+
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from . import parser
+
+LOG_PATTERNS = ('sms_webhook_*.log', 'sms_webhook_*.jsonl', 'sms_webhook_*.jsonl.gz')
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+def _read_records(path):
+    """Yield log records from one file in either format"""
+    with _open(path) as f:
+        if '.jsonl' in path:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        # Old format: indented JSON objects separated by a line of '='
+        entry = []
+        for line in f:
+            if line.startswith('====='):
+                if entry:
+                    yield json.loads(''.join(entry))
+                entry = []
+            else:
+                entry.append(line)
+        if ''.join(entry).strip():
+            yield json.loads(''.join(entry))
+
+def log_files(paths):
+    """Expand directories to their webhook log files, sorted by name"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in LOG_PATTERNS:
+                files.extend(glob.glob(os.path.join(path, pattern)))
+        else:
+            files.append(path)
+    return sorted(set(files))
+
+def load_messages(paths):
+    """Return the logged messages as dicts with content, sender and timestamp"""
+    messages = []
+    for path in log_files(paths):
+        try:
+            for record in _read_records(path):
+                data = record.get('data')
+                if not isinstance(data, dict) or not data.get('content'):
+                    continue
+                try:
+                    timestamp = int(data.get('timestamp') or record.get('raw_timestamp'))
+                except (TypeError, ValueError):
+                    timestamp = None
+                messages.append({
+                    'content': data['content'],
+                    'sender': data.get('sender'),
+                    'timestamp': timestamp
+                })
+        except (OSError, ValueError) as e:
+            print(f"Skipping {path}: {e}")
+    return messages
+
+def content_key(content):
+    """Baseline key for a message"""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def run(messages, func, concurrency):
+    """Run func over the messages, return (results, latencies in seconds, elapsed seconds)"""
+    def timed(message):
+        start = time.perf_counter()
+        try:
+            result = func(message)
+        except Exception as e:
+            result = {'status': 'error', 'message': str(e)}
+        return result, time.perf_counter() - start
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            timings = list(executor.map(timed, messages))
+    else:
+        timings = [timed(message) for message in messages]
+    elapsed = time.perf_counter() - start
+    return [t[0] for t in timings], [t[1] for t in timings], elapsed
+
+def diff_baseline(messages, results, baseline):
+    """Return [(content, expected, actual)] for messages whose parse result changed"""
+    diffs = []
+    seen = set()
+    for message, result in zip(messages, results):
+        key = content_key(message['content'])
+        if key in seen or key not in baseline:
+            continue
+        seen.add(key)
+        if baseline[key] != result:
+            diffs.append((message['content'], baseline[key], result))
+    return diffs
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Replay logged SMS and measure throughput')
+    arg_parser.add_argument('paths', nargs='*', default=['logs'], help='log files or directories (default: logs)')
+    arg_parser.add_argument('--process', action='store_true',
+                            help='run process_sms_alarm against --database-url instead of parsing only')
+    arg_parser.add_argument('--database-url', help='scratch database for --process')
+    arg_parser.add_argument('--concurrency', type=int, default=1, help='worker threads (default 1)')
+    arg_parser.add_argument('--repeat', type=int, default=1, help='replay the messages this many times')
+    arg_parser.add_argument('--baseline', help='JSON file of earlier parse results to diff against')
+    arg_parser.add_argument('--write-baseline', help='write parse results to this JSON file')
+    arg_parser.add_argument('--show-diffs', type=int, default=10, help='number of diffs to print')
+    args = arg_parser.parse_args(argv)
+
+    messages = load_messages(args.paths)
+    if not messages:
+        print("No logged messages found")
+        return 1
+    print(f"Loaded {len(messages)} messages from {len(log_files(args.paths))} files")
+
+    if args.process:
+        if not args.database_url:
+            print("--process needs --database-url pointing at a scratch database")
+            return 1
+        os.environ['DATABASE_URL'] = args.database_url
+        from .. import db
+        from .handler import process_sms_alarm
+        db.init_db()
+        db.run_migrations()
+        func = lambda message: process_sms_alarm(message['content'], message['sender'], message['timestamp'])
+    else:
+        # Time the parser itself; repeats would otherwise only time memo lookups
+        func = lambda message: parser.parse_sms_alarm_uncached(message['content'])
+
+    workload = messages * max(1, args.repeat)
+    parser.clear_parse_cache()
+    parser.reset_parse_cache_stats()
+    if not args.process:
+        # Memo hit rate of the workload, counted in an untimed pass
+        for message in workload:
+            parser.parse_sms_alarm(message['content'])
+    parser.reset_format_hits()
+    results, latencies, elapsed = run(workload, func, max(1, args.concurrency))
+    latencies.sort()
+
+    mode = 'process_sms_alarm' if args.process else 'parse_sms_alarm_uncached'
+    print(f"\n{mode}: {len(workload)} messages in {elapsed:.2f}s "
+          f"({len(workload) / elapsed:,.0f} msg/s, concurrency {args.concurrency})")
+    print("latency ms: " + '  '.join(
+        f"{label} {percentile(latencies, fraction) * 1000:.3f}"
+        for label, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))
+    ))
+
+    if args.process:
+        statuses = {}
+        for result in results:
+            statuses[result['status']] = statuses.get(result['status'], 0) + 1
+        print("results: " + ', '.join(f"{status} {count}" for status, count in sorted(statuses.items())))
+
+    cache = parser.get_parse_cache_stats()
+    print(f"parse memo: {cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate']:.0%} hit rate)")
+
+    print("\nPattern hits:")
+    for name, count in sorted(parser.get_format_hits().items(), key=lambda item: -item[1]):
+        print(f"  {name:<32} {count:>8}")
+
+    # Baselines always compare parse results, also after a --process run
+    parsed = results[:len(messages)]
+    if args.process:
+        parsed = [result.get('parsed_data') for result in parsed]
+
+    if args.write_baseline:
+        baseline = {content_key(m['content']): result for m, result in zip(messages, parsed)}
+        with open(args.write_baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        print(f"\nBaseline with {len(baseline)} messages written: {args.write_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        diffs = diff_baseline(messages, parsed, baseline)
+        if diffs:
+            print(f"\n✗ {len(diffs)} messages parse differently than the baseline")
+            for content, expected, actual in diffs[:args.show_diffs]:
+                print(f"  {content!r}")
+                print(f"    expected: {json.dumps(expected, ensure_ascii=False)}")
+                print(f"    actual:   {json.dumps(actual, ensure_ascii=False)}")
+            return 2
+        print("\n✓ Parse results match the baseline")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
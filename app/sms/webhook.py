@@ -2,41 +2,25 @@
 
 from flask import request, jsonify
 from datetime import datetime
-import json
-import os
-from .handler import process_sms_alarm
+from . import dedup, ingest, logwriter, patterns
+from .handler import process_sms_batch
+
+# Largest number of messages accepted by /sms-webhook/batch in one request
+MAX_BATCH_SIZE = 1000
 
 def log_sms_data(data, method, timestamp=None):
-    """Log SMS data to file for debugging"""
-    try:
-        # Create logs directory if it doesn't exist
-        log_dir = "logs"
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir)
-        
-        # Create log file with current date
-        log_file = os.path.join(log_dir, f"sms_webhook_{datetime.now().strftime('%Y-%m-%d')}.log")
-        
-        # Prepare log entry
-        log_entry = {
-            "timestamp": datetime.now().isoformat(),
-            "method": method,
-            "data": data,
-            "raw_timestamp": timestamp
-        }
-        
-        # Write to log file
-        with open(log_file, "a", encoding="utf-8") as f:
-            f.write(json.dumps(log_entry, ensure_ascii=False, indent=2) + "\n" + "="*50 + "\n")
-            
-        print(f"SMS data logged to: {log_file}")
-        
-    except Exception as e:
-        print(f"Error logging SMS data: {e}")
+    """Log SMS data to file for debugging (buffered, written in the background)"""
+    logwriter.log(data, method, timestamp)
 
 def register_sms_routes(app):
     """Register SMS webhook routes with Flask app"""
     
+    # Department patterns from the database, kept in sync across workers
+    patterns.start()
+    
+    # Drain queued SMS into alarms in the background
+    ingest.start_worker()
+    
     @app.route('/sms-webhook', methods=['POST', 'GET'])
     def receive_sms():
         """Receive SMS alarms from SMS gateway"""
@@ -49,11 +33,14 @@ def register_sms_routes(app):
                 else:
                     data = request.get_json(force=True)
                 
+                if not isinstance(data, dict):
+                    return jsonify({'status': 'error', 'message': 'Invalid JSON payload'}), 400
+                
                 print(f"SMS Webhook POST received: {data}")  # Debug logging
                 print(f"Content-Type: {request.content_type}")  # Debug content type
                 
                 # Log to file
-                log_sms_data(data, 'POST', data.get('timestamp') if data else None)
+                log_sms_data(data, 'POST', data.get('timestamp'))
                 
                 content = data.get('content', '')
                 sender = data.get('sender', '')
@@ -71,7 +58,12 @@ def register_sms_routes(app):
                 sender = request.args.get('sender', '')
                 recipient = request.args.get('recipient', '')
                 mid = request.args.get('mid', '')
-                timestamp = int(request.args.get('timestamp', datetime.now().timestamp()))
+                timestamp = request.args.get('timestamp', int(datetime.now().timestamp()))
+            
+            try:
+                timestamp = int(timestamp)
+            except (TypeError, ValueError):
+                return jsonify({'status': 'error', 'message': 'Invalid timestamp'}), 400
             
             print(f"Parsed SMS: content='{content}', sender='{sender}', timestamp='{timestamp}'")
             
@@ -79,31 +71,66 @@ def register_sms_routes(app):
                 print("ERROR: No content provided")
                 return jsonify({'status': 'error', 'message': 'No content provided'}), 400
             
-            # Process the SMS alarm
-            result = process_sms_alarm(content, sender, timestamp)
+            # Gateway retry of a message we already handled - return the original result
+            dedup_key = dedup.message_key(mid, content, timestamp)
+            previous = dedup.recall(dedup_key)
+            if previous is not None:
+                return jsonify(dict(previous, duplicate=True))
+            
+            # Back-pressure: let the gateway retry later instead of growing the queue
+            if ingest.pending_count() >= ingest.MAX_PENDING:
+                response = jsonify({'status': 'error', 'message': 'Queue full, retry later'})
+                response.headers['Retry-After'] = '30'
+                return response, 503
             
-            if result['status'] == 'success':
-                return jsonify({
-                    'status': 'success', 
-                    'alarm_id': result['alarm_id'],
-                    'department': result['department'],
-                    'all_departments': result.get('all_departments', [result['department']]),
-                    'kind': result['kind']
-                })
-            elif result['status'] == 'ignored':
-                return jsonify({
-                    'status': 'ignored',
-                    'reason': result['reason']
-                })
-            else:
-                return jsonify({
-                    'status': 'error',
-                    'message': result['message']
-                }), 500
+            # Acknowledge as soon as the message is durably queued - the worker creates the alarm
+            queued = ingest.enqueue({
+                'content': content,
+                'sender': sender,
+                'recipient': recipient,
+                'mid': mid,
+                'timestamp': timestamp,
+                'dedup_key': dedup_key
+            })
+            
+            if queued['duplicate'] and queued['result']:
+                return jsonify(dict(queued['result'], duplicate=True))
+            
+            # Not remembered: only a finished result may answer a retry without asking
+            # the queue, which re-queues a message that failed in the meantime
+            response = {'status': 'queued', 'queue_id': queued['queue_id']}
+            if queued['duplicate']:
+                response['duplicate'] = True
+            return jsonify(response)
                 
         except Exception as e:
             return jsonify({'status': 'error', 'message': str(e)}), 500
 
+    @app.route('/sms-webhook/batch', methods=['POST'])
+    def receive_sms_batch():
+        """Receive a backlog of SMS (gateway replay after an outage) in one request"""
+        
+        data = request.get_json(force=True, silent=True)
+        messages = data.get('messages') if isinstance(data, dict) else data
+        
+        if not isinstance(messages, list):
+            return jsonify({'status': 'error', 'message': 'Expected a JSON array of messages'}), 400
+        if len(messages) > MAX_BATCH_SIZE:
+            return jsonify({'status': 'error', 'message': f'At most {MAX_BATCH_SIZE} messages per batch'}), 413
+        
+        print(f"SMS Webhook batch received: {len(messages)} messages")
+        for message in messages:
+            if isinstance(message, dict):
+                log_sms_data(message, 'BATCH', message.get('timestamp'))
+        
+        try:
+            results = process_sms_batch(messages)
+        except Exception as e:
+            # Nothing was committed - the gateway can retry the whole batch
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+        
+        return jsonify({'status': 'success', 'count': len(results), 'results': results})
+
     @app.route('/sms-test', methods=['POST'])
     def test_sms():
         """Test endpoint for SMS alarm processing"""
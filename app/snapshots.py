@@ -0,0 +1,237 @@
+"""Shared per-alarm attendance snapshots for the live display
+
+Many viewers (wall screen, officer tablet, phones) poll the same alarm. The
+merged and sorted roster is built once per alarm per tick (or after a write
+invalidates it) and each viewer only gets a cheap projection of it. Arrival
+status, time remaining and order come from the query, so building a snapshot
+does no date arithmetic in Python. A background sweep records passed ETAs as
+arrivals (migrations/007).
+"""
+
+import threading
+import time
+from . import db
+
+# Seconds a snapshot is served before it is rebuilt
+SNAPSHOT_TTL = 2
+
+# Seconds a viewer's roles and departments are cached
+VIEWER_TTL = 30
+
+# Seconds between sweeps that turn passed ETAs into arrivals
+SWEEP_INTERVAL = 15
+
+_snapshots = {}
+_viewers = {}
+_lock = threading.Lock()
+_build_locks = {}
+_sweeper = None
+
+def invalidate(alarm_id):
+    """Drop the snapshot for an alarm after attendance or responses changed"""
+    with _lock:
+        _snapshots.pop(str(alarm_id), None)
+
+def get_viewer(user_id):
+    """Return cached role flags and department ids for a viewer"""
+    now = time.monotonic()
+    with _lock:
+        cached = _viewers.get(user_id)
+    if cached and now - cached['built_at'] < VIEWER_TTL:
+        return cached
+
+    row = db.sql_one("""
+        SELECT u.role_07, u.is_admin, u.is_md,
+               COALESCE(array_agg(ud.department_id) FILTER (WHERE ud.department_id IS NOT NULL), '{}')
+        FROM users u
+        LEFT JOIN user_departments ud ON ud.user_id = u.id
+        WHERE u.id = %s
+        GROUP BY u.id
+    """, user_id)
+
+    role_07, is_admin, is_md, department_ids = row if row else (False, False, False, [])
+    viewer = {
+        'built_at': now,
+        'can_see_phones': bool(role_07 or is_admin or is_md),  # Include MD role for phone visibility
+        'has_role_07': bool(role_07),
+        'department_ids': frozenset(department_ids),
+    }
+    with _lock:
+        _viewers[user_id] = viewer
+    return viewer
+
+def _format_person(user_id, attended_at, comment, eta, department_id, phone, first_name, last_name,
+                   is_rd, is_chafoer, dept_code, dept_name, dept_number, arrival_status, seconds_remaining):
+    """Build the attendee dict shared by all viewers (phone is stripped per viewer)"""
+    last_initial = last_name[0] + '.' if last_name else ''
+    display_name = f"{first_name} {last_initial}".strip()
+    rd_status = ' RD' if is_rd else ''
+    chafoer_status = ' C' if is_chafoer else ''
+
+    return {
+        'user_id': user_id,
+        'attended_at': attended_at.isoformat() if attended_at else None,
+        'comment': comment,
+        'eta': eta.isoformat() if eta else None,
+        'eta_future': arrival_status == 'incoming',
+        'arrival_status': arrival_status,
+        'seconds_remaining': seconds_remaining,
+        'department_id': department_id,
+        'department_code': dept_code,
+        'department_name': dept_name,
+        'department_number': dept_number,
+        'display_name': f"{user_id} {display_name}{rd_status}{chafoer_status}",
+        'first_name': first_name,
+        'last_name': last_name,
+        'is_rd': is_rd,
+        'is_chafoer': is_chafoer,
+        'phone': phone
+    }
+
+# Attendance rows, plus responses from people without one, for one alarm
+# (parameters: alarm id twice). Arrival status is decided against the database
+# clock: on_site (arrived, or ETA passed), incoming (ETA ahead) or no_eta
+# (coming, no ETA given).
+_ROSTER = """
+    WITH roster AS (
+        SELECT a.user_id, a.department_id, a.attended_at, a.comment, a.eta,
+               a.attended_at AS changed_at,
+               CASE WHEN a.eta > now() THEN 'incoming' ELSE 'on_site' END AS arrival_status
+        FROM attendance a
+        WHERE a.alarm_id = %s
+        UNION ALL
+        SELECT ar.user_id, ar.department_id, NULL, ar.comment, ar.eta,
+               ar.responded_at,
+               CASE WHEN ar.eta IS NULL THEN 'no_eta'
+                    WHEN ar.eta > now() THEN 'incoming'
+                    ELSE 'on_site' END
+        FROM alarm_responses ar
+        WHERE ar.alarm_id = %s AND ar.is_attending = true
+          AND NOT EXISTS (
+              SELECT 1 FROM attendance a
+              WHERE a.alarm_id = ar.alarm_id
+                AND a.department_id = ar.department_id
+                AND a.user_id = ar.user_id
+          )
+    )
+"""
+
+def _build(alarm_id):
+    """Load the merged roster and per-department counts of an alarm; Python only serialises"""
+    alarm = db.sql_one("SELECT occurred_at, ended_at FROM alarms WHERE id = %s", alarm_id)
+
+    # On site comes first, latest arrival first; then incoming, shortest time
+    # remaining first; no ETA last
+    rows = db.sql_all(_ROSTER + """
+        SELECT r.user_id, r.attended_at, r.comment, r.eta, r.department_id,
+               u.phone, u.first_name, u.last_name, u.is_rd, u.is_chafoer, d.code, d.name, ud.number,
+               r.arrival_status,
+               CASE WHEN r.arrival_status = 'incoming'
+                    THEN CEIL(EXTRACT(EPOCH FROM r.eta - now()))::int END AS seconds_remaining,
+               MAX(r.changed_at) OVER () AS last_change_at
+        FROM roster r
+        JOIN users u ON r.user_id = u.id
+        JOIN departments d ON r.department_id = d.id
+        LEFT JOIN user_departments ud ON r.user_id = ud.user_id AND r.department_id = ud.department_id
+        ORDER BY CASE r.arrival_status WHEN 'on_site' THEN 0 WHEN 'incoming' THEN 1 ELSE 2 END,
+                 CASE WHEN r.arrival_status = 'on_site' THEN COALESCE(r.eta, r.attended_at) END DESC,
+                 CASE WHEN r.arrival_status = 'incoming' THEN r.eta END,
+                 r.changed_at, r.user_id
+    """, alarm_id, alarm_id)
+
+    # Counters shown for departments the viewer doesn't belong to; no ETA means still coming
+    count_rows = db.sql_all(_ROSTER + """
+        SELECT r.department_id, d.code, d.name,
+               COUNT(*) FILTER (WHERE r.arrival_status <> 'on_site') AS incoming,
+               COUNT(*) FILTER (WHERE r.arrival_status = 'on_site') AS on_site,
+               COUNT(*) FILTER (WHERE u.is_rd) AS rd_count
+        FROM roster r
+        JOIN users u ON r.user_id = u.id
+        JOIN departments d ON r.department_id = d.id
+        GROUP BY r.department_id, d.code, d.name
+    """, alarm_id, alarm_id)
+
+    return {
+        'built_at': time.monotonic(),
+        'occurred_at': alarm[0] if alarm else None,
+        'ended_at': alarm[1] if alarm else None,
+        'exists': alarm is not None,
+        'last_change_at': rows[0][15] if rows else None,
+        'attendees': [_format_person(*row[:15]) for row in rows],
+        'dept_counts': {
+            row[0]: {'code': row[1], 'name': row[2], 'incoming': row[3], 'on_site': row[4], 'rd_count': row[5]}
+            for row in count_rows
+        },
+    }
+
+def get_snapshot(alarm_id):
+    """Return the current snapshot for an alarm, building it at most once per tick"""
+    alarm_id = str(alarm_id)
+
+    with _lock:
+        snapshot = _snapshots.get(alarm_id)
+        if snapshot and time.monotonic() - snapshot['built_at'] < SNAPSHOT_TTL:
+            return snapshot
+        build_lock = _build_locks.setdefault(alarm_id, threading.Lock())
+
+    # Only one viewer rebuilds; the others wait and reuse its result
+    with build_lock:
+        with _lock:
+            snapshot = _snapshots.get(alarm_id)
+        if snapshot and time.monotonic() - snapshot['built_at'] < SNAPSHOT_TTL:
+            return snapshot
+
+        snapshot = _build(alarm_id)
+        with _lock:
+            _snapshots[alarm_id] = snapshot
+            # Forget alarms nobody has looked at for a while
+            cutoff = time.monotonic() - 60 * SNAPSHOT_TTL
+            for stale_id in [key for key, value in _snapshots.items() if value['built_at'] < cutoff]:
+                _snapshots.pop(stale_id, None)
+                _build_locks.pop(stale_id, None)
+        return snapshot
+
+def project(snapshot, viewer):
+    """Per-viewer view of a snapshot: own departments in full, other departments as counters"""
+    department_ids = viewer['department_ids']
+    can_see_phones = viewer['can_see_phones']
+
+    attendees = []
+    for person in snapshot['attendees']:
+        if person['department_id'] not in department_ids:
+            continue
+        if not can_see_phones:
+            person = dict(person, phone=None)
+        attendees.append(person)
+
+    other_dept_counts = {}
+    if viewer['has_role_07']:
+        other_dept_counts = {
+            dept_id: dict(counts)
+            for dept_id, counts in snapshot['dept_counts'].items()
+            if dept_id not in department_ids
+        }
+
+    return attendees, other_dept_counts
+
+def sweep_passed_etas():
+    """Record passed ETAs as arrivals and drop the snapshots of the alarms that changed"""
+    rows = db.sql_all("SELECT alarm_id FROM sweep_passed_etas()")
+    for row in rows:
+        invalidate(row[0])
+    return len(rows)
+
+def _run_sweeper():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        try:
+            sweep_passed_etas()
+        except Exception as e:
+            print(f"ETA sweep failed: {e}")
+
+def start_sweeper():
+    """Start the background ETA sweep (once per process)"""
+    global _sweeper
+    if _sweeper is None or not _sweeper.is_alive():
+        _sweeper = threading.Thread(target=_run_sweeper, name='eta-sweeper', daemon=True)
+        _sweeper.start()
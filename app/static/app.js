@@ -119,14 +119,45 @@ function setupAdminForms() {
     }
 }
 
+// Post one user action. Network failures and server errors are retried with the
+// same Idempotency-Key, so the server applies the action at most once.
+function postAction(url, body, attempts = 3) {
+    const key = (window.crypto && crypto.randomUUID)
+        ? crypto.randomUUID()
+        : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    
+    const retry = (attempt) => new Promise(resolve => setTimeout(resolve, 1000 * attempt))
+        .then(() => send(attempt + 1));
+    
+    const send = (attempt) => fetch(url, {
+        method: 'POST',
+        body: body,
+        headers: {'Idempotency-Key': key},
+        credentials: 'same-origin'
+    })
+    .then(response => {
+        // 409 with Retry-After: the first try is still running on the server
+        const inProgress = response.status === 409 && response.headers.has('Retry-After');
+        if ((response.status >= 500 || inProgress) && attempt < attempts) {
+            return retry(attempt);
+        }
+        return response;
+    }, error => {
+        if (attempt < attempts) {
+            return retry(attempt);
+        }
+        throw error;
+    });
+    
+    return send(1);
+}
+
 // Global functions for admin actions
 function markAttendance(alarmId, departmentId, button) {
     button.disabled = true;
     button.textContent = 'Markerar...';
     
-    fetch(`/attendance/${alarmId}/${departmentId}`, {
-        method: 'POST'
-    })
+    postAction(`/attendance/${alarmId}/${departmentId}`)
     .then(response => response.json())
     .then(data => {
         if (data.success) {
@@ -0,0 +1,18 @@
+-- Raw store of every SMS received from the gateway, keyed for idempotent ingestion
+-- dedup_key is the gateway message id (mid), or a hash of content + timestamp when mid is missing
+CREATE TABLE IF NOT EXISTS sms_messages (
+  id          SERIAL PRIMARY KEY,
+  dedup_key   TEXT NOT NULL UNIQUE,
+  mid         TEXT,
+  sender      TEXT,
+  recipient   TEXT,
+  content     TEXT NOT NULL,
+  sent_at     TIMESTAMPTZ,
+  received_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  status      TEXT NOT NULL,
+  alarm_id    UUID REFERENCES alarms(id) ON DELETE SET NULL,
+  result      JSONB
+);
+
+CREATE INDEX IF NOT EXISTS idx_sms_messages_received_at ON sms_messages(received_at);
+CREATE INDEX IF NOT EXISTS idx_sms_messages_alarm_id ON sms_messages(alarm_id);
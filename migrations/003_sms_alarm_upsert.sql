@@ -0,0 +1,62 @@
+-- Find-or-create an SMS alarm and link its departments in one round trip
+-- An SMS for the same incident (same what / where / type) within the window joins the open alarm.
+-- Concurrent calls for the same incident are serialised by a transaction-level advisory lock,
+-- so two near-simultaneous messages can never both create an alarm.
+
+-- Advisory lock key for an incident (collisions only serialise unrelated incidents)
+CREATE OR REPLACE FUNCTION sms_alarm_lock_key(p_what TEXT, p_where TEXT, p_alarm_type TEXT)
+RETURNS BIGINT AS $$
+  SELECT hashtextextended(concat_ws(chr(31), 'sms_alarm', p_what, p_where, p_alarm_type), 0);
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION upsert_sms_alarm(
+  p_kind             alarm_kind,
+  p_description      TEXT,
+  p_occurred_at      TIMESTAMPTZ,
+  p_alarm_type       TEXT,
+  p_what             TEXT,
+  p_where            TEXT,
+  p_who_called       TEXT,
+  p_department_codes TEXT[],
+  p_window           INTERVAL DEFAULT INTERVAL '2 minutes'
+)
+RETURNS TABLE (id UUID, created BOOLEAN, missing_codes TEXT[]) AS $$
+#variable_conflict use_column
+DECLARE
+  v_alarm_id UUID;
+  v_created  BOOLEAN := FALSE;
+BEGIN
+  PERFORM pg_advisory_xact_lock(sms_alarm_lock_key(p_what, p_where, p_alarm_type));
+
+  SELECT a.id INTO v_alarm_id
+  FROM alarms a
+  WHERE a.source = 'SMS'
+    AND a.what IS NOT DISTINCT FROM p_what
+    AND a.where_location IS NOT DISTINCT FROM p_where
+    AND a.alarm_type IS NOT DISTINCT FROM p_alarm_type
+    AND a.occurred_at BETWEEN p_occurred_at - p_window AND p_occurred_at + p_window
+    AND a.ended_at IS NULL
+  ORDER BY a.occurred_at DESC
+  LIMIT 1;
+
+  IF v_alarm_id IS NULL THEN
+    INSERT INTO alarms (kind, description, occurred_at, source, alarm_type, what, where_location, who_called)
+    VALUES (p_kind, p_description, p_occurred_at, 'SMS', p_alarm_type, p_what, p_where, p_who_called)
+    RETURNING alarms.id INTO v_alarm_id;
+    v_created := TRUE;
+  END IF;
+
+  -- Department codes are matched case-insensitively (LuFBK vs LUFBK)
+  INSERT INTO alarm_departments (alarm_id, department_id)
+  SELECT v_alarm_id, d.id
+  FROM departments d
+  WHERE UPPER(d.code) IN (SELECT UPPER(c) FROM unnest(p_department_codes) AS c)
+  ON CONFLICT (alarm_id, department_id) DO NOTHING;
+
+  RETURN QUERY
+  SELECT v_alarm_id, v_created, ARRAY(
+    SELECT c FROM unnest(p_department_codes) AS c
+    WHERE NOT EXISTS (SELECT 1 FROM departments d WHERE UPPER(d.code) = UPPER(c))
+  );
+END;
+$$ LANGUAGE plpgsql;
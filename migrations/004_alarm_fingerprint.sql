@@ -0,0 +1,79 @@
+-- Indexed fingerprint for SMS duplicate detection
+-- fingerprint is a hash of the normalised what / where_location / alarm_type (trimmed,
+-- whitespace collapsed, lower case; NULL kept distinct from ''), so finding an open
+-- duplicate is one index probe on (source, fingerprint, occurred_at) however long the history.
+
+CREATE OR REPLACE FUNCTION alarm_fingerprint(p_what TEXT, p_where TEXT, p_alarm_type TEXT)
+RETURNS TEXT AS $$
+  SELECT md5(concat_ws(chr(31),
+    COALESCE(lower(btrim(regexp_replace(p_what, '\s+', ' ', 'g'))), chr(1)),
+    COALESCE(lower(btrim(regexp_replace(p_where, '\s+', ' ', 'g'))), chr(1)),
+    COALESCE(lower(btrim(regexp_replace(p_alarm_type, '\s+', ' ', 'g'))), chr(1))
+  ));
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Generated column: filled for existing alarms when added, kept up to date on every insert/update
+ALTER TABLE alarms ADD COLUMN IF NOT EXISTS fingerprint TEXT
+  GENERATED ALWAYS AS (alarm_fingerprint(what, where_location, alarm_type)) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_alarms_open_fingerprint
+  ON alarms(source, fingerprint, occurred_at) WHERE ended_at IS NULL;
+
+-- Advisory lock key is now derived from the fingerprint
+DROP FUNCTION IF EXISTS sms_alarm_lock_key(TEXT, TEXT, TEXT);
+
+CREATE OR REPLACE FUNCTION sms_alarm_lock_key(p_fingerprint TEXT)
+RETURNS BIGINT AS $$
+  SELECT hashtextextended('sms_alarm:' || p_fingerprint, 0);
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION upsert_sms_alarm(
+  p_kind             alarm_kind,
+  p_description      TEXT,
+  p_occurred_at      TIMESTAMPTZ,
+  p_alarm_type       TEXT,
+  p_what             TEXT,
+  p_where            TEXT,
+  p_who_called       TEXT,
+  p_department_codes TEXT[],
+  p_window           INTERVAL DEFAULT INTERVAL '2 minutes'
+)
+RETURNS TABLE (id UUID, created BOOLEAN, missing_codes TEXT[]) AS $$
+#variable_conflict use_column
+DECLARE
+  v_fingerprint TEXT := alarm_fingerprint(p_what, p_where, p_alarm_type);
+  v_alarm_id    UUID;
+  v_created     BOOLEAN := FALSE;
+BEGIN
+  PERFORM pg_advisory_xact_lock(sms_alarm_lock_key(v_fingerprint));
+
+  SELECT a.id INTO v_alarm_id
+  FROM alarms a
+  WHERE a.source = 'SMS'
+    AND a.fingerprint = v_fingerprint
+    AND a.occurred_at BETWEEN p_occurred_at - p_window AND p_occurred_at + p_window
+    AND a.ended_at IS NULL
+  ORDER BY a.occurred_at DESC
+  LIMIT 1;
+
+  IF v_alarm_id IS NULL THEN
+    INSERT INTO alarms (kind, description, occurred_at, source, alarm_type, what, where_location, who_called)
+    VALUES (p_kind, p_description, p_occurred_at, 'SMS', p_alarm_type, p_what, p_where, p_who_called)
+    RETURNING alarms.id INTO v_alarm_id;
+    v_created := TRUE;
+  END IF;
+
+  -- Department codes are matched case-insensitively (LuFBK vs LUFBK)
+  INSERT INTO alarm_departments (alarm_id, department_id)
+  SELECT v_alarm_id, d.id
+  FROM departments d
+  WHERE UPPER(d.code) IN (SELECT UPPER(c) FROM unnest(p_department_codes) AS c)
+  ON CONFLICT (alarm_id, department_id) DO NOTHING;
+
+  RETURN QUERY
+  SELECT v_alarm_id, v_created, ARRAY(
+    SELECT c FROM unnest(p_department_codes) AS c
+    WHERE NOT EXISTS (SELECT 1 FROM departments d WHERE UPPER(d.code) = UPPER(c))
+  );
+END;
+$$ LANGUAGE plpgsql;
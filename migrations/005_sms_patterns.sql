@@ -0,0 +1,108 @@
+-- SMS department and alarm kind patterns, editable by admins without a redeploy
+-- Every change bumps sms_pattern_config.version; workers poll it and rebuild their parser matcher.
+
+CREATE TABLE IF NOT EXISTS sms_department_patterns (
+  id            SERIAL PRIMARY KEY,
+  department_id INTEGER NOT NULL REFERENCES departments(id) ON DELETE CASCADE,
+  pattern       TEXT NOT NULL CHECK (btrim(pattern) <> ''),
+  position      INTEGER NOT NULL DEFAULT 0,
+  UNIQUE (department_id, pattern)
+);
+
+-- Alarm kind is the first kind (by position) with a pattern contained in the message
+CREATE TABLE IF NOT EXISTS sms_alarm_kind_patterns (
+  id       SERIAL PRIMARY KEY,
+  kind     alarm_kind NOT NULL,
+  pattern  TEXT NOT NULL CHECK (pattern <> ''),
+  position INTEGER NOT NULL DEFAULT 0,
+  UNIQUE (kind, pattern)
+);
+
+INSERT INTO sms_alarm_kind_patterns (kind, pattern, position) VALUES
+  ('practice', 'PROVALARM', 0),
+  ('practice', 'Övning', 0),
+  ('practice', 'test', 0),
+  ('test', 'test', 1),
+  ('test', 'TEST', 1)
+ON CONFLICT (kind, pattern) DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS sms_pattern_config (
+  id         BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+  version    BIGINT NOT NULL DEFAULT 1,
+  seeded     BOOLEAN NOT NULL DEFAULT FALSE, -- config.py patterns copied in once
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+INSERT INTO sms_pattern_config (id) VALUES (TRUE) ON CONFLICT (id) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_sms_pattern_version()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE sms_pattern_config SET version = version + 1, updated_at = NOW();
+    RETURN NULL;
+END;
+$$ language 'plpgsql';
+
+-- Department codes are part of the compiled matcher too
+DROP TRIGGER IF EXISTS trigger_sms_department_patterns_version ON sms_department_patterns;
+CREATE TRIGGER trigger_sms_department_patterns_version
+    AFTER INSERT OR UPDATE OR DELETE ON sms_department_patterns
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_sms_pattern_version();
+
+DROP TRIGGER IF EXISTS trigger_sms_alarm_kind_patterns_version ON sms_alarm_kind_patterns;
+CREATE TRIGGER trigger_sms_alarm_kind_patterns_version
+    AFTER INSERT OR UPDATE OR DELETE ON sms_alarm_kind_patterns
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_sms_pattern_version();
+
+DROP TRIGGER IF EXISTS trigger_departments_sms_pattern_version ON departments;
+CREATE TRIGGER trigger_departments_sms_pattern_version
+    AFTER INSERT OR UPDATE OR DELETE ON departments
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_sms_pattern_version();
+
+-- Departments are now resolved by id from the compiled patterns, not by code
+DROP FUNCTION IF EXISTS upsert_sms_alarm(alarm_kind, TEXT, TIMESTAMPTZ, TEXT, TEXT, TEXT, TEXT, TEXT[], INTERVAL);
+
+CREATE OR REPLACE FUNCTION upsert_sms_alarm(
+  p_kind           alarm_kind,
+  p_description    TEXT,
+  p_occurred_at    TIMESTAMPTZ,
+  p_alarm_type     TEXT,
+  p_what           TEXT,
+  p_where          TEXT,
+  p_who_called     TEXT,
+  p_department_ids INTEGER[],
+  p_window         INTERVAL DEFAULT INTERVAL '2 minutes'
+)
+RETURNS TABLE (id UUID, created BOOLEAN) AS $$
+#variable_conflict use_column
+DECLARE
+  v_fingerprint TEXT := alarm_fingerprint(p_what, p_where, p_alarm_type);
+  v_alarm_id    UUID;
+  v_created     BOOLEAN := FALSE;
+BEGIN
+  PERFORM pg_advisory_xact_lock(sms_alarm_lock_key(v_fingerprint));
+
+  SELECT a.id INTO v_alarm_id
+  FROM alarms a
+  WHERE a.source = 'SMS'
+    AND a.fingerprint = v_fingerprint
+    AND a.occurred_at BETWEEN p_occurred_at - p_window AND p_occurred_at + p_window
+    AND a.ended_at IS NULL
+  ORDER BY a.occurred_at DESC
+  LIMIT 1;
+
+  IF v_alarm_id IS NULL THEN
+    INSERT INTO alarms (kind, description, occurred_at, source, alarm_type, what, where_location, who_called)
+    VALUES (p_kind, p_description, p_occurred_at, 'SMS', p_alarm_type, p_what, p_where, p_who_called)
+    RETURNING alarms.id INTO v_alarm_id;
+    v_created := TRUE;
+  END IF;
+
+  INSERT INTO alarm_departments (alarm_id, department_id)
+  SELECT v_alarm_id, department_id
+  FROM unnest(p_department_ids) AS department_id
+  ON CONFLICT (alarm_id, department_id) DO NOTHING;
+
+  RETURN QUERY SELECT v_alarm_id, v_created;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,62 @@
+-- Attendance and response writes in one round trip
+-- Checks department membership, upserts alarm_responses and upserts attendance in one
+-- transaction. ETAs are computed server-side as now() + minutes, independent of any
+-- application time zone. Returns FALSE (and writes nothing) when the user is not a member.
+--   p_arrival_minutes  minutes until arrival; > 0 sets an ETA
+--   p_is_attending     FALSE records only the response (no attendance row)
+--   p_record_response  FALSE skips alarm_responses (manual attendance by admins)
+--   p_on_site          the user is on site now: clears the ETA and sets attended_at
+CREATE OR REPLACE FUNCTION record_attendance(
+  p_alarm_id        UUID,
+  p_department_id   INTEGER,
+  p_user_id         TEXT,
+  p_comment         TEXT,
+  p_arrival_minutes INTEGER,
+  p_is_attending    BOOLEAN DEFAULT TRUE,
+  p_record_response BOOLEAN DEFAULT TRUE,
+  p_on_site         BOOLEAN DEFAULT FALSE
+)
+RETURNS BOOLEAN AS $$
+DECLARE
+  v_eta TIMESTAMPTZ;
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM user_departments
+    WHERE user_id = p_user_id AND department_id = p_department_id
+  ) THEN
+    RETURN FALSE;
+  END IF;
+
+  IF p_is_attending AND NOT p_on_site AND p_arrival_minutes > 0 THEN
+    v_eta := now() + make_interval(mins => p_arrival_minutes);
+  END IF;
+
+  IF p_record_response THEN
+    INSERT INTO alarm_responses (alarm_id, department_id, user_id, comment, is_attending, eta)
+    VALUES (p_alarm_id, p_department_id, p_user_id, p_comment, p_is_attending, v_eta)
+    ON CONFLICT (alarm_id, department_id, user_id)
+    DO UPDATE SET
+      comment = EXCLUDED.comment,
+      is_attending = EXCLUDED.is_attending,
+      eta = EXCLUDED.eta,
+      responded_at = now();
+  END IF;
+
+  IF p_is_attending THEN
+    INSERT INTO attendance (alarm_id, department_id, user_id, comment, eta, attended_at)
+    VALUES (p_alarm_id, p_department_id, p_user_id, p_comment, v_eta, now())
+    ON CONFLICT (alarm_id, department_id, user_id)
+    DO UPDATE SET
+      comment = EXCLUDED.comment,
+      eta = EXCLUDED.eta,
+      attended_at = CASE
+        WHEN p_on_site THEN EXCLUDED.attended_at
+        WHEN EXCLUDED.eta IS NULL THEN COALESCE(attendance.attended_at, now())
+        WHEN EXCLUDED.eta <= now() THEN COALESCE(attendance.attended_at, now())
+        ELSE attendance.attended_at
+      END;
+  END IF;
+
+  RETURN TRUE;
+END;
+$$ language 'plpgsql';
@@ -0,0 +1,22 @@
+-- Turn passed ETAs into arrivals
+-- An attendance row with an ETA in the past means the member has arrived. The sweep
+-- moves the ETA into attended_at and clears it, so readers only have to compare
+-- future ETAs against now(). Returns the alarms that changed, so their cached
+-- rosters can be dropped.
+CREATE INDEX IF NOT EXISTS idx_attendance_eta ON attendance(eta) WHERE eta IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION sweep_passed_etas()
+RETURNS TABLE(alarm_id UUID) AS $$
+#variable_conflict use_column
+BEGIN
+  RETURN QUERY
+  WITH swept AS (
+    UPDATE attendance a
+    SET attended_at = a.eta,
+        eta = NULL
+    WHERE a.eta IS NOT NULL AND a.eta <= now()
+    RETURNING a.alarm_id
+  )
+  SELECT DISTINCT swept.alarm_id FROM swept;
+END;
+$$ language 'plpgsql';
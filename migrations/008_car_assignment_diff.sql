@@ -0,0 +1,104 @@
+-- Diff-based car assignment saves with an optimistic version check
+-- alarm_car_assignment_versions holds one version per alarm and department. A save
+-- passes the version it was based on; when another officer has saved since, nothing
+-- is written and the current version is returned. Otherwise the posted assignments
+-- are applied as a diff in one statement: removed people are deleted, new people
+-- inserted and only rows that actually changed are updated.
+CREATE TABLE IF NOT EXISTS alarm_car_assignment_versions (
+  alarm_id      UUID NOT NULL REFERENCES alarms(id) ON DELETE CASCADE,
+  department_id INTEGER NOT NULL REFERENCES departments(id) ON DELETE CASCADE,
+  version       BIGINT NOT NULL DEFAULT 0,
+  updated_at    TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  updated_by    CHARACTER(4) REFERENCES users(id) ON DELETE SET NULL,
+  PRIMARY KEY (alarm_id, department_id)
+);
+
+--   p_expected_version  version the client loaded; NULL skips the check
+--   returns saved = FALSE (and writes nothing) on a version conflict
+CREATE OR REPLACE FUNCTION save_car_assignments(
+  p_alarm_id                UUID,
+  p_department_id           INTEGER,
+  p_expected_version        BIGINT,
+  p_updated_by              TEXT,
+  p_user_ids                TEXT[],
+  p_car_codes               TEXT[],
+  p_mantimmar_insats        NUMERIC[],
+  p_mantimmar_bevakning     NUMERIC[],
+  p_mantimmar_aterstallning NUMERIC[],
+  p_anvant_aa_rokdykning    TEXT[],
+  p_anvant_aa_sjalvskydd    TEXT[]
+)
+RETURNS TABLE(saved BOOLEAN, version BIGINT, inserted INTEGER, updated INTEGER, deleted INTEGER) AS $$
+#variable_conflict use_column
+DECLARE
+  v_version  BIGINT;
+  v_inserted INTEGER;
+  v_updated  INTEGER;
+  v_deleted  INTEGER;
+BEGIN
+  INSERT INTO alarm_car_assignment_versions (alarm_id, department_id)
+  VALUES (p_alarm_id, p_department_id)
+  ON CONFLICT (alarm_id, department_id) DO NOTHING;
+
+  -- Serialises concurrent saves of the same report
+  SELECT v.version INTO v_version
+  FROM alarm_car_assignment_versions v
+  WHERE v.alarm_id = p_alarm_id AND v.department_id = p_department_id
+  FOR UPDATE;
+
+  IF p_expected_version IS NOT NULL AND p_expected_version <> v_version THEN
+    RETURN QUERY SELECT FALSE, v_version, 0, 0, 0;
+    RETURN;
+  END IF;
+
+  WITH input AS (
+    SELECT *
+    FROM unnest(p_user_ids, p_car_codes, p_mantimmar_insats, p_mantimmar_bevakning,
+                p_mantimmar_aterstallning, p_anvant_aa_rokdykning, p_anvant_aa_sjalvskydd)
+      AS i(user_id, car_code, mantimmar_insats, mantimmar_bevakning,
+           mantimmar_aterstallning, anvant_aa_rokdykning, anvant_aa_sjalvskydd)
+  ), removed AS (
+    DELETE FROM alarm_user_car_assignments ua
+    WHERE ua.alarm_id = p_alarm_id AND ua.department_id = p_department_id
+      AND NOT EXISTS (SELECT 1 FROM input i WHERE i.user_id = ua.user_id)
+    RETURNING 1
+  ), upserted AS (
+    INSERT INTO alarm_user_car_assignments AS ua
+      (alarm_id, department_id, user_id, car_code,
+       mantimmar_insats, mantimmar_bevakning, mantimmar_aterstallning,
+       anvant_aa_rokdykning, anvant_aa_sjalvskydd)
+    SELECT p_alarm_id, p_department_id, i.user_id, i.car_code,
+           i.mantimmar_insats, i.mantimmar_bevakning, i.mantimmar_aterstallning,
+           i.anvant_aa_rokdykning, i.anvant_aa_sjalvskydd
+    FROM input i
+    ON CONFLICT (alarm_id, department_id, user_id)
+    DO UPDATE SET car_code = EXCLUDED.car_code,
+                  mantimmar_insats = EXCLUDED.mantimmar_insats,
+                  mantimmar_bevakning = EXCLUDED.mantimmar_bevakning,
+                  mantimmar_aterstallning = EXCLUDED.mantimmar_aterstallning,
+                  anvant_aa_rokdykning = EXCLUDED.anvant_aa_rokdykning,
+                  anvant_aa_sjalvskydd = EXCLUDED.anvant_aa_sjalvskydd
+    -- Unchanged rows are left alone
+    WHERE (ua.car_code, ua.mantimmar_insats, ua.mantimmar_bevakning, ua.mantimmar_aterstallning,
+           ua.anvant_aa_rokdykning, ua.anvant_aa_sjalvskydd)
+          IS DISTINCT FROM
+          (EXCLUDED.car_code, EXCLUDED.mantimmar_insats, EXCLUDED.mantimmar_bevakning,
+           EXCLUDED.mantimmar_aterstallning, EXCLUDED.anvant_aa_rokdykning, EXCLUDED.anvant_aa_sjalvskydd)
+    RETURNING (xmax = 0) AS is_insert
+  )
+  SELECT (SELECT count(*) FROM removed),
+         count(*) FILTER (WHERE is_insert),
+         count(*) FILTER (WHERE NOT is_insert)
+  INTO v_deleted, v_inserted, v_updated
+  FROM upserted;
+
+  IF v_deleted + v_inserted + v_updated > 0 THEN
+    UPDATE alarm_car_assignment_versions v
+    SET version = v.version + 1, updated_at = now(), updated_by = p_updated_by
+    WHERE v.alarm_id = p_alarm_id AND v.department_id = p_department_id
+    RETURNING v.version INTO v_version;
+  END IF;
+
+  RETURN QUERY SELECT TRUE, v_version, v_inserted, v_updated, v_deleted;
+END;
+$$ language 'plpgsql';
@@ -0,0 +1,15 @@
+-- Idempotency keys for attendance and response posts
+-- A client sends the same Idempotency-Key header when it retries one user action.
+-- The first request claims the key (response NULL while it runs) and stores its
+-- response; replays get the stored response and never reach attendance again.
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+  user_id       CHARACTER(4) NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+  key           TEXT NOT NULL,
+  endpoint      TEXT NOT NULL,
+  status_code   INTEGER,
+  response      JSONB,
+  created_at    TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (user_id, key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at);
@@ -0,0 +1,8 @@
+-- Matching order of departments in SMS parsing
+-- The first department detected in a multi-department SMS becomes the alarm's primary
+-- department. That order used to be the key order of DEPARTMENT_PATTERNS in config.py;
+-- sms_priority keeps it explicit once the patterns live in the database. It is seeded
+-- once from config.py (see app/sms/patterns.py) and departments without one come last.
+ALTER TABLE departments ADD COLUMN IF NOT EXISTS sms_priority INTEGER;
+
+ALTER TABLE sms_pattern_config ADD COLUMN IF NOT EXISTS priority_seeded BOOLEAN NOT NULL DEFAULT FALSE;
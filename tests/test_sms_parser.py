@@ -0,0 +1,63 @@
+"""SMS parser golden corpus and benchmarks
+
+The golden tests parse every message in app/sms/corpus/messages.json and
+compare with golden.json (regenerate with `python -m app.sms.bench
+--update-golden` after an intended parser change). The benchmarks run with
+pytest-benchmark; compare runs on one machine with --benchmark-autosave and
+--benchmark-compare.
+"""
+
+import importlib.util
+import pytest
+from app.sms import bench, parser
+
+MESSAGES = bench.load_messages()
+GOLDEN = bench.load_golden()
+CONTENTS = [message['content'] for message in MESSAGES]
+
+requires_benchmark = pytest.mark.skipif(importlib.util.find_spec('pytest_benchmark') is None,
+                                        reason='pytest-benchmark not installed')
+
+def test_golden_covers_corpus():
+    assert set(GOLDEN) == {message['name'] for message in MESSAGES}
+
+@pytest.mark.parametrize('message', MESSAGES, ids=[message['name'] for message in MESSAGES])
+def test_golden(message):
+    assert parser.parse_sms_alarm_uncached(message['content']) == GOLDEN[message['name']]
+
+@pytest.mark.parametrize('message', MESSAGES, ids=[message['name'] for message in MESSAGES])
+def test_golden_memoised(message):
+    # Twice, so the second result comes from the memo
+    parser.parse_sms_alarm(message['content'])
+    assert parser.parse_sms_alarm(message['content']) == GOLDEN[message['name']]
+
+def test_memo_skips_parse_across_pattern_change(monkeypatch):
+    # Patterns swapped while a parse runs: its result must not be memoised
+    parse = parser._parse_sms_alarm
+    def parse_during_reload(content):
+        result = parse(content)
+        parser.clear_parse_cache()
+        return result
+    monkeypatch.setattr(parser, '_parse_sms_alarm', parse_during_reload)
+    content = CONTENTS[0] + ' memo'
+    parser.parse_sms_alarm(content)
+    monkeypatch.setattr(parser, '_parse_sms_alarm', parse)
+    misses = parser.get_parse_cache_stats()['misses']
+    parser.parse_sms_alarm(content)
+    assert parser.get_parse_cache_stats()['misses'] == misses + 1
+
+def _parse_corpus(func):
+    for content in CONTENTS:
+        func(content)
+
+@requires_benchmark
+def test_benchmark_parse_sms_alarm(benchmark):
+    benchmark(_parse_corpus, parser.parse_sms_alarm_uncached)
+
+@requires_benchmark
+def test_benchmark_detect_all_departments(benchmark):
+    benchmark(_parse_corpus, parser.detect_all_departments)
+
+@requires_benchmark
+def test_benchmark_extract_department_codes_from_end(benchmark):
+    benchmark(_parse_corpus, parser.extract_department_codes_from_end)